@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import logging
+import socket
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def quiet_logging(caplog):
+    """
+    Measure like a production deployment running with `--quiet`, without capturing log messages.
+    """
+    caplog.set_level(logging.WARNING)
+
+
+@pytest.fixture
+def udp_receiver():
+    """
+    A local UDP socket, acting as receiver of telemetry messages. Its address is `(host, port)`.
+    """
+    receiver = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    # Let the kernel drop datagrams when the buffer is full, instead of reading them.
+    receiver.setblocking(False)
+    yield receiver
+    receiver.close()
+
+
+def pytest_benchmark_update_json(config, benchmarks, output_json):
+    """
+    Keep the committed baseline small, by omitting the raw timings of each round. Statistics are kept.
+    """
+    for benchmark in output_json["benchmarks"]:
+        benchmark["stats"].pop("data", None)
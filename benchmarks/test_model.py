@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import contextlib
+import io
+
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.util import to_json
+from testing.data import dummy_reading, dummy_wire_message_good
+
+
+def test_reading_from_buffer(benchmark):
+    reading = benchmark(CalypsoReading.from_buffer, bytearray(dummy_wire_message_good))
+    assert reading.wind_speed == 5.69
+
+
+def test_decode_reading(benchmark):
+    reading = benchmark(CalypsoDeviceApi.decode_reading, bytearray(dummy_wire_message_good))
+    assert reading.wind_direction == 206
+
+
+def test_reading_to_json(benchmark):
+    payload = benchmark(to_json, dummy_reading.asdict())
+    assert '"wind_speed": 5.69' in payload
+
+
+def test_reading_dump(benchmark):
+    buffer = io.StringIO()
+
+    def dump():
+        buffer.seek(0)
+        buffer.truncate()
+        with contextlib.redirect_stdout(buffer):
+            dummy_reading.dump()
+
+    benchmark(dump)
+    assert '"wind_speed": 5.69' in buffer.getvalue()
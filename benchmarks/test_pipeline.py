@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+
+import pytest
+
+from calypso_anemometer.engine import handler_factory
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.pipeline import ProgressStage
+
+READINGS = 1000
+
+
+async def run_pipeline(target: str, queue_size: int):
+    """
+    Drive the whole pipeline using a fake device producing readings as fast as possible, until `READINGS` are done.
+    """
+    done = asyncio.Event()
+    handler = await handler_factory(
+        subscribe=True,
+        target=target,
+        quiet=True,
+        queue_size=queue_size,
+        stages=[ProgressStage(callback=lambda count: done.set(), each=READINGS)],
+    )
+    async with CalypsoDeviceApiFake(unlimited=True, batch_size=100) as calypso:
+        task = asyncio.ensure_future(handler(calypso))
+        await done.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.parametrize("scheme", ["udp+signalk+delta", "udp+broadcast+nmea0183"])
+@pytest.mark.parametrize("queue_size", [0, 128], ids=["inline", "queue"])
+def test_fake_pipeline(benchmark, udp_receiver, scheme, queue_size):
+    host, port = udp_receiver.getsockname()
+    benchmark.extra_info["readings"] = READINGS
+    benchmark.pedantic(lambda: asyncio.run(run_pipeline(f"{scheme}://{host}:{port}", queue_size)), rounds=5)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import random
+
+from calypso_anemometer.stats import TDigest
+
+READINGS = 10000
+
+
+def test_tdigest_update(benchmark):
+    """
+    Account for wind speeds reading by reading, like the engine does.
+    """
+    rng = random.Random(42)
+    values = [rng.weibullvariate(6.0, 2.0) for _ in range(READINGS)]
+
+    def run():
+        digest = TDigest()
+        for value in values:
+            digest.update(value)
+        return digest
+
+    benchmark.extra_info["readings"] = READINGS
+    benchmark(run)
+
+
+def test_tdigest_merge(benchmark):
+    """
+    Merge one digest per day of a season, like `calypso-anemometer percentiles` does.
+    """
+    rng = random.Random(42)
+    days = []
+    for _ in range(180):
+        digest = TDigest()
+        for _ in range(1000):
+            digest.update(rng.weibullvariate(6.0, 2.0))
+        days.append(digest.serialize())
+
+    def run():
+        season = TDigest()
+        for day in days:
+            season.merge(TDigest.deserialize(day))
+        return season.percentile(0.99)
+
+    benchmark(run)
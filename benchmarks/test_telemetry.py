@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import pytest
+
+from calypso_anemometer.telemetry.adapter import TelemetryAdapter
+from calypso_anemometer.telemetry.nmea0183 import Nmea0183Envelope, Nmea0183GenericMessage
+from calypso_anemometer.telemetry.signalk import SignalKDeltaMessage
+from testing.data import dummy_reading
+
+
+def test_nmea0183_render(benchmark):
+    def render():
+        envelope = Nmea0183Envelope()
+        envelope.set_reading(dummy_reading)
+        return envelope.render()
+
+    payload = benchmark(render)
+    assert payload.startswith("$MLHDT,235.0,T*")
+
+
+def test_nmea0183_checksum(benchmark):
+    checksum = benchmark(Nmea0183GenericMessage.checksum, "$MLVWR,154.0,L,11.06,N,5.69,M,20.48,K")
+    assert checksum == 0x64
+
+
+def test_signalk_render(benchmark):
+    def render():
+        message = SignalKDeltaMessage(source="Calypso UP10", location="Mast")
+        message.set_reading(dummy_reading)
+        return message.render()
+
+    payload = benchmark(render)
+    assert payload.startswith('{"updates": [{"$source": "calypso-up10"')
+
+
+@pytest.mark.parametrize("scheme", ["udp+signalk+delta", "udp+broadcast+nmea0183"])
+def test_telemetry_submit(benchmark, udp_receiver, scheme):
+    host, port = udp_receiver.getsockname()
+    telemetry = TelemetryAdapter(uri=f"{scheme}://{host}:{port}")
+    benchmark(telemetry.submit, dummy_reading)
+    assert udp_receiver.recv(4096)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from calypso_anemometer.truewind import BoatMotion, apply_true_wind  # noqa: E402
+from calypso_anemometer.wind import WindModel  # noqa: E402
+
+READINGS = 10000
+
+
+@pytest.mark.parametrize("batch_size", [1, 1000], ids=["live", "bulk"])
+def test_true_wind(benchmark, batch_size):
+    """
+    Compute true wind reading by reading, like the pipeline stage, and in batches, like processing recordings.
+    """
+    readings = WindModel(seed=42).generate(READINGS, interval=0.25)
+    motion = BoatMotion.fixed(speed=3.0, course=120.0).asarrays(batch_size)
+
+    def run():
+        for start in range(0, READINGS, batch_size):
+            apply_true_wind(readings[start : start + batch_size], motion)
+
+    benchmark.extra_info["readings"] = READINGS
+    benchmark(run)
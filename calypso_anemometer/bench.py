@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Check the capacity of a deployment target before going live.
+
+The benchmark drives the real stack, from the BLE notification handler of
+`CalypsoDeviceApi`, through decoding, the processing pipeline, and rendering
+telemetry messages, up to sending them to a local UDP socket. Readings are
+produced by an emulated peripheral, using pre-encoded notification payloads,
+so producing them does not account for the measurement.
+
+Log messages about each telemetry message are suppressed while benchmarking,
+so the numbers reflect a deployment running with `--quiet`.
+
+Synopsis::
+
+    report = await Bench(protocol=TelemetryProtocol.UDP_SIGNALK_DELTA, duration=5).run()
+"""
+import asyncio
+import dataclasses
+import logging
+import socket
+import time
+import typing as t
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.emulator import EmulatedPeripheral
+from calypso_anemometer.fleet import memory_peak
+from calypso_anemometer.model import CalypsoDeviceDataRate
+from calypso_anemometer.pipeline import FanOutStage, Pipeline, SourceStage, TelemetrySink
+from calypso_anemometer.telemetry.adapter import TelemetryAdapter
+from calypso_anemometer.telemetry.model import TelemetryProtocol
+from calypso_anemometer.tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+
+class BenchPeripheral(EmulatedPeripheral):
+    """
+    Emulated peripheral cycling through pre-encoded readings.
+
+    :param datarate: Send notifications at this data rate. `None` sends them as fast as possible.
+    :param variety: How many distinct readings to pre-encode.
+    """
+
+    def __init__(self, datarate: t.Optional[CalypsoDeviceDataRate] = None, variety: int = 1000):
+        super().__init__()
+        self.datarate = datarate
+        self.buffers = [reading.to_buffer() for reading in self.source.produce_fake_readings(variety)]
+        self.position = 0
+
+    @property
+    def interval(self) -> float:
+        if self.datarate is None:
+            return 0.0
+        return self.datarate.interval
+
+    def produce_reading(self) -> bytes:
+        buffer = self.buffers[self.position]
+        self.position = (self.position + 1) % len(self.buffers)
+        return buffer
+
+
+@dataclasses.dataclass
+class BenchReport:
+    """
+    Capacity of the deployment target for one telemetry protocol. Durations are in seconds, memory is in MiB.
+
+    `cpu_load` is the share of one CPU core needed at each data rate, in percent.
+    """
+
+    protocol: str
+    readings: int
+    duration: float
+    readings_per_second: float
+    cpu_per_reading: t.Optional[float]
+    cpu_load: t.Dict[str, t.Optional[float]]
+    latency_p50: t.Optional[float]
+    latency_p99: t.Optional[float]
+    latency_max: t.Optional[float]
+    dropped: int
+    memory_peak: t.Optional[float]
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+    def __str__(self):
+        def fmt(value, scale=1000.0, unit="ms"):
+            return "n/a" if value is None else f"{value * scale:.1f}{unit}"
+
+        return (
+            f"protocol={self.protocol}, readings={self.readings}, "
+            f"readings_per_second={self.readings_per_second:.1f}, "
+            f"cpu_per_reading={fmt(self.cpu_per_reading, 1e6, 'us')}, "
+            f"latency_p50={fmt(self.latency_p50)}, latency_p99={fmt(self.latency_p99)}, "
+            f"latency_max={fmt(self.latency_max)}, dropped={self.dropped}, "
+            f"memory_peak={fmt(self.memory_peak, 1.0, 'MiB')}"
+        )
+
+
+class Bench:
+    """
+    Measure throughput, CPU usage, and end-to-end latency of processing readings.
+
+    :param protocol: Which telemetry protocol to render and send.
+    :param duration: How long to run, in seconds.
+    :param datarate: Send notifications at this data rate. `None` sends them as fast as possible.
+    :param queue_size: Decouple processing from receiving readings using a queue of this size. `0` disables it.
+    """
+
+    def __init__(
+        self,
+        protocol: TelemetryProtocol,
+        duration: float = 5.0,
+        datarate: t.Optional[CalypsoDeviceDataRate] = None,
+        queue_size: int = 128,
+    ):
+        self.protocol = protocol
+        self.duration = duration
+        self.datarate = datarate
+        self.queue_size = queue_size
+
+    async def run(self) -> BenchReport:
+        # The local sink. Datagrams are never read, the kernel drops them when the buffer is full.
+        receiver = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        host, port = receiver.getsockname()
+
+        peripheral = BenchPeripheral(datarate=self.datarate)
+        device = CalypsoDeviceApi(ble_address=peripheral.ADDRESS, client_factory=peripheral.client)
+        source = SourceStage()
+        telemetry = TelemetryAdapter(uri=f"{self.protocol.value}://{host}:{port}")
+        pipeline = Pipeline([source, FanOutStage([TelemetrySink(telemetry)])])
+        tracer = Tracer()
+        tracer.instrument(pipeline)
+        tracer.instrument_device(device)
+        queue = None
+        subscribe_kwargs = {}
+        if self.queue_size:
+            queue = subscribe_kwargs["queue"] = ReadingQueue(maxsize=self.queue_size)
+
+        logger.info(f"Benchmarking {self.protocol.value} for {self.duration} seconds")
+        network_logger = logging.getLogger("calypso_anemometer.telemetry.network")
+        network_level = network_logger.level
+        network_logger.setLevel(logging.WARNING)
+        try:
+            async with device:
+                started_monotonic = time.monotonic()
+                started_cpu = time.process_time()
+                await device.subscribe_reading(pipeline, **subscribe_kwargs)
+                await asyncio.sleep(self.duration)
+                await device.unsubscribe_reading()
+                if queue is not None:
+                    await queue.stop(drain_timeout=1.0)
+                duration = time.monotonic() - started_monotonic
+                cpu_time = time.process_time() - started_cpu
+        finally:
+            network_logger.setLevel(network_level)
+            await pipeline.close()
+            receiver.close()
+
+        readings = source.metrics.received
+        cpu_per_reading = cpu_time / readings if readings else None
+        latency = tracer.histograms["total"]
+        report = BenchReport(
+            protocol=self.protocol.value,
+            readings=readings,
+            duration=duration,
+            readings_per_second=readings / duration,
+            cpu_per_reading=cpu_per_reading,
+            cpu_load={
+                rate.name: None if cpu_per_reading is None else cpu_per_reading / rate.interval * 100
+                for rate in CalypsoDeviceDataRate
+            },
+            latency_p50=latency.percentile(0.50),
+            latency_p99=latency.percentile(0.99),
+            latency_max=latency.max,
+            dropped=queue.metrics.dropped if queue is not None else 0,
+            memory_peak=memory_peak(),
+        )
+        logger.info(f"Bench report: {report}")
+        return report
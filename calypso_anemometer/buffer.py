@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Decouple the BLE notification path from processing readings.
+
+The notification handler only puts decoded readings into a bounded queue,
+while a consumer task invokes the callback, for example dumping to STDOUT
+or sending telemetry data. This way, a slow sink can not delay receiving
+BLE notifications, and overflows are accounted for instead of going by
+silently.
+"""
+import asyncio
+import dataclasses
+import logging
+import typing as t
+
+from calypso_anemometer.model import QueueOverflowPolicy
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class ReadingQueueMetrics:
+    received: int = 0
+    processed: int = 0
+    dropped: int = 0
+    errors: int = 0
+    depth: int = 0
+    depth_max: int = 0
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+
+class ReadingQueue:
+    """
+    Bounded queue with consumer task, sitting between BLE notification callback and processing pipeline.
+
+    :param maxsize: Maximum number of readings to buffer.
+    :param policy: What to do when the queue is full.
+    """
+
+    DROP_LOG_EACH = 100
+
+    def __init__(self, maxsize: int = 128, policy: QueueOverflowPolicy = QueueOverflowPolicy.DROP_OLDEST):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.metrics = ReadingQueueMetrics()
+        self.queue: t.Optional[asyncio.Queue] = None
+        self.consumer: t.Optional[asyncio.Future] = None
+
+    @property
+    def depth(self) -> int:
+        if self.queue is None:
+            return 0
+        return self.queue.qsize()
+
+    @property
+    def running(self) -> bool:
+        return self.consumer is not None and not self.consumer.done()
+
+    def start(self, callback: t.Optional[t.Callable] = None):
+        """
+        Start the consumer task. Calling it again while running is a no-op, so resubscribing is safe.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.maxsize)
+        if self.running:
+            return
+        if callback is not None:
+            self.consumer = asyncio.ensure_future(self.consume(callback))
+
+    async def stop(self, drain_timeout: t.Optional[float] = None) -> int:
+        """
+        Stop the consumer task, and return the number of discarded readings.
+
+        :param drain_timeout: Give the consumer up to this number of seconds to process buffered readings.
+        """
+        if self.consumer is not None:
+            if drain_timeout and self.running and self.depth:
+                try:
+                    await asyncio.wait_for(self.join(), timeout=drain_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self.consumer.cancel()
+            try:
+                await self.consumer
+            except asyncio.CancelledError:
+                pass
+            self.consumer = None
+            if self.depth:
+                logger.warning(f"Reading queue stopped. Discarded readings: {self.depth}")
+        return self.depth
+
+    async def put(self, item: t.Any):
+        """
+        Put item into queue, applying the overflow policy when it is full.
+
+        With the `BLOCK` policy, wait until a free slot is available.
+        """
+        if self.policy is QueueOverflowPolicy.BLOCK:
+            self.metrics.received += 1
+            await self.queue.put(item)
+            self.on_put()
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item: t.Any):
+        """
+        Put item into queue without waiting, applying the overflow policy when it is full.
+
+        Suitable for synchronous callbacks like the BLE notification handler. With the `BLOCK`
+        policy, it will raise `asyncio.QueueFull` when the queue is full.
+        """
+        self.metrics.received += 1
+        if self.queue.full():
+            if self.policy is QueueOverflowPolicy.DROP_NEWEST:
+                self.on_drop()
+                return
+            if self.policy is QueueOverflowPolicy.DROP_OLDEST:
+                self.on_drop()
+                self.queue.get_nowait()
+                self.queue.task_done()
+        self.queue.put_nowait(item)
+        self.on_put()
+
+    def on_put(self):
+        depth = self.queue.qsize()
+        self.metrics.depth = depth
+        if depth > self.metrics.depth_max:
+            self.metrics.depth_max = depth
+
+    async def get(self) -> t.Any:
+        item = await self.queue.get()
+        self.on_get()
+        return item
+
+    def get_nowait(self) -> t.Any:
+        item = self.queue.get_nowait()
+        self.on_get()
+        return item
+
+    def on_get(self):
+        self.queue.task_done()
+        self.metrics.processed += 1
+        self.metrics.depth = self.queue.qsize()
+
+    def iterate(
+        self, batch_size: t.Optional[int] = None, max_latency: t.Optional[float] = None
+    ) -> t.AsyncIterator[t.Any]:
+        """
+        Yield items from the queue, either one by one, or in batches.
+
+        A batch is emitted when it reached `batch_size` items, or `max_latency` seconds
+        after its first item has been received, whichever comes first.
+        """
+        if batch_size is not None and batch_size < 1:
+            raise ValueError(f"Batch size must be a positive number: {batch_size}")
+        if max_latency is not None and max_latency < 0:
+            raise ValueError(f"Maximum latency must not be negative: {max_latency}")
+        return self.iterate_items(batch_size=batch_size, max_latency=max_latency)
+
+    async def iterate_items(
+        self, batch_size: t.Optional[int] = None, max_latency: t.Optional[float] = None
+    ) -> t.AsyncIterator[t.Any]:
+        if batch_size is None:
+            while True:
+                yield await self.get()
+
+        loop = asyncio.get_event_loop()
+        pending: t.Optional[asyncio.Future] = None
+        try:
+            while True:
+                # Wait for the first item of the batch without timeout.
+                if pending is not None:
+                    batch = [await pending]
+                    pending = None
+                else:
+                    batch = [await self.get()]
+                deadline = None
+                if max_latency is not None:
+                    deadline = loop.time() + max_latency
+                while len(batch) < batch_size:
+                    if not self.queue.empty():
+                        batch.append(self.get_nowait())
+                        continue
+                    if deadline is None:
+                        batch.append(await self.get())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    # Do not cancel the pending `get` on timeout, in order not to lose an item.
+                    pending = asyncio.ensure_future(self.get())
+                    done, _ = await asyncio.wait({pending}, timeout=timeout)
+                    if not done:
+                        break
+                    batch.append(pending.result())
+                    pending = None
+                yield batch
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def join(self):
+        """
+        Wait until all items have been processed.
+        """
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def consume(self, callback: t.Callable):
+        while True:
+            item = await self.queue.get()
+            try:
+                callback(item)
+                self.metrics.processed += 1
+            except Exception:
+                self.metrics.errors += 1
+                logger.exception("Processing reading failed")
+            finally:
+                self.queue.task_done()
+                self.metrics.depth = self.queue.qsize()
+
+    def on_drop(self):
+        self.metrics.dropped += 1
+        if self.metrics.dropped % self.DROP_LOG_EACH == 1:
+            logger.warning(
+                f"Reading queue overflow, policy={self.policy.value}. "
+                f"Dropped readings: {self.metrics.dropped}, depth: {self.queue.qsize()}"
+            )
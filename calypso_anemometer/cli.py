@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@panodata.org>
 # License: GNU Affero General Public License, Version 3
+import functools
+import json
 import logging
+import sys
 import typing as t
 
 import click
 
-from calypso_anemometer.core import CalypsoDeviceApi
-from calypso_anemometer.engine import handler_factory, run_engine
-from calypso_anemometer.model import CalypsoDeviceCompassStatus, CalypsoDeviceDataRate, CalypsoDeviceMode, Settings
-from calypso_anemometer.util import EnumChoice, make_sync, setup_logging
+from calypso_anemometer.engine import DRAIN_TIMEOUT, handler_factory, make_workhorse, run_engine
+from calypso_anemometer.exception import CalypsoError
+from calypso_anemometer.model import (
+    CalypsoDeviceCompassStatus,
+    CalypsoDeviceDataRate,
+    CalypsoDeviceMode,
+    QueueOverflowPolicy,
+    Settings,
+)
+from calypso_anemometer.pipeline import PipelineStage
+from calypso_anemometer.profiling import PROFILE_MODES, Profiler
+from calypso_anemometer.stats import TDigest
+from calypso_anemometer.telemetry.model import TelemetryProtocol
+from calypso_anemometer.util import EVENT_LOOPS, EnumChoice, make_sync, setup_event_loop, setup_logging, to_json
 
 logger = logging.getLogger(__name__)
 
@@ -19,14 +32,136 @@ logger = logging.getLogger(__name__)
 @click.option("--quiet", envvar="CALYPSO_QUIET", is_flag=True, required=False, help="Do not print to stdout or stderr.")
 @click.option("--verbose", is_flag=True, required=False, help="Increase log verbosity.")
 @click.option("--debug", is_flag=True, required=False, help="Enable debug messages.")
+@click.option(
+    "--loop",
+    "event_loop",
+    envvar="CALYPSO_LOOP",
+    type=click.Choice(EVENT_LOOPS, case_sensitive=False),
+    required=False,
+    default="asyncio",
+    help="Event loop implementation. `uvloop` needs to be installed separately. Default: asyncio",
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    envvar="CALYPSO_PROFILE",
+    type=click.Path(dir_okay=False, writable=True),
+    required=False,
+    help="Profile the command, and write the profile to this file. A summary is printed to stderr.",
+)
+@click.option(
+    "--profile-mode",
+    type=click.Choice(PROFILE_MODES, case_sensitive=False),
+    required=False,
+    default="cprofile",
+    help="`cprofile` writes a pstats file, `sampling` writes collapsed stacks, "
+    "with less overhead on slow computers. Default: cprofile",
+)
+@click.option(
+    "--profile-duration",
+    type=click.FloatRange(min=0, min_open=True),
+    required=False,
+    help="Stop the command after profiling for this number of seconds.",
+)
+@click.option(
+    "--profile-readings",
+    type=click.IntRange(min=1),
+    required=False,
+    help="Stop the command after profiling this number of processed readings.",
+)
 @click.pass_context
-def cli(ctx, quiet: t.Optional[bool], verbose: t.Optional[bool], debug: t.Optional[bool]):
+def cli(
+    ctx,
+    quiet: t.Optional[bool],
+    verbose: t.Optional[bool],
+    debug: t.Optional[bool],
+    event_loop: str = "asyncio",
+    profile_path: t.Optional[str] = None,
+    profile_mode: str = "cprofile",
+    profile_duration: t.Optional[float] = None,
+    profile_readings: t.Optional[int] = None,
+):
     log_level = logging.INFO
     if quiet:
         log_level = logging.WARNING
     if verbose or debug:
         log_level = logging.DEBUG
     setup_logging(level=log_level)
+    try:
+        setup_event_loop(event_loop.lower())
+    except ImportError as ex:
+        raise click.UsageError(
+            f"Event loop '{event_loop}' is not available: {ex}. "
+            f"Install it using `pip install calypso-anemometer[uvloop]`."
+        ) from None
+    if profile_path is None:
+        if profile_duration is not None or profile_readings is not None:
+            raise click.UsageError("Options `--profile-duration` and `--profile-readings` require `--profile`")
+        return
+    profiler = Profiler(
+        path=profile_path, mode=profile_mode.lower(), duration=profile_duration, readings=profile_readings
+    )
+    ctx.meta["calypso.profiler"] = profiler
+
+    def print_summary():
+        if not quiet:
+            click.echo(f"Profile summary, full profile written to {profile_path}\n{profiler.summary()}", err=True)
+
+    ctx.call_on_close(print_summary)
+
+
+def profiler_stages(ctx: click.Context) -> t.List[PipelineStage]:
+    """
+    Pipeline stages needed by the profiler, if `--profile` is used.
+    """
+    profiler = ctx.meta.get("calypso.profiler")
+    if profiler is None:
+        return []
+    return profiler.stages()
+
+
+def require_numpy(ctx: click.Context, extra: str):
+    """
+    Fail with an installation hint, when NumPy is not available.
+    """
+    try:
+        import numpy  # noqa: F401
+    except ImportError as ex:
+        raise click.UsageError(
+            f"NumPy is not available: {ex}. Install it using `pip install calypso-anemometer[{extra}]`.", ctx=ctx
+        ) from None
+
+
+def outlier_stages(outlier_window: t.Optional[int] = None, outlier_threshold: float = 3.0) -> t.List[PipelineStage]:
+    """
+    Pipeline stages replacing spikes, if `--outlier-window` is used.
+    """
+    if outlier_window is None:
+        return []
+    from calypso_anemometer.outlier import HampelStage
+
+    return [HampelStage(window=outlier_window, threshold=outlier_threshold)]
+
+
+def true_wind_stages(
+    ctx: click.Context,
+    boat_speed: t.Optional[float] = None,
+    boat_course: t.Optional[float] = None,
+    boat_heading: t.Optional[float] = None,
+    nmea_input: t.Optional[str] = None,
+) -> t.List[PipelineStage]:
+    """
+    Pipeline stages computing true wind, if boat motion is given.
+    """
+    if boat_speed is None and boat_course is None and boat_heading is None and nmea_input is None:
+        return []
+    require_numpy(ctx, extra="truewind")
+    from calypso_anemometer.truewind import make_true_wind_stage
+
+    try:
+        return [make_true_wind_stage(speed=boat_speed, course=boat_course, heading=boat_heading, nmea_input=nmea_input)]
+    except ValueError as ex:
+        raise click.UsageError(str(ex), ctx=ctx) from ex
 
 
 ble_adapter_option = click.option(
@@ -74,6 +209,142 @@ compass_option = click.option(
 )
 subscribe_option = click.option("--subscribe", is_flag=True, required=False, help="Continuously receive readings")
 target_option = click.option("--target", type=str, required=False, help="Submit telemetry data to target")
+queue_size_option = click.option(
+    "--queue-size",
+    envvar="CALYPSO_QUEUE_SIZE",
+    type=int,
+    required=False,
+    default=128,
+    help="Size of the queue between receiving and processing readings. Use `0` to process inline. Default: 128",
+)
+queue_overflow_option = click.option(
+    "--queue-overflow",
+    envvar="CALYPSO_QUEUE_OVERFLOW",
+    type=EnumChoice(QueueOverflowPolicy, case_sensitive=False),
+    required=False,
+    default=QueueOverflowPolicy.DROP_OLDEST.name,
+    help="What to do when the queue is full, one of DROP_OLDEST, DROP_NEWEST, or BLOCK (fake device only). "
+    "Default: DROP_OLDEST",
+)
+reconnect_option = click.option(
+    "--reconnect",
+    envvar="CALYPSO_RECONNECT",
+    is_flag=True,
+    required=False,
+    help="Reconnect and resubscribe in-process when the BLE link drops.",
+)
+metrics_address_option = click.option(
+    "--metrics-address",
+    envvar="CALYPSO_METRICS_ADDRESS",
+    type=str,
+    required=False,
+    help="Expose metrics in Prometheus format on this address, like `localhost:9464`, or `:9464` for all interfaces.",
+)
+trace_option = click.option(
+    "--trace",
+    envvar="CALYPSO_TRACE",
+    is_flag=True,
+    required=False,
+    help="Trace latencies from receiving to submitting readings. Logged on SIGUSR1 and at exit.",
+)
+record_option = click.option(
+    "--record",
+    envvar="CALYPSO_RECORD",
+    type=click.Path(dir_okay=False, writable=True),
+    required=False,
+    help="Record readings to this file, in JSON Lines format. Synced to disk when shutting down.",
+)
+sketch_option = click.option(
+    "--sketch",
+    envvar="CALYPSO_SKETCH",
+    type=click.Path(dir_okay=False, writable=True),
+    required=False,
+    help="Resume wind speed percentiles from this file, and write them back. Use a `{device}` placeholder to "
+    "keep one file per device. Files can be merged using `calypso-anemometer percentiles`.",
+)
+drain_timeout_option = click.option(
+    "--drain-timeout",
+    envvar="CALYPSO_DRAIN_TIMEOUT",
+    type=click.FloatRange(min=0),
+    required=False,
+    default=DRAIN_TIMEOUT,
+    help=f"When shutting down, give buffered readings up to this number of seconds to be processed. "
+    f"Default: {DRAIN_TIMEOUT}",
+)
+outlier_window_option = click.option(
+    "--outlier-window",
+    envvar="CALYPSO_OUTLIER_WINDOW",
+    type=click.IntRange(min=3),
+    required=False,
+    help="Replace spikes in wind speed and direction by the median of this number of recent readings, "
+    "using a Hampel filter.",
+)
+outlier_threshold_option = click.option(
+    "--outlier-threshold",
+    envvar="CALYPSO_OUTLIER_THRESHOLD",
+    type=click.FloatRange(min=0, min_open=True),
+    required=False,
+    default=3.0,
+    help="Values deviating from the median by more than this multiple of the scaled median absolute deviation "
+    "are spikes. Default: 3.0",
+)
+boat_speed_option = click.option(
+    "--boat-speed",
+    envvar="CALYPSO_BOAT_SPEED",
+    type=click.FloatRange(min=0),
+    required=False,
+    help="Fixed boat speed in m/s, for computing true wind. Requires `--boat-course`, and NumPy.",
+)
+boat_course_option = click.option(
+    "--boat-course",
+    envvar="CALYPSO_BOAT_COURSE",
+    type=click.FloatRange(min=0, max=360),
+    required=False,
+    help="Fixed boat course in degrees true, for computing true wind. Requires `--boat-speed`.",
+)
+boat_heading_option = click.option(
+    "--boat-heading",
+    envvar="CALYPSO_BOAT_HEADING",
+    type=click.FloatRange(min=0, max=360),
+    required=False,
+    help="Fixed boat heading in degrees true, for computing true wind. Default: The value of `--boat-course`",
+)
+nmea_input_option = click.option(
+    "--nmea-input",
+    envvar="CALYPSO_NMEA_INPUT",
+    type=str,
+    required=False,
+    help="Receive boat motion as NMEA-0183 over UDP on this address, like `:10110`, for computing true wind. "
+    "Uses RMC, VTG, VHW, and HDT sentences. Requires NumPy.",
+)
+emulate_option = click.option(
+    "--emulate",
+    envvar="CALYPSO_EMULATE",
+    is_flag=True,
+    required=False,
+    help="Use an emulated device instead of Bluetooth hardware. Useful for testing and benchmarking.",
+)
+adaptive_option = click.option(
+    "--adaptive",
+    envvar="CALYPSO_ADAPTIVE",
+    is_flag=True,
+    required=False,
+    help="Adjust data rate and power mode at runtime, based on wind variability, battery level, and time of day.",
+)
+watchdog_tolerance_option = click.option(
+    "--watchdog-tolerance",
+    envvar="CALYPSO_WATCHDOG_TOLERANCE",
+    type=float,
+    required=False,
+    help="Resubscribe or reconnect when no reading arrived within this multiple of the expected interval.",
+)
+watchdog_hard_timeout_option = click.option(
+    "--watchdog-hard-timeout",
+    envvar="CALYPSO_WATCHDOG_HARD_TIMEOUT",
+    type=float,
+    required=False,
+    help="Kill the process when no reading arrived within this number of seconds. Requires `--watchdog-tolerance`.",
+)
 
 
 @click.command()
@@ -90,6 +361,8 @@ async def info(
     ble_discovery_timeout: t.Optional[float] = None,
     ble_connect_timeout: t.Optional[float] = None,
 ):
+    from calypso_anemometer.core import CalypsoDeviceApi
+
     settings = Settings(
         ble_adapter=ble_adapter,
         ble_address=ble_address,
@@ -113,6 +386,8 @@ async def explore(
     ble_discovery_timeout: t.Optional[float] = None,
     ble_connect_timeout: t.Optional[float] = None,
 ):
+    from calypso_anemometer.core import CalypsoDeviceApi
+
     settings = Settings(
         ble_adapter=ble_adapter,
         ble_address=ble_address,
@@ -147,6 +422,8 @@ async def set_option(
     rate: t.Optional[CalypsoDeviceDataRate] = None,
     compass: t.Optional[CalypsoDeviceCompassStatus] = None,
 ):
+    from calypso_anemometer.core import CalypsoDeviceApi
+
     async def handler(calypso: CalypsoDeviceApi):
         if mode is not None:
             logger.info(f"Setting device mode to {mode}")
@@ -177,6 +454,24 @@ async def set_option(
 @target_option
 @rate_option
 @compass_option
+@queue_size_option
+@queue_overflow_option
+@reconnect_option
+@adaptive_option
+@emulate_option
+@metrics_address_option
+@trace_option
+@record_option
+@sketch_option
+@drain_timeout_option
+@watchdog_tolerance_option
+@watchdog_hard_timeout_option
+@boat_speed_option
+@boat_course_option
+@boat_heading_option
+@nmea_input_option
+@outlier_window_option
+@outlier_threshold_option
 @click.pass_context
 @make_sync
 async def read(
@@ -189,7 +484,29 @@ async def read(
     target: t.Optional[str] = None,
     rate: t.Optional[CalypsoDeviceDataRate] = None,
     compass: t.Optional[CalypsoDeviceCompassStatus] = None,
+    queue_size: int = 0,
+    queue_overflow: QueueOverflowPolicy = QueueOverflowPolicy.DROP_OLDEST,
+    reconnect: t.Optional[bool] = False,
+    adaptive: t.Optional[bool] = False,
+    emulate: t.Optional[bool] = False,
+    metrics_address: t.Optional[str] = None,
+    trace: t.Optional[bool] = False,
+    record: t.Optional[str] = None,
+    sketch: t.Optional[str] = None,
+    drain_timeout: float = DRAIN_TIMEOUT,
+    watchdog_tolerance: t.Optional[float] = None,
+    watchdog_hard_timeout: t.Optional[float] = None,
+    boat_speed: t.Optional[float] = None,
+    boat_course: t.Optional[float] = None,
+    boat_heading: t.Optional[float] = None,
+    nmea_input: t.Optional[str] = None,
+    outlier_window: t.Optional[int] = None,
+    outlier_threshold: float = 3.0,
 ):
+    if watchdog_hard_timeout is not None and watchdog_tolerance is None:
+        raise click.UsageError("Option `--watchdog-hard-timeout` requires `--watchdog-tolerance`", ctx=ctx)
+    if queue_size and queue_overflow is QueueOverflowPolicy.BLOCK:
+        raise click.UsageError("Option `--queue-overflow=BLOCK` is only supported by the fake device", ctx=ctx)
     quiet = ctx.parent.params.get("quiet")
     settings = Settings(
         ble_adapter=ble_adapter,
@@ -197,29 +514,399 @@ async def read(
         ble_discovery_timeout=ble_discovery_timeout,
         ble_connect_timeout=ble_connect_timeout,
     )
-    handler = await handler_factory(subscribe=subscribe, target=target, rate=rate, compass=compass, quiet=quiet)
-    await run_engine(workhorse=CalypsoDeviceApi, settings=settings, handler=handler)
+    handler = await handler_factory(
+        subscribe=subscribe,
+        target=target,
+        rate=rate,
+        compass=compass,
+        quiet=quiet,
+        watchdog_tolerance=watchdog_tolerance,
+        watchdog_hard_timeout=watchdog_hard_timeout,
+        queue_size=queue_size,
+        queue_overflow=queue_overflow,
+        adaptive=adaptive,
+        stages=[
+            *outlier_stages(outlier_window, outlier_threshold),
+            *true_wind_stages(ctx, boat_speed, boat_course, boat_heading, nmea_input),
+            *profiler_stages(ctx),
+        ],
+        metrics_address=metrics_address,
+        trace=trace,
+        record=record,
+        sketch=sketch,
+        drain_timeout=drain_timeout,
+    )
+    workhorse = make_workhorse(settings=settings, emulate=emulate, reconnect=reconnect)
+    await run_engine(workhorse=workhorse, settings=settings, handler=handler)
 
 
 @click.command()
 @subscribe_option
 @target_option
-@rate_option
+@click.option(
+    "--rate",
+    type=click.Choice([element.name for element in CalypsoDeviceDataRate] + ["UNLIMITED"], case_sensitive=False),
+    required=False,
+    help="Set data rate to one of HZ_1, HZ_4, HZ_8, or UNLIMITED.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    required=False,
+    default=1,
+    help="Produce readings in chunks of this size, on each tick of the data rate. Default: 1",
+)
+@click.option(
+    "--wind-model",
+    is_flag=True,
+    required=False,
+    help="Generate realistic readings using a stochastic wind model. Requires NumPy.",
+)
+@click.option("--seed", type=int, required=False, help="Seed for the wind model, for reproducible readings")
+@click.option(
+    "--devices",
+    type=click.IntRange(min=1),
+    required=False,
+    default=1,
+    help="Run a fleet of this many fake devices within one process, for scale testing. Default: 1",
+)
+@click.option(
+    "--duration",
+    type=click.FloatRange(min=0, min_open=True),
+    required=False,
+    help="Stop after this number of seconds, and report resource usage of the fleet.",
+)
 @compass_option
+@queue_size_option
+@queue_overflow_option
+@adaptive_option
+@metrics_address_option
+@trace_option
+@record_option
+@sketch_option
+@drain_timeout_option
+@boat_speed_option
+@boat_course_option
+@boat_heading_option
+@nmea_input_option
+@outlier_window_option
+@outlier_threshold_option
 @click.pass_context
 @make_sync
 async def fake(
     ctx,
     subscribe: bool = False,
     target: t.Optional[str] = None,
-    rate: t.Optional[CalypsoDeviceDataRate] = None,
+    rate: t.Optional[str] = None,
+    batch_size: int = 1,
+    wind_model: bool = False,
+    seed: t.Optional[int] = None,
+    devices: int = 1,
+    duration: t.Optional[float] = None,
     compass: t.Optional[CalypsoDeviceCompassStatus] = None,
+    queue_size: int = 0,
+    queue_overflow: QueueOverflowPolicy = QueueOverflowPolicy.DROP_OLDEST,
+    adaptive: t.Optional[bool] = False,
+    metrics_address: t.Optional[str] = None,
+    trace: t.Optional[bool] = False,
+    record: t.Optional[str] = None,
+    sketch: t.Optional[str] = None,
+    drain_timeout: float = DRAIN_TIMEOUT,
+    boat_speed: t.Optional[float] = None,
+    boat_course: t.Optional[float] = None,
+    boat_heading: t.Optional[float] = None,
+    nmea_input: t.Optional[str] = None,
+    outlier_window: t.Optional[int] = None,
+    outlier_threshold: float = 3.0,
 ):
     from calypso_anemometer.fake import CalypsoDeviceApiFake
 
+    unlimited = rate == "UNLIMITED"
+    datarate = None
+    if rate is not None and not unlimited:
+        datarate = CalypsoDeviceDataRate[rate]
+
+    quiet = ctx.parent.params.get("quiet")
+    handler = await handler_factory(
+        subscribe=subscribe,
+        target=target,
+        rate=datarate,
+        compass=compass,
+        quiet=quiet,
+        queue_size=queue_size,
+        queue_overflow=queue_overflow,
+        adaptive=adaptive,
+        stages=[
+            *outlier_stages(outlier_window, outlier_threshold),
+            *true_wind_stages(ctx, boat_speed, boat_course, boat_heading, nmea_input),
+            *profiler_stages(ctx),
+        ],
+        metrics_address=metrics_address,
+        trace=trace,
+        record=record,
+        sketch=sketch,
+        drain_timeout=drain_timeout,
+    )
+
+    def make_model(index: int = 0):
+        if not wind_model:
+            return None
+        from calypso_anemometer.wind import WindModel
+
+        # Give each fleet member a distinct seed.
+        return WindModel(seed=None if seed is None else seed + index)
+
+    if devices == 1 and duration is None:
+        workhorse = functools.partial(
+            CalypsoDeviceApiFake, unlimited=unlimited, batch_size=batch_size, model=make_model()
+        )
+        await run_engine(workhorse=workhorse, handler=handler)
+        return
+
+    from calypso_anemometer.fleet import FakeFleet, fleet_address
+
+    def make_device(index: int):
+        return CalypsoDeviceApiFake(
+            ble_address=fleet_address(index), unlimited=unlimited, batch_size=batch_size, model=make_model(index)
+        )
+
+    fleet = FakeFleet(devices=devices, device_factory=make_device)
+    report = await fleet.run(handler=handler, duration=duration)
+    if not quiet:
+        click.echo(to_json(report.asdict()), err=True)
+
+
+@click.command()
+@click.option(
+    "--config",
+    "config_path",
+    envvar="CALYPSO_CONFIG",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    help="Configuration file in TOML format, declaring devices and pipelines. Reloaded on SIGHUP.",
+)
+@click.pass_context
+@make_sync
+async def serve(ctx, config_path: str):
+    """
+    Serve multiple devices and pipelines within one long-lived process.
+    """
+    from calypso_anemometer.daemon import Daemon, DaemonConfig
+
     quiet = ctx.parent.params.get("quiet")
-    handler = await handler_factory(subscribe=subscribe, target=target, rate=rate, compass=compass, quiet=quiet)
-    await run_engine(workhorse=CalypsoDeviceApiFake, handler=handler)
+    try:
+        config = DaemonConfig.from_file(config_path)
+        daemon = Daemon(config=config, path=config_path, stages=profiler_stages(ctx), quiet=quiet)
+        await daemon.run()
+    except CalypsoError as ex:
+        logger.error(ex)
+        sys.exit(1)
+
+
+@click.command()
+@click.option(
+    "--protocol",
+    "protocols",
+    type=EnumChoice(TelemetryProtocol, case_sensitive=False),
+    multiple=True,
+    required=False,
+    help="Benchmark this telemetry protocol, one of UDP_SIGNALK_DELTA or UDP_BROADCAST_NMEA0183. "
+    "Can be used multiple times. Default: all",
+)
+@click.option(
+    "--rate",
+    type=click.Choice([element.name for element in CalypsoDeviceDataRate] + ["UNLIMITED"], case_sensitive=False),
+    required=False,
+    default="UNLIMITED",
+    help="Send notifications at one of HZ_1, HZ_4, HZ_8, or UNLIMITED. Default: UNLIMITED",
+)
+@click.option(
+    "--duration",
+    type=click.FloatRange(min=0, min_open=True),
+    required=False,
+    default=5.0,
+    help="Run each benchmark for this number of seconds. Default: 5.0",
+)
+@queue_size_option
+@click.pass_context
+@make_sync
+async def bench(
+    ctx,
+    protocols: t.Tuple[TelemetryProtocol, ...] = (),
+    rate: str = "UNLIMITED",
+    duration: float = 5.0,
+    queue_size: int = 128,
+):
+    """
+    Check capacity of this computer, driving the real decode, render, and telemetry stack.
+    """
+    from calypso_anemometer.bench import Bench
+
+    datarate = None
+    if rate.upper() != "UNLIMITED":
+        datarate = CalypsoDeviceDataRate[rate.upper()]
+    reports = []
+    for protocol in protocols or TelemetryProtocol:
+        bench = Bench(protocol=protocol, duration=duration, datarate=datarate, queue_size=queue_size)
+        reports.append((await bench.run()).asdict())
+    click.echo(to_json(reports))
+
+
+@click.command()
+@click.argument("infile", type=click.File("r"), default="-")
+@click.option(
+    "--output",
+    "outfile",
+    type=click.File("w"),
+    required=False,
+    default="-",
+    help="Write readings including true wind to this file, in JSON Lines format. Default: stdout",
+)
+@click.option(
+    "--motion-file",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+    help="Log file of NMEA-0183 sentences with boat motion. Timestamps are taken from RMC sentences.",
+)
+@boat_speed_option
+@boat_course_option
+@boat_heading_option
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    required=False,
+    default=10000,
+    help="Compute true wind in batches of this number of readings. Default: 10000",
+)
+@click.pass_context
+def true_wind(
+    ctx,
+    infile: t.TextIO,
+    outfile: t.TextIO,
+    motion_file: t.Optional[str] = None,
+    boat_speed: t.Optional[float] = None,
+    boat_course: t.Optional[float] = None,
+    boat_heading: t.Optional[float] = None,
+    batch_size: int = 10000,
+):
+    """
+    Compute true wind for readings recorded using `--record`, in bulk. Requires NumPy.
+    """
+    require_numpy(ctx, extra="truewind")
+    from calypso_anemometer.truewind import BoatMotion, MotionTrack, process_recording
+
+    fixed = boat_speed is not None or boat_course is not None or boat_heading is not None
+    if motion_file is not None and fixed:
+        raise click.UsageError("Use either fixed boat motion, or `--motion-file`", ctx=ctx)
+    if motion_file is not None:
+        motion = MotionTrack.from_file(motion_file)
+    elif boat_speed is not None and boat_course is not None:
+        motion = BoatMotion.fixed(speed=boat_speed, course=boat_course, heading=boat_heading)
+    else:
+        raise click.UsageError("Boat motion needs `--motion-file`, or both `--boat-speed` and `--boat-course`", ctx=ctx)
+    count = process_recording(infile, outfile, motion, batch_size=batch_size)
+    logger.info(f"Processed readings: {count}")
+
+
+@click.command()
+@click.argument("infile", type=click.File("r"), default="-")
+@click.option(
+    "--output",
+    "outfile",
+    type=click.File("w"),
+    required=False,
+    default="-",
+    help="Write filtered readings to this file, in JSON Lines format. Default: stdout",
+)
+@click.option(
+    "--field",
+    "fields",
+    type=str,
+    multiple=True,
+    required=False,
+    help="Filter this field. Can be used multiple times. Default: wind_speed and wind_direction",
+)
+@click.option(
+    "--window",
+    type=click.IntRange(min=3),
+    required=False,
+    default=7,
+    help="Replace spikes by the median of this number of recent readings. Default: 7",
+)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(min=0, min_open=True),
+    required=False,
+    default=3.0,
+    help="Values deviating from the median by more than this multiple of the scaled median absolute deviation "
+    "are spikes. Default: 3.0",
+)
+@click.pass_context
+def filter_outliers(
+    ctx,
+    infile: t.TextIO,
+    outfile: t.TextIO,
+    fields: t.Tuple[str, ...] = (),
+    window: int = 7,
+    threshold: float = 3.0,
+):
+    """
+    Replace spikes within readings recorded using `--record`, using a Hampel filter. Requires NumPy.
+    """
+    require_numpy(ctx, extra="outlier")
+    from calypso_anemometer.outlier import filter_recording
+
+    try:
+        outliers = filter_recording(infile, outfile, fields=list(fields), window=window, threshold=threshold)
+    except ValueError as ex:
+        raise click.UsageError(str(ex), ctx=ctx) from ex
+    logger.info(f"Replaced outliers: {outliers}")
+
+
+@click.command()
+@click.argument("infiles", type=click.File("r"), nargs=-1, required=True)
+@click.option(
+    "--output",
+    "outfile",
+    type=click.Path(dir_okay=False, writable=True),
+    required=False,
+    help="Write the merged percentiles to this file, for merging it again later.",
+)
+@click.pass_context
+def percentiles(ctx, infiles: t.Tuple[t.TextIO, ...], outfile: t.Optional[str] = None):
+    """
+    Merge wind speed percentiles from files written using `--sketch`, and from readings recorded using `--record`.
+    """
+    digest = TDigest()
+    for infile in infiles:
+        try:
+            digest.merge(read_digest(infile))
+        except ValueError as ex:
+            raise click.UsageError(f"{infile.name}: {ex}", ctx=ctx) from ex
+    if outfile is not None:
+        digest.save(outfile)
+    click.echo(to_json(digest.asdict()))
+
+
+def read_digest(infile: t.TextIO) -> TDigest:
+    """
+    Read percentiles written using `--sketch`, or compute them from readings recorded using `--record`.
+    """
+    content = infile.read()
+    try:
+        data = json.loads(content)
+    except ValueError:
+        data = None
+    if isinstance(data, dict) and "centroids" in data:
+        return TDigest.deserialize(data)
+    digest = TDigest()
+    for line in content.splitlines():
+        if line.strip():
+            try:
+                digest.update(float(json.loads(line)["wind_speed"]))
+            except (KeyError, TypeError, ValueError) as ex:
+                raise ValueError(f"Invalid reading: {line}") from ex
+    return digest
 
 
 cli.add_command(info, name="info")
@@ -227,3 +914,8 @@ cli.add_command(explore, name="explore")
 cli.add_command(set_option, name="set-option")
 cli.add_command(read, name="read")
 cli.add_command(fake, name="fake")
+cli.add_command(serve, name="serve")
+cli.add_command(bench, name="bench")
+cli.add_command(true_wind, name="true-wind")
+cli.add_command(filter_outliers, name="filter-outliers")
+cli.add_command(percentiles, name="percentiles")
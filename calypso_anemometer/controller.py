@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Adjust data rate and power mode of the device at runtime, in order to save battery.
+
+The controller observes the stream of readings, and decides about the most
+appropriate device configuration, based on wind variability, battery level,
+and time of day:
+
+- Low battery, or at night: Low power mode, 1 Hz.
+- Gusty conditions: 8 Hz.
+- Calm conditions: 1 Hz.
+- Otherwise: 4 Hz.
+
+All changes go through the regular `set_mode` and `set_datarate` operations of
+the workhorse, and are rate-limited in order not to oscillate.
+"""
+import asyncio
+import collections
+import dataclasses
+import logging
+import statistics
+import time
+import typing as t
+
+from calypso_anemometer.model import CalypsoDeviceDataRate, CalypsoDeviceMode, CalypsoReading
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class AdaptiveSettings:
+    """
+    Thresholds of the adaptive controller.
+
+    - `gust_threshold`: Standard deviation of wind speed in m/s, above which conditions are considered gusty.
+    - `calm_threshold`: Standard deviation of wind speed in m/s, below which conditions are considered calm.
+    - `calm_speed`: Mean wind speed in m/s, below which conditions are considered calm.
+    - `battery_low`: Battery level in percent, at or below which the device goes to low power mode.
+    - `night_start`, `night_end`: Hours of local time delimiting the night. `None` disables night mode.
+    - `window`: Seconds of readings to compute wind variability on.
+    - `min_samples`: Minimum number of readings within the window before making a decision.
+    - `hold`: Minimum number of seconds between two changes.
+    """
+
+    gust_threshold: float = 2.0
+    calm_threshold: float = 0.5
+    calm_speed: float = 1.0
+    battery_low: int = 30
+    night_start: t.Optional[int] = 21
+    night_end: t.Optional[int] = 6
+    window: float = 60.0
+    min_samples: int = 10
+    hold: float = 60.0
+
+    def is_night(self, hour: int) -> bool:
+        if self.night_start is None or self.night_end is None:
+            return False
+        if self.night_start <= self.night_end:
+            return self.night_start <= hour < self.night_end
+        return hour >= self.night_start or hour < self.night_end
+
+
+@dataclasses.dataclass
+class AdaptiveMetrics:
+    changes: int = 0
+    last_reason: t.Optional[str] = None
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+
+class AdaptiveController:
+    """
+    Adjust data rate and power mode of a workhorse instance, based on the stream of readings.
+
+    :param device: The workhorse instance, optionally wrapped into a `CalypsoDeviceSupervisor`.
+    :param callback: The function receiving readings.
+    :param settings: Thresholds of the controller.
+    :param clock: Function returning the current Unix time, used to determine the time of day.
+    """
+
+    def __init__(
+        self,
+        device,
+        callback: t.Callable,
+        settings: t.Optional[AdaptiveSettings] = None,
+        clock: t.Callable[[], float] = time.time,
+    ):
+        self.device = device
+        self.callback = callback
+        self.settings = settings or AdaptiveSettings()
+        self.clock = clock
+        self.metrics = AdaptiveMetrics()
+
+        self.samples: t.Deque[t.Tuple[float, float]] = collections.deque()
+        self.last_change_at: t.Optional[float] = None
+        self.apply_task: t.Optional[asyncio.Future] = None
+        self.mode_supported = True
+
+    @property
+    def mode(self) -> CalypsoDeviceMode:
+        return getattr(self.device, "mode", None) or CalypsoDeviceMode.NORMAL
+
+    @property
+    def datarate(self) -> t.Optional[CalypsoDeviceDataRate]:
+        return getattr(self.device, "datarate", None)
+
+    def on_reading(self, reading: CalypsoReading):
+        self.callback(reading)
+        self.update(reading)
+
+    def update(self, reading: CalypsoReading):
+        """
+        Account for a reading, and start applying a new configuration when needed.
+        """
+        now = reading.received_monotonic if reading.received_monotonic is not None else time.monotonic()
+        self.samples.append((now, reading.wind_speed))
+        while self.samples and now - self.samples[0][0] > self.settings.window:
+            self.samples.popleft()
+
+        if len(self.samples) < self.settings.min_samples:
+            return
+        if self.last_change_at is not None and now - self.last_change_at < self.settings.hold:
+            return
+        if self.apply_task is not None and not self.apply_task.done():
+            return
+
+        mode, rate, reason = self.decide(battery_level=reading.battery_level)
+        if not self.mode_supported:
+            mode = self.mode
+        if mode is self.mode and rate is self.datarate:
+            return
+        self.last_change_at = now
+        self.metrics.changes += 1
+        self.metrics.last_reason = reason
+        logger.info(f"Adjusting device to mode={mode.name}, rate={rate.name}. Reason: {reason}")
+        self.apply_task = asyncio.ensure_future(self.apply(mode, rate))
+
+    def decide(self, battery_level: t.Optional[int] = None) -> t.Tuple[CalypsoDeviceMode, CalypsoDeviceDataRate, str]:
+        """
+        Decide about the device configuration, based on the current conditions.
+        """
+        speeds = [speed for _, speed in self.samples]
+        mean = statistics.mean(speeds)
+        stdev = statistics.pstdev(speeds)
+        hour = time.localtime(self.clock()).tm_hour
+
+        if battery_level is not None and battery_level <= self.settings.battery_low:
+            return CalypsoDeviceMode.LOW_POWER, CalypsoDeviceDataRate.HZ_1, f"battery level {battery_level}%"
+        if self.settings.is_night(hour):
+            return CalypsoDeviceMode.LOW_POWER, CalypsoDeviceDataRate.HZ_1, f"night, hour {hour}"
+        if stdev >= self.settings.gust_threshold:
+            return CalypsoDeviceMode.NORMAL, CalypsoDeviceDataRate.HZ_8, f"gusty, stdev {stdev:.2f} m/s"
+        if stdev <= self.settings.calm_threshold and mean <= self.settings.calm_speed:
+            return CalypsoDeviceMode.NORMAL, CalypsoDeviceDataRate.HZ_1, f"calm, mean {mean:.2f} m/s"
+        return CalypsoDeviceMode.NORMAL, CalypsoDeviceDataRate.HZ_4, f"moderate, stdev {stdev:.2f} m/s"
+
+    async def apply(self, mode: CalypsoDeviceMode, rate: CalypsoDeviceDataRate):
+        # Some firmware versions reject writing the mode, so adjust the data rate independently.
+        if mode is not self.mode and self.mode_supported:
+            try:
+                await self.device.set_mode(mode)
+            except Exception as ex:
+                self.mode_supported = False
+                logger.warning(f"Setting device mode failed, continuing with data rate only: {ex}")
+        if rate is not self.datarate:
+            try:
+                await self.device.set_datarate(rate)
+            except Exception:
+                logger.exception("Setting data rate failed")
+
+    def stop(self):
+        if self.apply_task is not None:
+            self.apply_task.cancel()
@@ -14,10 +14,12 @@ References
 import asyncio
 import concurrent
 import logging
-from typing import Callable, Optional
+import time
+from typing import AsyncIterator, Callable, Optional
 
 from bleak import BleakClient, BleakError, BleakScanner
 
+from calypso_anemometer.buffer import ReadingQueue
 from calypso_anemometer.exception import (
     BluetoothAdapterError,
     BluetoothConversationError,
@@ -26,6 +28,7 @@ from calypso_anemometer.exception import (
     CalypsoDecodingError,
 )
 from calypso_anemometer.model import (
+    DEVICE_NAME,
     BleCharSpec,
     CalypsoDeviceCompassStatus,
     CalypsoDeviceDataRate,
@@ -36,15 +39,18 @@ from calypso_anemometer.model import (
     CalypsoDeviceStatus,
     CalypsoDeviceStatusCharacteristic,
     CalypsoReading,
+    QueueOverflowPolicy,
     Settings,
 )
+from calypso_anemometer.servicemap import GattCharacteristic, GattDescriptor, GattServiceMap
+from calypso_anemometer.stats import ArrivalStatistics
 from calypso_anemometer.util import to_json
 
 logger = logging.getLogger(__name__)
 
 
 class CalypsoDeviceApi:
-    NAME = "calypso-up10"
+    NAME = DEVICE_NAME
     DESCRIPTION = "Calypso UP10 anemometer"
     BLUETOOTH_DEVICE_NAME = "ULTRASONIC"
 
@@ -62,13 +68,39 @@ class CalypsoDeviceApi:
         CalypsoDeviceStatusCharacteristic.compass,
     ]
 
-    def __init__(self, settings: Optional[Settings] = None, ble_address: Optional[str] = None):
+    def __init__(
+        self,
+        settings: Optional[Settings] = None,
+        ble_address: Optional[str] = None,
+        client_factory: Optional[Callable] = None,
+    ):
+        """
+        :param client_factory: Use a different implementation than `BleakClient`, for example the emulated device.
+        """
         if settings is None:
             settings = Settings(ble_address=ble_address)
         self.settings = settings
         self.ble_address = settings.ble_address
+        self.client_factory = client_factory
         self.client: BleakClient
 
+        # Remember device settings, in order to be able to restore them after reconnecting.
+        self.mode: Optional[CalypsoDeviceMode] = None
+        self.datarate: Optional[CalypsoDeviceDataRate] = None
+        self.compass: Optional[CalypsoDeviceCompassStatus] = None
+
+        # Inter-arrival statistics of subscribed readings. The device defaults to 4 Hz.
+        self.arrival_statistics = ArrivalStatistics(expected_interval=CalypsoDeviceDataRate.HZ_4.interval)
+        self.decoding_errors = 0
+        # Optionally trace decoding latency, see `calypso_anemometer.tracing.Tracer`.
+        self.tracer = None
+
+        # Optionally get notified when the BLE link drops.
+        self.disconnected_callback: Optional[Callable] = None
+
+        # The queue handed to `subscribe_reading`, whose consumer task is stopped when leaving the context.
+        self.queue: Optional[ReadingQueue] = None
+
         logger.info(f"Initializing client with {self.settings}")
 
     async def __aenter__(self):
@@ -81,6 +113,7 @@ class CalypsoDeviceApi:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.disconnect()
+        await self.stop_queue()
         if exc_val is not None:  # pragma: no cover
             raise exc_val
 
@@ -116,8 +149,12 @@ class CalypsoDeviceApi:
             return False
 
     async def connect(self):
-        self.client = BleakClient(
-            self.ble_address, timeout=self.settings.ble_connect_timeout, adapter=self.settings.ble_adapter
+        kwargs = {}
+        if self.disconnected_callback is not None:
+            kwargs["disconnected_callback"] = self.disconnected_callback
+        client_factory = self.client_factory or BleakClient
+        self.client = client_factory(
+            self.ble_address, timeout=self.settings.ble_connect_timeout, adapter=self.settings.ble_adapter, **kwargs
         )
         logger.info(f"Connecting to device at '{self.ble_address}' with adapter '{get_adapter_name(self.client)}'")
         try:
@@ -145,33 +182,45 @@ class CalypsoDeviceApi:
         """
         Explore all services and characteristics. Useful for debugging purposes.
 
+        Bleak resolves the GATT services when connecting. Characteristic and
+        descriptor values are read concurrently, by handle.
+
         Possible errors:
 
         - bleak.exc.BleakDBusError: [org.bluez.Error.Failed] Software caused connection abort
         - bleak.exc.BleakError: Device with address F8:C7:2C:EC:13:D0 was not found.
         - futures.TimeoutError:
         """
-        services = await self.client.get_services()
-        for service in services:
+        service_map = GattServiceMap.from_bleak(self.client.services)
+
+        async def read_char(char: GattCharacteristic):
+            if "read" not in char.properties:
+                return None
+            try:
+                return bytes(await self.client.read_gatt_char(char.handle))
+            except Exception:
+                logger.exception(f"  Reading characteristic failed: {char}")
+
+        async def read_descriptor(descriptor: GattDescriptor):
+            try:
+                return bytes(await self.client.read_gatt_descriptor(descriptor.handle))
+            except Exception:
+                logger.exception(f"    Reading descriptor failed: {descriptor}")
+
+        chars = [char for service in service_map.services for char in service.characteristics]
+        descriptors = [descriptor for char in chars for descriptor in char.descriptors]
+        char_values = iter(await asyncio.gather(*map(read_char, chars)))
+        descriptor_values = iter(await asyncio.gather(*map(read_descriptor, descriptors)))
+
+        # Report in the same order as the values have been requested.
+        for service in service_map.services:
             logger.info(f"Found service: {service}")
             for char in service.characteristics:
                 logger.info(f"  Found characteristic: {char}. properties={','.join(char.properties)}")
-                value = None
-                if "read" in char.properties:
-                    try:
-                        value = bytes(await self.client.read_gatt_char(char.uuid))
-                    except Exception:
-                        logger.exception(f"  Reading characteristic failed: {char}")
-                logger.info(f"  Value: {value}")
-
+                logger.info(f"  Value: {next(char_values)}")
                 for descriptor in char.descriptors:
                     logger.info(f"    Found descriptor: {descriptor}")
-                    value = None
-                    try:
-                        value = bytes(await self.client.read_gatt_descriptor(descriptor.handle))
-                    except Exception:
-                        logger.exception(f"    Reading descriptor failed: {descriptor}")
-                    logger.info(f"    Value: {value}")
+                    logger.info(f"    Value: {next(descriptor_values)}")
 
     async def about(self):
         response = {
@@ -206,12 +255,15 @@ class CalypsoDeviceApi:
         await self.client.write_gatt_char(
             CalypsoDeviceStatusCharacteristic.mode.value.uuid, data=bytes([mode.value]), response=True
         )
+        self.mode = mode
 
     async def set_datarate(self, rate: CalypsoDeviceDataRate):
         logger.info(f"Setting data rate to {rate}")
         await self.client.write_gatt_char(
             CalypsoDeviceStatusCharacteristic.rate.value.uuid, data=bytes([rate.value]), response=True
         )
+        self.datarate = rate
+        self.arrival_statistics.expected_interval = rate.interval
 
     async def set_compass(self, compass: CalypsoDeviceCompassStatus):
         if compass is None:
@@ -220,21 +272,43 @@ class CalypsoDeviceApi:
         await self.client.write_gatt_char(
             CalypsoDeviceStatusCharacteristic.compass.value.uuid, data=bytes([compass.value]), response=True
         )
+        self.compass = compass
 
     async def get_reading(self):
         logger.info("Requesting reading")
         data: bytearray = await self.client.read_gatt_char(CalypsoDeviceReadingCharacteristic.data.value.uuid)
-        reading = self.decode_reading(data)
+        reading = self.decode_reading(data).stamp(device=self.ble_address)
         self.on_reading(reading)
         return reading
 
-    async def subscribe_reading(self, callback: Optional[Callable] = None):
+    async def subscribe_reading(self, callback: Optional[Callable] = None, queue: Optional[ReadingQueue] = None):
+        """
+        Subscribe to readings using BLE notifications.
+
+        When `queue` is given, readings are handed over to its consumer task, which will invoke the
+        callback. Otherwise, the callback will be invoked inline within the BLE notification handler.
+        When `queue` is given without `callback`, the queue needs to be consumed elsewhere.
+        """
         logger.info("Subscribing to readings")
-        callback = callback or self.on_reading
 
-        async def handler(sender: int, data: bytearray):
-            reading = self.decode_reading(data, sender=sender)
-            callback(reading)
+        # Bleak schedules coroutine handlers as independent tasks, so the notification handler
+        # can not wait for a free slot in the queue. Instead, it hands over without blocking.
+        if queue is not None:
+            if queue.policy is QueueOverflowPolicy.BLOCK:
+                raise ValueError(
+                    f"Queue overflow policy '{queue.policy.value}' is not supported with BLE notifications"
+                )
+            queue.start(callback)
+            self.queue = queue
+
+            def handler(sender: int, data: bytearray):
+                queue.put_nowait(self.receive_reading(data, sender=sender))
+
+        else:
+            callback = callback or self.on_reading
+
+            async def handler(sender: int, data: bytearray):
+                callback(self.receive_reading(data, sender=sender))
 
         await self.client.start_notify(CalypsoDeviceReadingCharacteristic.data.value.uuid, handler)
 
@@ -242,6 +316,68 @@ class CalypsoDeviceApi:
         logger.info("Unsubscribing from readings")
         await self.client.stop_notify(CalypsoDeviceReadingCharacteristic.data.value.uuid)
 
+    async def stop_queue(self):
+        """
+        Stop the consumer task of the reading queue, so it does not outlive the event loop.
+
+        The engine drains the queue before, see `calypso_anemometer.shutdown.drain`.
+        """
+        if self.queue is not None:
+            await self.queue.stop()
+            self.queue = None
+
+    async def stream(
+        self,
+        batch_size: Optional[int] = None,
+        max_latency: Optional[float] = None,
+        queue: Optional[ReadingQueue] = None,
+    ) -> AsyncIterator:
+        """
+        Subscribe to readings, and yield them one by one, or as lists of readings.
+
+            async for reading in calypso.stream():
+                ...
+
+            async for readings in calypso.stream(batch_size=32, max_latency=1.0):
+                ...
+
+        When breaking out of the loop early, invoke `aclose()` on the iterator to unsubscribe immediately.
+
+        :param batch_size: Yield lists of up to `batch_size` readings.
+        :param max_latency: Yield incomplete batches when their first reading is older than this number of seconds.
+        :param queue: The queue buffering readings until they are consumed. By default, it holds 128 readings,
+                      and drops the oldest ones when the consumer can not keep up with the device.
+                      The `BLOCK` overflow policy is not supported, because the device can not be paused.
+        """
+        if queue is None:
+            queue = ReadingQueue(maxsize=max(128, 2 * (batch_size or 0)), policy=QueueOverflowPolicy.DROP_OLDEST)
+        iterator = queue.iterate(batch_size=batch_size, max_latency=max_latency)
+        await self.subscribe_reading(queue=queue)
+        try:
+            async for item in iterator:
+                yield item
+        finally:
+            await iterator.aclose()
+            await self.unsubscribe_reading()
+
+    def receive_reading(self, data: bytearray, sender: Optional[int] = None) -> CalypsoReading:
+        """
+        Decode reading from BLE notification, and account for its receive time.
+        """
+        received_monotonic = time.monotonic()
+        received_time = time.time()
+        try:
+            reading = self.decode_reading(data, sender=sender).stamp(
+                received_monotonic, received_time, device=self.ble_address
+            )
+        except CalypsoDecodingError:
+            self.decoding_errors += 1
+            raise
+        if self.tracer is not None:
+            self.tracer.record("decode", time.monotonic() - received_monotonic)
+        self.arrival_statistics.update(received_monotonic)
+        return reading
+
     @staticmethod
     def decode_reading(data: bytearray, sender: Optional[int] = None):
         logger.debug(f"Received buffer:  {data}")
@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Serve multiple devices and pipelines within one long-lived process, declared in a TOML file.
+
+Each device is connected and subscribed once, and feeds its own instance of one of the named
+pipelines, so stateful stages never mix readings of different devices. A pipeline consists of
+filter, outlier, aggregation, and true wind stages, and fans out to a number of sinks, i.e.
+STDOUT, a recording file, and any number of telemetry targets::
+
+    [[devices]]
+    name = "masthead"
+    ble_address = "F8:C7:2C:EC:13:D0"
+    rate = "HZ_4"
+    reconnect = true
+    pipeline = "default"
+
+    [pipelines.default]
+    targets = ["udp+signalk+delta://openplotter.local:4123"]
+
+    [[pipelines.default.stages]]
+    type = "aggregate"
+    window = 4
+
+When receiving SIGHUP, the configuration file is read again. Changes to pipelines,
+and to the data rate and compass status of devices, are applied without dropping the
+BLE connection. All other changes to devices need a restart, and are only reported.
+
+Synopsis::
+
+    daemon = Daemon(config=DaemonConfig.from_file("calypso.toml"), path="calypso.toml")
+    await daemon.run()
+"""
+import asyncio
+import dataclasses
+import logging
+import signal
+import typing as t
+
+from calypso_anemometer.engine import DRAIN_TIMEOUT, handler_factory, make_workhorse
+from calypso_anemometer.exception import CalypsoConfigurationError
+from calypso_anemometer.model import (
+    CalypsoDeviceCompassStatus,
+    CalypsoDeviceDataRate,
+    CalypsoReading,
+    QueueOverflowPolicy,
+    Settings,
+)
+from calypso_anemometer.pipeline import (
+    AggregateStage,
+    FanOutStage,
+    FilterStage,
+    Pipeline,
+    PipelineStage,
+    RecordingSink,
+    ReloadableStage,
+    StdoutSink,
+    TelemetrySink,
+)
+from calypso_anemometer.shutdown import ShutdownSignal
+
+logger = logging.getLogger(__name__)
+
+DEVICE_DRIVERS = ["ble", "emulated", "fake"]
+
+
+def load_toml(path: str) -> t.Dict[str, t.Any]:
+    """
+    Read a TOML file, using `tomllib` on Python 3.11 and newer, and `tomli` otherwise.
+    """
+    try:
+        import tomllib
+    except ImportError:  # pragma: no cover
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise CalypsoConfigurationError(
+                "Reading configuration files needs `tomli` on Python < 3.11. "
+                "Install it using `pip install calypso-anemometer[daemon]`."
+            ) from None
+    try:
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError) as ex:
+        raise CalypsoConfigurationError(f"Unable to read configuration file {path}: {ex}") from ex
+
+
+def from_dict(cls, data: t.Dict[str, t.Any], context: str, enums: t.Optional[t.Dict[str, t.Type]] = None):
+    """
+    Create a configuration data class from a dictionary, rejecting unknown keys, and converting enum names.
+    """
+    fields = [field.name for field in dataclasses.fields(cls)]
+    unknown = sorted(set(data) - set(fields))
+    if unknown:
+        raise CalypsoConfigurationError(f"Unknown settings for {context}: {', '.join(unknown)}")
+    data = dict(data)
+    for key, enum_type in (enums or {}).items():
+        if data.get(key) is None:
+            continue
+        try:
+            data[key] = enum_type[str(data[key]).upper().replace("-", "_")]
+        except KeyError:
+            choices = ", ".join(element.name for element in enum_type)
+            raise CalypsoConfigurationError(
+                f"Invalid value for {context}: {key}={data[key]!r}. Use one of {choices}"
+            ) from None
+    try:
+        return cls(**data)
+    except TypeError as ex:
+        raise CalypsoConfigurationError(f"Invalid settings for {context}: {ex}") from ex
+
+
+@dataclasses.dataclass
+class DeviceConfig:
+    """
+    A device, how to connect to it, and which pipeline it feeds.
+
+    `driver` is one of `ble`, `emulated`, or `fake`. All other settings correspond to the
+    options of the `read` subcommand.
+    """
+
+    name: str
+    driver: str = "ble"
+    ble_adapter: t.Optional[str] = "hci0"
+    ble_address: t.Optional[str] = None
+    ble_discovery_timeout: float = 10.0
+    ble_connect_timeout: float = 10.0
+    rate: t.Optional[CalypsoDeviceDataRate] = None
+    compass: t.Optional[CalypsoDeviceCompassStatus] = None
+    reconnect: bool = False
+    adaptive: bool = False
+    queue_size: int = 128
+    queue_overflow: QueueOverflowPolicy = QueueOverflowPolicy.DROP_OLDEST
+    watchdog_tolerance: t.Optional[float] = None
+    watchdog_hard_timeout: t.Optional[float] = None
+    metrics_address: t.Optional[str] = None
+    trace: bool = False
+    drain_timeout: float = DRAIN_TIMEOUT
+    sketch: t.Optional[str] = None
+    pipeline: str = "default"
+
+    # Settings which can be changed while connected.
+    LIVE_SETTINGS: t.ClassVar[t.List[str]] = ["rate", "compass"]
+
+    ENUMS: t.ClassVar[t.Dict[str, t.Type]] = {
+        "rate": CalypsoDeviceDataRate,
+        "compass": CalypsoDeviceCompassStatus,
+        "queue_overflow": QueueOverflowPolicy,
+    }
+
+    @classmethod
+    def from_dict(cls, data: t.Dict[str, t.Any], index: int) -> "DeviceConfig":
+        if "name" not in data:
+            raise CalypsoConfigurationError(f"Device #{index + 1} needs a name")
+        device = from_dict(cls, data, context=f"device '{data['name']}'", enums=cls.ENUMS)
+        device.validate()
+        return device
+
+    def validate(self):
+        context = f"device '{self.name}'"
+        if self.driver not in DEVICE_DRIVERS:
+            raise CalypsoConfigurationError(
+                f"Invalid driver for {context}: {self.driver}. Use one of {', '.join(DEVICE_DRIVERS)}"
+            )
+        if self.watchdog_hard_timeout is not None and self.watchdog_tolerance is None:
+            raise CalypsoConfigurationError(
+                f"Setting `watchdog_hard_timeout` requires `watchdog_tolerance` for {context}"
+            )
+        if self.queue_size and self.queue_overflow is QueueOverflowPolicy.BLOCK and self.driver != "fake":
+            raise CalypsoConfigurationError(
+                f"Setting `queue_overflow=BLOCK` is only supported by the fake driver, see {context}"
+            )
+        if self.reconnect and self.driver == "fake":
+            raise CalypsoConfigurationError(f"Setting `reconnect` is not supported by the fake driver, see {context}")
+
+    @property
+    def settings(self) -> Settings:
+        return Settings(
+            ble_adapter=self.ble_adapter,
+            ble_address=self.ble_address,
+            ble_discovery_timeout=self.ble_discovery_timeout,
+            ble_connect_timeout=self.ble_connect_timeout,
+        )
+
+    def restart_settings(self, other: "DeviceConfig") -> t.List[str]:
+        """
+        Names of changed settings which can only be applied by reconnecting.
+        """
+        return [
+            field.name
+            for field in dataclasses.fields(self)
+            if field.name not in self.LIVE_SETTINGS and getattr(self, field.name) != getattr(other, field.name)
+        ]
+
+
+@dataclasses.dataclass
+class PipelineConfig:
+    """
+    Processing stages, in order, and the sinks readings are finally fanned out to.
+
+    Each stage is a table with a `type` key. Available stages are:
+
+    - `filter`: Only pass readings where `field` is within `min` and `max`, both inclusive and optional.
+    - `aggregate`: Aggregate each `window` readings into one.
+    """
+
+    stdout: bool = False
+    record: t.Optional[str] = None
+    targets: t.List[str] = dataclasses.field(default_factory=list)
+    stages: t.List[t.Dict[str, t.Any]] = dataclasses.field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data: t.Dict[str, t.Any], name: str) -> "PipelineConfig":
+        pipeline = from_dict(cls, data, context=f"pipeline '{name}'")
+        # Build stages once, in order to report errors early. Sinks are not built, so no sockets are opened.
+        for spec in pipeline.stages:
+            make_stage(spec, context=f"pipeline '{name}'")
+        return pipeline
+
+    def build(self, quiet: bool = False, device: str = "default") -> Pipeline:
+        """
+        Build an instance of the pipeline for the given device. `{device}` within `record` is replaced by its name.
+        """
+        from calypso_anemometer.telemetry.adapter import TelemetryAdapter
+
+        sinks: t.List[PipelineStage] = []
+        if self.stdout and not quiet:
+            sinks.append(StdoutSink())
+        if self.record is not None:
+            sinks.append(RecordingSink(self.record.replace("{device}", device)))
+        for target in self.targets:
+            sinks.append(TelemetrySink(TelemetryAdapter(uri=target)))
+        return Pipeline([*(make_stage(spec) for spec in self.stages), FanOutStage(sinks)])
+
+
+def make_stage(spec: t.Dict[str, t.Any], context: str = "pipeline") -> PipelineStage:
+    """
+    Create a pipeline stage from its declaration within the configuration file.
+    """
+    spec = dict(spec)
+    kind = spec.pop("type", None)
+    try:
+        if kind == "filter":
+            return make_filter_stage(**spec)
+        if kind == "aggregate":
+            return AggregateStage(**spec)
+        if kind == "hampel":
+            from calypso_anemometer.outlier import HampelStage
+
+            return HampelStage(**spec)
+        if kind == "true_wind":
+            from calypso_anemometer.truewind import make_true_wind_stage
+
+            return make_true_wind_stage(**spec)
+    except (ImportError, TypeError, ValueError) as ex:
+        raise CalypsoConfigurationError(f"Invalid stage '{kind}' in {context}: {ex}") from ex
+    raise CalypsoConfigurationError(
+        f"Unknown stage type in {context}: {kind}. Use one of filter, hampel, aggregate, true_wind"
+    )
+
+
+def make_filter_stage(
+    field: str,
+    min: t.Optional[float] = None,  # noqa: A002
+    max: t.Optional[float] = None,  # noqa: A002
+    name: t.Optional[str] = None,
+) -> FilterStage:
+    """
+    Only pass readings where the value of `field` is within `min` and `max`.
+    """
+    # Only the measurement fields, excluding receive timestamps and derived wind.
+    if field not in [item.name for item in dataclasses.fields(CalypsoReading) if item.compare]:
+        raise ValueError(f"Unknown field: {field}")
+
+    def predicate(reading: CalypsoReading) -> bool:
+        value = getattr(reading, field)
+        return (min is None or value >= min) and (max is None or value <= max)
+
+    return FilterStage(predicate, name=name or f"filter-{field}")
+
+
+@dataclasses.dataclass
+class DaemonConfig:
+    """
+    Devices and pipelines of a long-lived process.
+    """
+
+    devices: t.List[DeviceConfig]
+    pipelines: t.Dict[str, PipelineConfig]
+
+    @classmethod
+    def from_file(cls, path: str) -> "DaemonConfig":
+        return cls.from_dict(load_toml(path))
+
+    @classmethod
+    def from_dict(cls, data: t.Dict[str, t.Any]) -> "DaemonConfig":
+        unknown = sorted(set(data) - {"devices", "pipelines"})
+        if unknown:
+            raise CalypsoConfigurationError(f"Unknown sections: {', '.join(unknown)}")
+        devices = [DeviceConfig.from_dict(item, index) for index, item in enumerate(data.get("devices", []))]
+        pipelines = {name: PipelineConfig.from_dict(item, name) for name, item in data.get("pipelines", {}).items()}
+        if not devices:
+            raise CalypsoConfigurationError("No devices configured")
+        names = [device.name for device in devices]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise CalypsoConfigurationError(f"Duplicate device names: {', '.join(duplicates)}")
+        for device in devices:
+            if device.pipeline not in pipelines:
+                raise CalypsoConfigurationError(f"Unknown pipeline for device '{device.name}': {device.pipeline}")
+        # Each device records using its own sink, so they must not write to the same file.
+        for name, pipeline in pipelines.items():
+            users = [device.name for device in devices if device.pipeline == name]
+            if len(users) > 1 and pipeline.record is not None and "{device}" not in pipeline.record:
+                raise CalypsoConfigurationError(
+                    f"Pipeline '{name}' is used by multiple devices, "
+                    f"so its `record` setting needs a `{{device}}` placeholder: {pipeline.record}"
+                )
+        return cls(devices=devices, pipelines=pipelines)
+
+    def device(self, name: str) -> t.Optional[DeviceConfig]:
+        for device in self.devices:
+            if device.name == name:
+                return device
+        return None
+
+
+class Daemon:
+    """
+    Connect to all configured devices, feed their readings into the pipelines, and reload on SIGHUP.
+
+    :param config: The configuration.
+    :param path: The configuration file, read again when reloading.
+    :param stages: Additional pipeline stages, running before the configured pipeline of each device.
+    :param quiet: Do not print readings to stdout, even when configured.
+    """
+
+    def __init__(
+        self,
+        config: DaemonConfig,
+        path: t.Optional[str] = None,
+        stages: t.Optional[t.List[PipelineStage]] = None,
+        quiet: bool = False,
+    ):
+        self.config = config
+        self.path = path
+        self.stages = stages or []
+        self.quiet = quiet
+        # One pipeline instance per device name.
+        self.pipelines: t.Dict[str, ReloadableStage] = {}
+        self.connected: t.Dict[str, t.Any] = {}
+        self.reloading: t.Optional[asyncio.Future] = None
+        # All devices shut down on the same signal.
+        self.shutdown = ShutdownSignal()
+
+    async def run(self):
+        """
+        Serve all devices until one of them fails, until receiving SIGTERM or SIGINT, or until cancelled.
+        """
+        # Each device gets its own pipeline instance. Unused pipelines are not built, not to open sockets in vain.
+        for device in self.config.devices:
+            pipeline = self.config.pipelines[device.pipeline].build(quiet=self.quiet, device=device.name)
+            self.pipelines[device.name] = ReloadableStage(pipeline, name=device.pipeline)
+
+        loop = asyncio.get_event_loop()
+        sighup = getattr(signal, "SIGHUP", None)
+        if self.path is not None and sighup is not None:
+            loop.add_signal_handler(sighup, self.on_reload_signal)
+            logger.info(f"Send signal SIGHUP to reload configuration from {self.path}")
+
+        logger.info(f"Serving {len(self.config.devices)} devices")
+        tasks = [asyncio.ensure_future(self.serve(device)) for device in self.config.devices]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            if self.path is not None and sighup is not None:
+                loop.remove_signal_handler(sighup)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.reloading is not None:
+                await asyncio.gather(self.reloading, return_exceptions=True)
+
+    async def serve(self, device: DeviceConfig):
+        handler = await handler_factory(
+            subscribe=True,
+            rate=device.rate,
+            compass=device.compass,
+            quiet=True,
+            watchdog_tolerance=device.watchdog_tolerance,
+            watchdog_hard_timeout=device.watchdog_hard_timeout,
+            queue_size=device.queue_size,
+            queue_overflow=device.queue_overflow,
+            adaptive=device.adaptive,
+            stages=[*self.stages, self.pipelines[device.name]],
+            metrics_address=device.metrics_address,
+            trace=device.trace,
+            drain_timeout=device.drain_timeout,
+            shutdown=self.shutdown,
+            sketch=device.sketch,
+        )
+        settings = device.settings
+        if device.driver == "fake":
+            from calypso_anemometer.fake import CalypsoDeviceApiFake
+
+            workhorse = CalypsoDeviceApiFake
+        else:
+            workhorse = make_workhorse(
+                settings=settings, emulate=device.driver == "emulated", reconnect=device.reconnect
+            )
+        logger.info(f"Connecting to device '{device.name}'")
+        async with workhorse(settings=settings) as calypso:
+            self.connected[device.name] = calypso
+            try:
+                await handler(calypso)
+            finally:
+                del self.connected[device.name]
+
+    def on_reload_signal(self):
+        if self.reloading is not None and not self.reloading.done():
+            logger.warning("Already reloading configuration")
+            return
+        self.reloading = asyncio.ensure_future(self.reload())
+
+    async def reload(self) -> bool:
+        """
+        Read the configuration file again, and apply all changes which do not need to reconnect.
+        """
+        logger.info(f"Reloading configuration from {self.path}")
+        try:
+            config = DaemonConfig.from_file(self.path)
+        except CalypsoConfigurationError as ex:
+            logger.error(f"Keeping current configuration: {ex}")
+            return False
+
+        for name in sorted(
+            {device.name for device in config.devices} - {device.name for device in self.config.devices}
+        ):
+            logger.warning(f"Adding device '{name}' requires a restart")
+
+        devices = []
+        for current in self.config.devices:
+            update = config.device(current.name)
+            if update is None:
+                logger.warning(f"Removing device '{current.name}' requires a restart")
+                devices.append(current)
+                continue
+            changed = current.restart_settings(update)
+            if changed:
+                logger.warning(f"Changing {', '.join(changed)} of device '{current.name}' requires a restart")
+            live = {name: getattr(update, name) for name in DeviceConfig.LIVE_SETTINGS}
+            try:
+                await self.apply_live_settings(current, **live)
+            except Exception as ex:
+                logger.error(f"Keeping current settings of device '{current.name}': {ex}")
+                devices.append(current)
+                continue
+            devices.append(dataclasses.replace(current, **live))
+
+        pipelines = dict(self.config.pipelines)
+        for name, current in self.config.pipelines.items():
+            update = config.pipelines.get(name)
+            if update is None or update == current:
+                continue
+            # Build all instances first, so the pipeline is either replaced for all of its devices, or for none.
+            try:
+                instances = {
+                    device.name: update.build(quiet=self.quiet, device=device.name)
+                    for device in devices
+                    if device.pipeline == name and device.name in self.pipelines
+                }
+            except (KeyError, ValueError, OSError) as ex:
+                logger.error(f"Keeping current pipeline '{name}': {ex}")
+                continue
+            for device_name, pipeline in instances.items():
+                previous = self.pipelines[device_name].replace(pipeline)
+                await previous.close()
+            pipelines[name] = update
+            logger.info(f"Reloaded pipeline '{name}'")
+
+        self.config = DaemonConfig(devices=devices, pipelines=pipelines)
+        return True
+
+    async def apply_live_settings(
+        self,
+        device: DeviceConfig,
+        rate: t.Optional[CalypsoDeviceDataRate] = None,
+        compass: t.Optional[CalypsoDeviceCompassStatus] = None,
+    ):
+        calypso = self.connected.get(device.name)
+        if calypso is None:
+            return
+        if rate is not None and rate != device.rate:
+            logger.info(f"Setting data rate of device '{device.name}' to {rate.name}")
+            await calypso.set_datarate(rate)
+        if compass is not None and compass != device.compass:
+            logger.info(f"Setting compass status of device '{device.name}' to {compass.name}")
+            await calypso.set_compass(compass)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Emulate the Calypso UP10 as an in-process BLE peripheral.
+
+`EmulatedBleakClient` implements the subset of `BleakClient` used by
+`CalypsoDeviceApi`, so the real driver, including reconnecting, queueing,
+and the watchdog, can be exercised end to end without Bluetooth hardware.
+Imperfections of real links can be configured: connect latency,
+notification jitter, dropped notifications, and forced disconnects.
+
+Synopsis::
+
+    peripheral = EmulatedPeripheral(EmulatorSettings(drop_rate=0.01))
+    async with CalypsoDeviceApi(ble_address=peripheral.ADDRESS, client_factory=peripheral.client) as calypso:
+        ...
+"""
+import asyncio
+import dataclasses
+import logging
+import random
+import typing as t
+from copy import deepcopy
+
+from bleak import BleakError
+
+from calypso_anemometer.fake import MINIMUM_VALUES, CalypsoDeviceApiFake
+from calypso_anemometer.model import (
+    CalypsoDeviceCompassStatus,
+    CalypsoDeviceDataRate,
+    CalypsoDeviceInfoCharacteristic,
+    CalypsoDeviceMode,
+    CalypsoDeviceReadingCharacteristic,
+    CalypsoDeviceStatusCharacteristic,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class EmulatorSettings:
+    """
+    Imperfections of the emulated BLE link.
+
+    - `connect_latency`: Seconds it takes to connect.
+    - `notify_jitter`: Random deviation of notification intervals, as a fraction of the interval.
+    - `drop_rate`: Probability of dropping a notification.
+    - `disconnect_interval`: Force a disconnect after being connected for this number of seconds.
+    - `seed`: Seed for the random number generator, for reproducible runs.
+    """
+
+    connect_latency: float = 0.0
+    notify_jitter: float = 0.0
+    drop_rate: float = 0.0
+    disconnect_interval: t.Optional[float] = None
+    seed: t.Optional[int] = None
+
+
+@dataclasses.dataclass
+class EmulatorMetrics:
+    connects: int = 0
+    disconnects: int = 0
+    notifications: int = 0
+    dropped: int = 0
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+
+class EmulatedPeripheral:
+    """
+    The emulated device. Like real hardware, its state survives reconnects.
+
+    :param settings: Imperfections of the emulated BLE link.
+    :param model: Generate realistic readings using a `calypso_anemometer.wind.WindModel`.
+                  By default, all values are incremented by one, like the fake device does.
+    """
+
+    ADDRESS = "00:00:00:00:CA:1F"
+
+    INFO = {
+        CalypsoDeviceInfoCharacteristic.manufacturer_name: "Calypso Instruments",
+        CalypsoDeviceInfoCharacteristic.model_number: "ULTRASONIC Portable",
+        CalypsoDeviceInfoCharacteristic.serial_number: "EMULATED",
+        CalypsoDeviceInfoCharacteristic.hardware_revision: "1.0",
+        CalypsoDeviceInfoCharacteristic.firmware_revision: "1.0",
+        CalypsoDeviceInfoCharacteristic.software_revision: "1.0",
+    }
+
+    def __init__(self, settings: t.Optional[EmulatorSettings] = None, model=None):
+        self.settings = settings or EmulatorSettings()
+        self.random = random.Random(self.settings.seed)  # noqa: S311
+        self.metrics = EmulatorMetrics()
+        self.available = True
+        self.clients: t.List["EmulatedBleakClient"] = []
+
+        # Reuse the fake device for keeping the device status, and for producing readings.
+        self.source = CalypsoDeviceApiFake(ble_address=self.ADDRESS, model=model)
+        self.source.reading = deepcopy(MINIMUM_VALUES)
+
+    def client(
+        self,
+        address: str,
+        timeout: float = 10.0,
+        adapter: t.Optional[str] = None,
+        disconnected_callback: t.Optional[t.Callable] = None,
+        **kwargs,
+    ) -> "EmulatedBleakClient":
+        """
+        Create a client, with the same signature as `BleakClient`.
+        """
+        return EmulatedBleakClient(self, address, adapter=adapter, disconnected_callback=disconnected_callback)
+
+    @property
+    def interval(self) -> t.Optional[float]:
+        """
+        The interval between two notifications, in seconds. `None` when sleeping.
+        """
+        if self.source.mode is CalypsoDeviceMode.SLEEP:
+            return None
+        if self.source.mode is CalypsoDeviceMode.LOW_POWER:
+            return CalypsoDeviceDataRate.HZ_1.interval
+        return self.source.datarate.interval
+
+    def produce_reading(self) -> bytes:
+        return self.source.produce_fake_readings(1)[0].to_buffer()
+
+    def read(self, uuid: str) -> bytes:
+        for charspec_item, value in self.INFO.items():
+            if charspec_item.value.uuid == uuid:
+                return value.encode()
+        if uuid == CalypsoDeviceStatusCharacteristic.mode.value.uuid:
+            return bytes([self.source.mode.value])
+        if uuid == CalypsoDeviceStatusCharacteristic.rate.value.uuid:
+            return bytes([self.source.datarate.value])
+        if uuid == CalypsoDeviceStatusCharacteristic.compass.value.uuid:
+            return bytes([self.source.compass.value])
+        if uuid == CalypsoDeviceReadingCharacteristic.data.value.uuid:
+            return self.produce_reading()
+        raise BleakError(f"Characteristic {uuid} was not found!")
+
+    def write(self, uuid: str, data: bytes):
+        try:
+            if uuid == CalypsoDeviceStatusCharacteristic.mode.value.uuid:
+                self.source.mode = CalypsoDeviceMode(data[0])
+            elif uuid == CalypsoDeviceStatusCharacteristic.rate.value.uuid:
+                self.source.datarate = CalypsoDeviceDataRate(data[0])
+            elif uuid == CalypsoDeviceStatusCharacteristic.compass.value.uuid:
+                self.source.compass = CalypsoDeviceCompassStatus(data[0])
+            else:
+                raise BleakError(f"Characteristic {uuid} was not found!")
+        except (IndexError, ValueError) as ex:
+            raise BleakError(f"Writing characteristic {uuid} failed: {ex}") from None
+
+    def force_disconnect(self):
+        """
+        Drop the BLE link of all connected clients, like when the device goes out of range.
+        """
+        for client in list(self.clients):
+            client.on_link_lost()
+
+
+class EmulatedBleakClient:
+    """
+    Implement the subset of `BleakClient` used by `CalypsoDeviceApi`.
+    """
+
+    def __init__(
+        self,
+        peripheral: EmulatedPeripheral,
+        address: str,
+        adapter: t.Optional[str] = None,
+        disconnected_callback: t.Optional[t.Callable] = None,
+    ):
+        self.peripheral = peripheral
+        self.address = address
+        self._adapter = adapter
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self.notify_tasks: t.Dict[str, asyncio.Future] = {}
+        self.disconnect_task: t.Optional[asyncio.Future] = None
+
+    async def connect(self, **kwargs) -> bool:
+        settings = self.peripheral.settings
+        if settings.connect_latency:
+            await asyncio.sleep(settings.connect_latency)
+        if not self.peripheral.available or self.address != self.peripheral.ADDRESS:
+            raise BleakError(f"Device with address {self.address} was not found.")
+        self.is_connected = True
+        self.peripheral.clients.append(self)
+        self.peripheral.metrics.connects += 1
+        if settings.disconnect_interval is not None:
+            self.disconnect_task = asyncio.ensure_future(self.disconnect_later(settings.disconnect_interval))
+        return True
+
+    async def disconnect(self) -> bool:
+        if self.is_connected:
+            self.on_link_lost()
+        return True
+
+    async def read_gatt_char(self, char_specifier: str, **kwargs) -> bytearray:
+        self.ensure_connected()
+        return bytearray(self.peripheral.read(str(char_specifier).lower()))
+
+    async def write_gatt_char(self, char_specifier: str, data: bytes, response: bool = False):
+        self.ensure_connected()
+        self.peripheral.write(str(char_specifier).lower(), bytes(data))
+
+    async def start_notify(self, char_specifier: str, callback: t.Callable, **kwargs):
+        self.ensure_connected()
+        uuid = str(char_specifier).lower()
+        if uuid != CalypsoDeviceReadingCharacteristic.data.value.uuid:
+            raise BleakError(f"Characteristic {uuid} does not support notifications")
+        if uuid in self.notify_tasks:
+            raise BleakError(f"Notifications already started for characteristic {uuid}")
+        self.notify_tasks[uuid] = asyncio.ensure_future(self.notify(callback))
+
+    async def stop_notify(self, char_specifier: str):
+        self.ensure_connected()
+        task = self.notify_tasks.pop(str(char_specifier).lower(), None)
+        if task is None:
+            raise BleakError(f"Notifications not started for characteristic {char_specifier}")
+        task.cancel()
+
+    def ensure_connected(self):
+        if not self.is_connected:
+            raise BleakError("Not connected")
+
+    async def notify(self, callback: t.Callable):
+        peripheral = self.peripheral
+        settings = peripheral.settings
+        sender = 42
+        while True:
+            interval = peripheral.interval
+            if interval is None:
+                await asyncio.sleep(CalypsoDeviceDataRate.HZ_1.interval)
+                continue
+            jitter = settings.notify_jitter * peripheral.random.uniform(-1.0, 1.0)
+            await asyncio.sleep(interval * (1.0 + jitter))
+            if settings.drop_rate and peripheral.random.random() < settings.drop_rate:
+                peripheral.metrics.dropped += 1
+                continue
+            peripheral.metrics.notifications += 1
+            result = callback(sender, bytearray(peripheral.produce_reading()))
+            # Like Bleak, schedule coroutine callbacks as independent tasks.
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+
+    async def disconnect_later(self, delay: float):
+        await asyncio.sleep(delay)
+        logger.info(f"Emulating link loss to device at '{self.address}'")
+        self.disconnect_task = None
+        self.on_link_lost()
+
+    def on_link_lost(self):
+        self.is_connected = False
+        for task in self.notify_tasks.values():
+            task.cancel()
+        self.notify_tasks.clear()
+        if self.disconnect_task is not None:
+            self.disconnect_task.cancel()
+            self.disconnect_task = None
+        if self in self.peripheral.clients:
+            self.peripheral.clients.remove(self)
+        self.peripheral.metrics.disconnects += 1
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
@@ -1,18 +1,41 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@panodata.org>
 # License: GNU Affero General Public License, Version 3
+import functools
 import logging
 import sys
 import typing as t
 
-from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.buffer import ReadingQueue
 from calypso_anemometer.exception import CalypsoError
-from calypso_anemometer.model import CalypsoDeviceCompassStatus, CalypsoDeviceDataRate, CalypsoReading, Settings
-from calypso_anemometer.telemetry.adapter import TelemetryAdapter
-from calypso_anemometer.util import wait_forever
+from calypso_anemometer.model import CalypsoDeviceCompassStatus, CalypsoDeviceDataRate, QueueOverflowPolicy, Settings
+from calypso_anemometer.pipeline import (
+    FanOutStage,
+    Pipeline,
+    PipelineStage,
+    ProgressStage,
+    QuantileStage,
+    RecordingSink,
+    SourceStage,
+    StdoutSink,
+    TelemetrySink,
+)
+from calypso_anemometer.shutdown import ShutdownSignal, drain, unsubscribe
+from calypso_anemometer.stats import LoopLagProbe
+
+# Components which are only needed for specific options are imported on demand,
+# in order to keep the startup time low. Notably, the `fake` command does not load Bleak.
+if t.TYPE_CHECKING:  # pragma: no cover
+    from calypso_anemometer.core import CalypsoDeviceApi
 
 logger = logging.getLogger(__name__)
 
+# How long to wait for buffered readings to be processed when shutting down, in seconds.
+DRAIN_TIMEOUT = 2.0
+
+# How often to probe the event loop for scheduling delays, in seconds.
+LOOP_LAG_PROBE_INTERVAL = 0.25
+
 
 async def run_engine(workhorse, handler: t.Callable, settings: t.Optional[Settings] = None):
     """
@@ -28,12 +51,48 @@ async def run_engine(workhorse, handler: t.Callable, settings: t.Optional[Settin
     return worker
 
 
+def make_workhorse(settings: Settings, emulate: bool = False, reconnect: bool = False) -> t.Callable:
+    """
+    Choose the workhorse for talking to a Calypso UP10 device, to be used with `run_engine`.
+
+    :param settings: Connection settings. When emulating, the BLE address defaults to the one of the emulated device.
+    :param emulate: Use an emulated device instead of Bluetooth hardware.
+    :param reconnect: Reconnect and resubscribe in-process when the BLE link drops.
+    """
+    from calypso_anemometer.core import CalypsoDeviceApi
+
+    workhorse = CalypsoDeviceApi
+    if emulate:
+        from calypso_anemometer.emulator import EmulatedPeripheral
+
+        peripheral = EmulatedPeripheral()
+        settings.ble_address = settings.ble_address or peripheral.ADDRESS
+        workhorse = functools.partial(CalypsoDeviceApi, client_factory=peripheral.client)
+    if reconnect:
+        from calypso_anemometer.supervisor import CalypsoDeviceSupervisor
+
+        workhorse = functools.partial(CalypsoDeviceSupervisor, workhorse=workhorse)
+    return workhorse
+
+
 async def handler_factory(
     subscribe: bool = False,
     target: t.Optional[str] = None,
     rate: t.Optional[CalypsoDeviceDataRate] = None,
     compass: t.Optional[CalypsoDeviceCompassStatus] = None,
     quiet: bool = False,
+    watchdog_tolerance: t.Optional[float] = None,
+    watchdog_hard_timeout: t.Optional[float] = None,
+    queue_size: int = 0,
+    queue_overflow: QueueOverflowPolicy = QueueOverflowPolicy.DROP_OLDEST,
+    adaptive: bool = False,
+    stages: t.Optional[t.List[PipelineStage]] = None,
+    metrics_address: t.Optional[str] = None,
+    trace: bool = False,
+    record: t.Optional[str] = None,
+    drain_timeout: float = DRAIN_TIMEOUT,
+    shutdown: t.Optional[ShutdownSignal] = None,
+    sketch: t.Optional[str] = None,
 ) -> t.Callable:
     """
     Create an asynchronous handler function for processing readings.
@@ -43,38 +102,118 @@ async def handler_factory(
     :param rate: At which rate to sample the readings.
     :param compass: If the compass should be enabled or not.
     :param quiet: Do not print to stdout or stderr.
+    :param watchdog_tolerance: Recover when no reading arrived within this multiple of the expected interval.
+    :param watchdog_hard_timeout: Kill the process when no reading arrived within this number of seconds.
+    :param queue_size: Decouple processing from receiving readings using a queue of this size. `0` disables it.
+    :param queue_overflow: What to do when the queue is full.
+    :param adaptive: Adjust data rate and power mode at runtime, based on wind variability, battery, and time of day.
+    :param stages: Additional pipeline stages, for example filters or aggregators, running before the sinks.
+    :param metrics_address: Expose metrics in Prometheus format on this address, like `localhost:9464`.
+    :param trace: Trace latencies from receiving to submitting readings, and log them on SIGUSR1 and at exit.
+    :param record: Record readings to this file, in JSON Lines format.
+    :param drain_timeout: When shutting down, give buffered readings up to this number of seconds to be processed.
+    :param shutdown: Shut down on SIGTERM or SIGINT. Handlers of multiple devices need to share one instance.
+    :param sketch: Resume wind speed percentiles from this file, and write them back, see `QuantileStage`.
+                   Percentiles are only estimated when this, or `metrics_address`, is given.
 
     :return: An asynchronous handler function accepting a reference to a workhorse instance.
     """
 
-    message_counter = 0
-    message_counter_log_each = 25
+    arrival_statistics = None
 
-    # Optionally enable telemetry.
-    telemetry = None
-    if target is not None:
-        telemetry = TelemetryAdapter(uri=target)
+    # Measure the scheduling delay of the event loop, which sits between receiving and submitting readings.
+    loop_lag = LoopLagProbe(interval=LOOP_LAG_PROBE_INTERVAL)
+
+    # Optionally estimate wind speed percentiles over all readings, per device.
+    quantiles = None
+    if sketch is not None or metrics_address is not None:
+        quantiles = QuantileStage(path=sketch)
+
+    # Optionally decouple processing readings from receiving them.
+    queue = None
+    if queue_size:
+        queue = ReadingQueue(maxsize=queue_size, policy=queue_overflow)
+
+    def log_progress(count: int):
+        logger.info(f"Processed readings: {count}")
+        if queue is not None:
+            logger.info(f"Reading queue: depth={queue.depth}, dropped={queue.metrics.dropped}")
+        if arrival_statistics is not None:
+            logger.info(f"Arrival statistics: {arrival_statistics}")
+        if loop_lag.count:
+            logger.info(f"Event loop: {loop_lag}")
+        if quantiles is not None:
+            for device, digest in quantiles.digests.items():
+                logger.info(f"Wind speed at {device}: {digest}")
 
     # When a reading is received, optionally display on STDOUT or hand over to telemetry adapter.
-    def process_reading(reading: CalypsoReading):
-        nonlocal message_counter
-        message_counter += 1
-        if not quiet:
-            reading.dump()
-        if telemetry is not None:
-            telemetry.submit(reading)
-        if message_counter % message_counter_log_each == 0:
-            logger.info(f"Processed readings: {message_counter}")
+    # Sinks which are not needed are not part of the pipeline at all.
+    sinks: t.List[PipelineStage] = []
+    if not quiet:
+        sinks.append(StdoutSink())
+    if record is not None:
+        sinks.append(RecordingSink(record))
+    telemetry_sink = None
+    if target is not None:
+        from calypso_anemometer.telemetry.adapter import TelemetryAdapter
+
+        telemetry_sink = TelemetrySink(TelemetryAdapter(uri=target))
+        sinks.append(telemetry_sink)
+    source = SourceStage()
+    pipeline = Pipeline(
+        [
+            source,
+            *(stages or []),
+            *([quantiles] if quantiles is not None else []),
+            FanOutStage(sinks),
+            ProgressStage(callback=log_progress, each=25),
+        ]
+    )
+
+    if shutdown is None:
+        shutdown = ShutdownSignal()
+
+    # Optionally expose metrics.
+    metrics = None
+    metrics_server = None
+    if metrics_address is not None:
+        from calypso_anemometer.metrics import EngineMetrics, MetricsServer
+
+        metrics = EngineMetrics()
+        metrics.source = source
+        metrics.queue = queue
+        metrics.loop_lag = loop_lag
+        metrics.quantiles = quantiles
+        if telemetry_sink is not None:
+            metrics.instrument_telemetry(telemetry_sink)
+        metrics_server = MetricsServer.from_address(metrics.registry, metrics_address)
+
+    # Optionally trace latencies.
+    tracer = None
+    if trace:
+        from calypso_anemometer.tracing import Tracer
+
+        tracer = Tracer()
+        tracer.instrument(pipeline)
 
     # Main handler, which receives readings.
-    async def handler(calypso: CalypsoDeviceApi):
+    async def handler(calypso: "CalypsoDeviceApi"):
+        nonlocal arrival_statistics
+        arrival_statistics = getattr(calypso, "arrival_statistics", None)
+
+        if tracer is not None:
+            tracer.instrument_device(calypso)
+
         # Optionally enable compass.
         await calypso.set_compass(compass)
 
         # One-shot reading.
         if not subscribe:
             reading = await calypso.get_reading()
-            process_reading(reading)
+            pipeline(reading)
+            await pipeline.close()
+            if tracer is not None:
+                tracer.close()
 
         # Continuous readings.
         else:
@@ -82,7 +221,58 @@ async def handler_factory(
                 logger.info(f"Setting device data rate to {rate}")
                 await calypso.set_datarate(rate)
 
-            await calypso.subscribe_reading(process_reading)
-            await wait_forever()
+            subscribe_kwargs = {}
+            if queue is not None:
+                subscribe_kwargs["queue"] = queue
+
+            callback = pipeline
+            controller = None
+            if adaptive:
+                from calypso_anemometer.controller import AdaptiveController
+
+                controller = AdaptiveController(device=calypso, callback=pipeline)
+                callback = controller.on_reading
+
+            watchdog = None
+            if watchdog_tolerance is not None:
+                from calypso_anemometer.watchdog import NotificationWatchdog
+
+                watchdog = NotificationWatchdog(
+                    device=calypso,
+                    callback=callback,
+                    tolerance=watchdog_tolerance,
+                    hard_timeout=watchdog_hard_timeout,
+                )
+
+            loop_lag.start()
+            if metrics is not None:
+                metrics.add_device(calypso)
+                await metrics_server.start()
+            if tracer is not None:
+                tracer.install_signal_handler()
+            shutdown.install()
+            subscription = None
+            try:
+                if watchdog is None:
+                    subscription = await shutdown.run_until_requested(
+                        calypso.subscribe_reading(callback, **subscribe_kwargs)
+                    )
+                else:
+                    watchdog.start()
+                    subscription = await shutdown.run_until_requested(watchdog.subscribe(**subscribe_kwargs))
+            finally:
+                # Stop producing readings first, then flush them, see `calypso_anemometer.shutdown`.
+                if watchdog is not None:
+                    watchdog.stop()
+                if controller is not None:
+                    controller.stop()
+                await unsubscribe(calypso, subscription, timeout=drain_timeout)
+                report = await drain(pipeline, queue=queue, timeout=drain_timeout)
+                logger.info(f"Shutdown: {report}")
+                loop_lag.stop()
+                if metrics_server is not None:
+                    await metrics_server.stop()
+                if tracer is not None:
+                    tracer.close()
 
     return handler
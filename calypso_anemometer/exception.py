@@ -25,3 +25,7 @@ class BluetoothConversationError(CalypsoError):
 
 class BluetoothTimeoutError(CalypsoError):
     pass
+
+
+class CalypsoConfigurationError(CalypsoError):
+    pass
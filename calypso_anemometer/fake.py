@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@panodata.org>
 # License: GNU Affero General Public License, Version 3
+import asyncio
 import dataclasses
 import logging
+import time
 from copy import deepcopy
-from typing import Callable, Optional
-
-import aiorate
-
-from calypso_anemometer.model import CalypsoDeviceCompassStatus, CalypsoDeviceDataRate, CalypsoReading, Settings
+from typing import AsyncIterator, Callable, List, Optional
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.model import (
+    CalypsoDeviceCompassStatus,
+    CalypsoDeviceDataRate,
+    CalypsoDeviceMode,
+    CalypsoReading,
+    QueueOverflowPolicy,
+    Settings,
+)
+from calypso_anemometer.stats import ArrivalStatistics
 
 logger = logging.getLogger(__name__)
 
@@ -33,18 +42,67 @@ MAXIMUM_VALUES = CalypsoReading(
 )
 
 
+# Only the measurement fields, excluding receive timestamps.
+MEASUREMENT_FIELDS = [field.name for field in dataclasses.fields(CalypsoReading) if field.compare]
+
+
+class Ticker:
+    """
+    Regulate the loop frequency of the fake reading producer.
+
+    Sleep until the next tick, without polling the event loop, so many fake devices
+    can share one process. Ticks are scheduled on a fixed grid, in order not to drift.
+    When running late, missed ticks are skipped instead of catching up in a burst.
+    """
+
+    def __init__(self, interval: float):
+        self.loop = asyncio.get_event_loop()
+        self.interval = interval
+        self.next_tick = self.loop.time() + interval
+
+    async def sleep(self):
+        delay = self.next_tick - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            self.next_tick += self.interval
+        else:
+            self.next_tick = self.loop.time() + self.interval
+
+
 class CalypsoDeviceApiFake:
     NAME = "calypso-up10-fake"
     DESCRIPTION = "Calypso UP10 anemometer fake device"
 
-    def __init__(self, settings: Optional[Settings] = None, ble_address: Optional[str] = None):
+    def __init__(
+        self,
+        settings: Optional[Settings] = None,
+        ble_address: Optional[str] = None,
+        unlimited: bool = False,
+        batch_size: int = 1,
+        model=None,
+    ):
+        """
+        :param unlimited: Produce readings as fast as possible, not obeying the data rate. Useful for load testing.
+        :param batch_size: Produce readings in chunks of this size. When obeying the data rate, each tick emits a chunk.
+        :param model: Generate realistic readings using a `calypso_anemometer.wind.WindModel`.
+                      By default, all values are incremented by one.
+        """
         if settings is None:
             settings = Settings(ble_address=ble_address)
+        if batch_size < 1:
+            raise ValueError(f"Batch size must be a positive number: {batch_size}")
         self.settings = settings
+        self.unlimited = unlimited
+        self.batch_size = batch_size
+        self.model = model
         self.ble_address = settings.ble_address
+        self.mode: CalypsoDeviceMode = CalypsoDeviceMode.NORMAL
         self.datarate: CalypsoDeviceDataRate = CalypsoDeviceDataRate.HZ_4
         self.compass: CalypsoDeviceCompassStatus = CalypsoDeviceCompassStatus.OFF
         self.reading: Optional[CalypsoReading] = None
+        self.subscription: Optional[object] = None
+        self.queue: Optional[ReadingQueue] = None
+        self.arrival_statistics = ArrivalStatistics(expected_interval=self.datarate.interval)
 
     async def __aenter__(self):
         await self.connect()
@@ -52,6 +110,7 @@ class CalypsoDeviceApiFake:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.disconnect()
+        await self.stop_queue()
         if exc_val is not None:  # pragma: no cover
             raise exc_val
 
@@ -65,41 +124,122 @@ class CalypsoDeviceApiFake:
     async def disconnect(self):
         self.reading = None
 
+    async def set_mode(self, mode: CalypsoDeviceMode):
+        self.mode = mode
+
     async def set_datarate(self, rate: CalypsoDeviceDataRate):
         self.datarate = rate
+        self.arrival_statistics.expected_interval = rate.interval
 
     async def set_compass(self, compass: CalypsoDeviceCompassStatus):
         self.compass = compass
 
     async def get_reading(self):
         logger.info("Producing reading")
-        return await self.produce_fake_reading()
-
-    async def subscribe_reading(self, callback: Optional[Callable] = None, run_once: Optional[bool] = False):
+        return (await self.produce_fake_reading()).stamp(device=self.ble_address)
+
+    async def subscribe_reading(
+        self,
+        callback: Optional[Callable] = None,
+        run_once: Optional[bool] = False,
+        queue: Optional[ReadingQueue] = None,
+    ):
         """
         Fake async reading producer task, emulating responses to a BLE subscribe/notify.
         """
         logger.info("Subscribing to readings")
-        rate = aiorate.Rate(float(self.datarate.value))
-        while True:
-            reading = await self.produce_fake_reading()
-            if callback is not None:
-                callback(reading)
-            await rate.sleep()
+        if queue is not None:
+            queue.start(callback)
+            self.queue = queue
+        datarate = self.datarate
+        rate = Ticker(datarate.interval)
+        subscription = self.subscription = object()
+        while self.subscription is subscription:
+            # Follow data rate changes at runtime.
+            if self.datarate is not datarate:
+                datarate = self.datarate
+                rate = Ticker(datarate.interval)
+            readings = self.produce_fake_readings(self.batch_size)
+            received_monotonic, received_time = time.monotonic(), time.time()
+            self.arrival_statistics.update(received_monotonic)
+            for reading in readings:
+                reading.stamp(received_monotonic, received_time, device=self.ble_address)
+                if queue is not None:
+                    await queue.put(reading)
+                elif callback is not None:
+                    callback(reading)
+            if self.unlimited:
+                # Yield to the event loop, so consumers can keep up.
+                await asyncio.sleep(0)
+            else:
+                await rate.sleep()
             if run_once:
                 break
 
+    async def unsubscribe_reading(self):
+        """
+        Stop the fake reading producer task.
+        """
+        logger.info("Unsubscribing from readings")
+        self.subscription = None
+
+    async def stop_queue(self):
+        """
+        Stop the consumer task of the reading queue, see `CalypsoDeviceApi.stop_queue`.
+        """
+        if self.queue is not None:
+            await self.queue.stop()
+            self.queue = None
+
+    async def stream(
+        self,
+        batch_size: Optional[int] = None,
+        max_latency: Optional[float] = None,
+        queue: Optional[ReadingQueue] = None,
+    ) -> AsyncIterator:
+        """
+        Yield fake readings one by one, or as lists of readings, see `CalypsoDeviceApi.stream`.
+
+        By default, the fake producer blocks when the consumer can not keep up, applying backpressure.
+        """
+        if queue is None:
+            queue = ReadingQueue(maxsize=max(128, 2 * (batch_size or 0)), policy=QueueOverflowPolicy.BLOCK)
+        iterator = queue.iterate(batch_size=batch_size, max_latency=max_latency)
+        queue.start()
+        producer = asyncio.ensure_future(self.subscribe_reading(queue=queue))
+        try:
+            async for item in iterator:
+                yield item
+        finally:
+            await iterator.aclose()
+            await self.unsubscribe_reading()
+            producer.cancel()
+
     async def produce_fake_reading(self):
         """
         Produce an artificial reading with incrementing values,
         wrapping around at a maximum limit per measurement.
         """
-        for field in dataclasses.fields(self.reading):
-            current_value = getattr(self.reading, field.name)
-            minimum_value = getattr(MINIMUM_VALUES, field.name)
-            maximum_value = getattr(MAXIMUM_VALUES, field.name)
-            current_value += 1
-            if current_value > maximum_value:
-                current_value = minimum_value
-            setattr(self.reading, field.name, current_value)
-        return self.reading
+        return self.produce_fake_readings(1)[0]
+
+    def produce_fake_readings(self, count: int) -> List[CalypsoReading]:
+        """
+        Produce a chunk of artificial readings with incrementing values,
+        wrapping around at a maximum limit per measurement.
+
+        Values are computed column by column, in order to keep the per-reading overhead low.
+        """
+        if self.model is not None:
+            readings = self.model.generate(count, interval=self.datarate.interval)
+            self.reading = dataclasses.replace(readings[-1])
+            return readings
+        columns = []
+        for name in MEASUREMENT_FIELDS:
+            minimum_value = getattr(MINIMUM_VALUES, name)
+            span = getattr(MAXIMUM_VALUES, name) - minimum_value + 1
+            offset = getattr(self.reading, name) - minimum_value
+            columns.append([minimum_value + (offset + step) % span for step in range(1, count + 1)])
+        readings = [CalypsoReading(*values) for values in zip(*columns)]  # noqa: B905
+        # Keep a copy of the last reading, because readings may be buffered by the consumer.
+        self.reading = dataclasses.replace(readings[-1])
+        return readings
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Run a fleet of fake devices within a single process, for scale testing.
+
+All devices share one event loop and one handler, i.e. they feed the same
+processing and telemetry pipeline, like a gateway serving many anemometers.
+The report accounts for the cost of the whole pipeline: CPU time per reading,
+event loop lag, and peak memory usage.
+
+Synopsis::
+
+    fleet = FakeFleet(devices=100)
+    report = await fleet.run(handler, duration=30)
+"""
+import asyncio
+import dataclasses
+import logging
+import sys
+import time
+import typing as t
+
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.stats import LoopLagProbe
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def fleet_address(index: int) -> str:
+    """
+    Compute a distinct, stable BLE address for each fleet member.
+    """
+    return f"00:00:00:FA:{index // 256 % 256:02X}:{index % 256:02X}"
+
+
+def memory_peak() -> t.Optional[float]:
+    """
+    Peak resident set size of the process, in MiB. `None` when not available on this platform.
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes.
+    if sys.platform == "darwin":  # pragma: no cover
+        return maxrss / 1024 / 1024
+    return maxrss / 1024
+
+
+@dataclasses.dataclass
+class FleetReport:
+    """
+    Resource usage of a fleet run. Durations are in seconds, memory is in MiB.
+    """
+
+    devices: int
+    readings: int
+    duration: float
+    cpu_time: float
+    cpu_per_reading: t.Optional[float]
+    readings_per_second: float
+    loop_lag_mean: t.Optional[float]
+    loop_lag_p99: t.Optional[float]
+    loop_lag_max: t.Optional[float]
+    memory_peak: t.Optional[float]
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+    def __str__(self):
+        def fmt(value, scale=1000.0, unit="ms"):
+            return "n/a" if value is None else f"{value * scale:.1f}{unit}"
+
+        return (
+            f"devices={self.devices}, readings={self.readings}, "
+            f"readings_per_second={self.readings_per_second:.1f}, "
+            f"cpu_per_reading={fmt(self.cpu_per_reading, 1e6, 'us')}, "
+            f"loop_lag_mean={fmt(self.loop_lag_mean)}, loop_lag_p99={fmt(self.loop_lag_p99)}, "
+            f"loop_lag_max={fmt(self.loop_lag_max)}, memory_peak={fmt(self.memory_peak, 1.0, 'MiB')}"
+        )
+
+
+class FakeFleet:
+    """
+    Manage a number of independent fake devices, with distinct addresses and seeds.
+
+    :param devices: How many devices to run.
+    :param device_factory: Create the device for a given index, by default a `CalypsoDeviceApiFake`.
+    :param report_interval: Log an interim report each number of seconds. `None` disables it.
+    """
+
+    def __init__(
+        self,
+        devices: int,
+        device_factory: t.Optional[t.Callable[[int], t.Any]] = None,
+        report_interval: t.Optional[float] = 10.0,
+    ):
+        if devices < 1:
+            raise ValueError(f"Number of devices must be a positive number: {devices}")
+        self.device_factory = device_factory or self.make_device
+        self.devices = [self.device_factory(index) for index in range(devices)]
+        self.report_interval = report_interval
+        self.probe = LoopLagProbe()
+        self.started_monotonic: t.Optional[float] = None
+        self.started_cpu: t.Optional[float] = None
+
+    @staticmethod
+    def make_device(index: int) -> CalypsoDeviceApiFake:
+        return CalypsoDeviceApiFake(ble_address=fleet_address(index))
+
+    @property
+    def readings(self) -> int:
+        # The fake device accounts for arrival statistics once per chunk.
+        return sum(device.arrival_statistics.count * getattr(device, "batch_size", 1) for device in self.devices)
+
+    async def serve(self, device, handler: t.Callable):
+        async with device as calypso:
+            await handler(calypso)
+
+    async def run(self, handler: t.Callable, duration: t.Optional[float] = None) -> FleetReport:
+        """
+        Run all devices concurrently, each invoking `handler`, for `duration` seconds or until cancelled.
+        """
+        logger.info(f"Starting fleet of {len(self.devices)} fake devices")
+        self.started_monotonic = time.monotonic()
+        self.started_cpu = time.process_time()
+        self.probe.start()
+        tasks = [asyncio.ensure_future(self.serve(device, handler)) for device in self.devices]
+        reporter = None
+        if self.report_interval is not None:
+            reporter = asyncio.ensure_future(self.report_periodically())
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=duration, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            self.probe.stop()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        report = self.report()
+        logger.info(f"Fleet report: {report}")
+        return report
+
+    async def report_periodically(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            logger.info(f"Fleet report: {self.report()}")
+
+    def report(self) -> FleetReport:
+        duration = time.monotonic() - self.started_monotonic
+        cpu_time = time.process_time() - self.started_cpu
+        readings = self.readings
+        probe = self.probe.asdict()
+        return FleetReport(
+            devices=len(self.devices),
+            readings=readings,
+            duration=duration,
+            cpu_time=cpu_time,
+            cpu_per_reading=cpu_time / readings if readings else None,
+            readings_per_second=readings / duration if duration else 0.0,
+            loop_lag_mean=probe["lag_mean"],
+            loop_lag_p99=probe["lag_p99"],
+            loop_lag_max=probe["lag_max"],
+            memory_peak=memory_peak(),
+        )
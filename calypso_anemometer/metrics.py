@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Expose operational metrics in Prometheus text format, without additional dependencies.
+
+Most values are already accounted for by the components themselves, like the
+queue, the supervisor, or the pipeline stages. Those are collected on each
+scrape, so they cost nothing on the hot path. Only latencies are recorded on
+the hot path, using histograms with fixed buckets.
+
+Synopsis::
+
+    registry = MetricsRegistry()
+    histogram = registry.register(Histogram("calypso_send_seconds", "Latency of sending"))
+    histogram.observe(0.0012)
+    server = MetricsServer(registry, host="localhost", port=9464)
+    await server.start()
+
+- https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import asyncio
+import bisect
+import logging
+import math
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+Labels = t.Dict[str, str]
+Sample = t.Tuple[str, Labels, float]
+
+# Latency buckets, in seconds, from 10 microseconds to one second.
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 1.0)
+
+
+class Metric:
+    """
+    Base class for metrics. `kind` is one of `counter`, `gauge`, or `histogram`.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+
+    def samples(self) -> t.Iterable[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def samples(self) -> t.Iterable[Sample]:
+        yield self.name, {}, self.value
+
+
+class Gauge(Metric):
+    """
+    A value which can go up and down. When `function` is given, it is invoked on each scrape.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: t.Optional[t.Callable[[], t.Optional[float]]] = None):
+        super().__init__(name, documentation)
+        self.value: t.Optional[float] = 0.0
+        self.function = function
+
+    def set(self, value: t.Optional[float]):  # noqa: A003
+        self.value = value
+
+    def samples(self) -> t.Iterable[Sample]:
+        value = self.function() if self.function is not None else self.value
+        if value is not None:
+            yield self.name, {}, value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values. Observing a value increments a single bucket, cumulative
+    counts are computed on scrape.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: t.Sequence[float] = LATENCY_BUCKETS,
+        labels: t.Optional[Labels] = None,
+    ):
+        super().__init__(name, documentation)
+        self.labels = labels or {}
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> t.Iterable[Sample]:
+        cumulative = 0
+        for bound, count in zip(self.bounds + [math.inf], self.counts):  # noqa: B905
+            cumulative += count
+            yield f"{self.name}_bucket", {**self.labels, "le": format_value(bound)}, cumulative
+        yield f"{self.name}_sum", self.labels, self.sum
+        yield f"{self.name}_count", self.labels, self.count
+
+
+class Summary(Metric):
+    """
+    Percentiles of observed values, estimated by a `calypso_anemometer.stats.TDigest`, which is updated elsewhere.
+    """
+
+    kind = "summary"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        digest,
+        quantiles: t.Sequence[float] = (0.5, 0.9, 0.99),
+        labels: t.Optional[Labels] = None,
+    ):
+        super().__init__(name, documentation)
+        self.digest = digest
+        self.quantiles = quantiles
+        self.labels = labels or {}
+
+    def samples(self) -> t.Iterable[Sample]:
+        if self.digest.count:
+            for quantile in self.quantiles:
+                yield self.name, {**self.labels, "quantile": format_value(quantile)}, self.digest.percentile(quantile)
+        yield f"{self.name}_sum", self.labels, self.digest.total
+        yield f"{self.name}_count", self.labels, self.digest.count
+
+
+class MetricFamily(Metric):
+    """
+    A metric with samples computed by a collector, optionally with labels.
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str = "gauge"):
+        super().__init__(name, documentation)
+        self.kind = kind
+        self.items: t.List[t.Tuple[Labels, float]] = []
+
+    def add(self, value: t.Optional[float], **labels: str) -> "MetricFamily":
+        if value is not None:
+            self.items.append((labels, value))
+        return self
+
+    def samples(self) -> t.Iterable[Sample]:
+        for labels, value in self.items:
+            yield self.name, labels, value
+
+
+class MetricsRegistry:
+    """
+    Hold metrics, and collectors computing metrics on each scrape.
+    """
+
+    def __init__(self):
+        self.metrics: t.List[Metric] = []
+        self.collectors: t.List[t.Callable[[], t.Iterable[Metric]]] = []
+
+    def register(self, metric: Metric) -> t.Any:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: t.Callable[[], t.Iterable[Metric]]):
+        self.collectors.append(collector)
+
+    def collect(self) -> t.Iterable[Metric]:
+        yield from self.metrics
+        for collector in self.collectors:
+            try:
+                yield from collector()
+            except Exception:
+                logger.exception("Collecting metrics failed")
+
+    def render(self) -> str:
+        # Metrics of the same name, for example histograms with different labels, are rendered as one family.
+        families: t.Dict[str, t.List[Metric]] = {}
+        for metric in self.collect():
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, metrics in families.items():
+            lines.append(f"# HELP {name} {metrics[0].documentation}")
+            lines.append(f"# TYPE {name} {metrics[0].kind}")
+            for metric in metrics:
+                for sample_name, labels, value in metric.samples():
+                    lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    items = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server exposing the metrics registry at `/metrics`.
+
+    :param registry: The metrics to expose.
+    :param host: The address to listen on.
+    :param port: The port to listen on. `0` will choose a free port.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, registry: MetricsRegistry, host: t.Optional[str] = "localhost", port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: t.Optional[asyncio.AbstractServer] = None
+        self.lock: t.Optional[asyncio.Lock] = None
+
+    @classmethod
+    def from_address(cls, registry: MetricsRegistry, address: str) -> "MetricsServer":
+        """
+        Create server from an address like `localhost:9464`, or `:9464` for listening on all interfaces.
+        """
+        host, _, port = address.rpartition(":")
+        try:
+            return cls(registry, host=host or None, port=int(port))
+        except ValueError:
+            raise ValueError(f"Invalid metrics address: {address}") from None
+
+    @property
+    def running(self) -> bool:
+        return self.server is not None
+
+    async def start(self):
+        """
+        Start listening. Calling it again while running is a no-op, so a server can be shared.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.server is not None:
+                return
+            self.server = await asyncio.start_server(self.handle, host=self.host, port=self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Serving metrics at http://{self.host or '0.0.0.0'}:{self.port}/metrics")  # noqa: S104
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        await self.server.wait_closed()
+        self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+            # Consume the request headers.
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                status, body = "405 Method Not Allowed", ""
+            elif parts[1].split("?")[0] != "/metrics":
+                status, body = "404 Not Found", ""
+            else:
+                status, body = "200 OK", self.registry.render()
+            payload = body.encode("utf-8")
+            header = (
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {self.CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: close\r\n\r\n"
+            )
+            writer.write(header.encode("latin-1"))
+            if parts and parts[0] != "HEAD":
+                writer.write(payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as ex:
+            logger.debug(f"Serving metrics failed: {ex}")
+        finally:
+            writer.close()
+
+
+class EngineMetrics:
+    """
+    Expose the state of the engine: devices, processing pipeline, queue, and event loop.
+
+    Counters kept by the components are collected on scrape. Only telemetry latencies
+    are recorded per reading, when instrumenting telemetry sinks.
+    """
+
+    def __init__(self, registry: t.Optional[MetricsRegistry] = None):
+        self.registry = registry or MetricsRegistry()
+        self.devices: t.List[t.Any] = []
+        self.source = None
+        self.telemetry_sinks: t.List[t.Any] = []
+        self.queue = None
+        self.loop_lag = None
+        self.quantiles = None
+        self.registry.add_collector(self.collect)
+
+    def add_device(self, device):
+        if device not in self.devices:
+            self.devices.append(device)
+
+    def instrument_telemetry(self, sink):
+        """
+        Record render and send latencies of a `calypso_anemometer.pipeline.TelemetrySink`.
+        """
+        labels = {"target": sink.telemetry.uri}
+        sink.render_latency = self.registry.register(
+            Histogram("calypso_telemetry_render_seconds", "Time to render a telemetry message.", labels=labels)
+        )
+        sink.send_latency = self.registry.register(
+            Histogram("calypso_telemetry_send_seconds", "Time to send a telemetry message.", labels=labels)
+        )
+        self.telemetry_sinks.append(sink)
+
+    def collect(self) -> t.Iterable[Metric]:
+        received = MetricFamily("calypso_readings_received_total", "Readings received from the device.", "counter")
+        decoding_errors = MetricFamily(
+            "calypso_decoding_errors_total", "Notifications which could not be decoded.", "counter"
+        )
+        reconnects = MetricFamily("calypso_reconnects_total", "Reconnects after losing the BLE link.", "counter")
+        reconnect_latency = MetricFamily(
+            "calypso_reconnect_latency_seconds", "Time from losing the BLE link until connected again, last time."
+        )
+        gap_duration = MetricFamily(
+            "calypso_gap_duration_seconds", "Time from losing the BLE link until receiving readings again, last time."
+        )
+        gap_total = MetricFamily(
+            "calypso_gap_seconds_total", "Time without readings because of losing the BLE link.", "counter"
+        )
+        datarate = MetricFamily("calypso_datarate_hertz", "Current data rate of the device.")
+        for device in self.devices:
+            address = str(device.ble_address)
+            statistics = getattr(device, "arrival_statistics", None)
+            if statistics is not None:
+                # The fake device accounts for arrival statistics once per chunk.
+                received.add(statistics.count * getattr(device, "batch_size", 1), device=address)
+            decoding_errors.add(getattr(device, "decoding_errors", 0), device=address)
+            supervisor_metrics = getattr(device, "metrics", None)
+            if supervisor_metrics is not None and hasattr(supervisor_metrics, "reconnects"):
+                reconnects.add(supervisor_metrics.reconnects, device=address)
+                reconnect_latency.add(supervisor_metrics.last_reconnect_latency, device=address)
+                gap_duration.add(supervisor_metrics.last_gap_duration, device=address)
+                gap_total.add(supervisor_metrics.total_gap_duration, device=address)
+            if getattr(device, "datarate", None) is not None:
+                datarate.add(device.datarate.value, device=address)
+        yield from [received, decoding_errors, reconnects, reconnect_latency, gap_duration, gap_total, datarate]
+
+        if self.source is not None:
+            yield MetricFamily(
+                "calypso_readings_processed_total", "Readings entering the processing pipeline.", "counter"
+            ).add(self.source.metrics.received)
+            last = self.source.last
+            yield MetricFamily("calypso_battery_level_percent", "Battery level of the most recent reading.").add(
+                last.battery_level if last is not None else None
+            )
+
+        sent = MetricFamily("calypso_telemetry_sent_total", "Telemetry messages sent.", "counter")
+        failures = MetricFamily("calypso_telemetry_failures_total", "Telemetry messages failed to send.", "counter")
+        for sink in self.telemetry_sinks:
+            target = sink.telemetry.uri
+            sent.add(sink.metrics.received - sink.metrics.errors, target=target)
+            failures.add(sink.metrics.errors, target=target)
+        yield from [sent, failures]
+
+        if self.queue is not None:
+            yield MetricFamily("calypso_queue_depth", "Readings waiting in the processing queue.").add(self.queue.depth)
+            yield MetricFamily(
+                "calypso_queue_dropped_total", "Readings dropped because the queue was full.", "counter"
+            ).add(self.queue.metrics.dropped)
+
+        if self.quantiles is not None:
+            for device, digest in self.quantiles.digests.items():
+                yield Summary(
+                    "calypso_wind_speed_meters_per_second",
+                    "Percentiles of wind speed over all readings.",
+                    digest,
+                    labels={"device": device or "default"},
+                )
+
+        if self.loop_lag is not None and self.loop_lag.count:
+            data = self.loop_lag.asdict()
+            lag = MetricFamily("calypso_loop_lag_seconds", "Scheduling delay of the event loop.")
+            lag.add(data["lag_p50"], quantile="0.5").add(data["lag_p99"], quantile="0.99")
+            yield lag
+            yield MetricFamily("calypso_loop_lag_max_seconds", "Maximum scheduling delay of the event loop.").add(
+                data["lag_max"]
+            )
@@ -4,6 +4,7 @@
 import dataclasses
 import logging
 import struct
+import time
 from enum import Enum, IntEnum
 from typing import Optional, Union
 
@@ -11,6 +12,9 @@ from calypso_anemometer.util import to_json
 
 logger = logging.getLogger(__name__)
 
+# The device name, used as source identifier for telemetry data.
+DEVICE_NAME = "calypso-up10"
+
 
 @dataclasses.dataclass
 class Settings:
@@ -61,6 +65,13 @@ class CalypsoDeviceDataRate(IntEnum):
     HZ_4 = 0x04
     HZ_8 = 0x08
 
+    @property
+    def interval(self) -> float:
+        """
+        The interval between two readings, in seconds.
+        """
+        return 1.0 / float(self.value)
+
 
 class CalypsoDeviceCompassStatus(IntEnum):
     OFF = 0x00
@@ -89,6 +100,23 @@ class CalypsoDeviceStatusCharacteristic(Enum):
     )
 
 
+@dataclasses.dataclass
+class TrueWind:
+    """
+    Wind derived from apparent wind and boat motion. Speed is in m/s, angles are in degrees.
+
+    The angle is relative to the bow, like the apparent wind direction, while the
+    direction is relative to true north. Both denote where the wind is coming from.
+    """
+
+    speed: float
+    angle: float
+    direction: float
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+
 @dataclasses.dataclass
 class CalypsoReading:
     wind_speed: float
@@ -99,6 +127,20 @@ class CalypsoReading:
     pitch: int
     heading: int
 
+    # Receive timestamps. Monotonic clock for computing intervals, wall clock for downstream consumers.
+    # They are not part of the measurement, so they are excluded from comparison and serialization.
+    received_monotonic: Optional[float] = dataclasses.field(default=None, compare=False, repr=False)
+    received_time: Optional[float] = dataclasses.field(default=None, compare=False, repr=False)
+
+    # Wind derived from boat motion, relative to the water, and relative to the ground.
+    # See `calypso_anemometer.truewind`. They are only serialized when computed.
+    true_wind: Optional[TrueWind] = dataclasses.field(default=None, compare=False, repr=False)
+    ground_wind: Optional[TrueWind] = dataclasses.field(default=None, compare=False, repr=False)
+
+    # Address of the device which sent the reading, for keeping per-device state within shared pipelines.
+    # It is not part of the measurement, so it is excluded from comparison and serialization.
+    device: Optional[str] = dataclasses.field(default=None, compare=False, repr=False)
+
     @classmethod
     def from_buffer(cls, buffer: bytearray):
         """
@@ -147,6 +189,21 @@ class CalypsoReading:
             heading=360 - heading,
         )
 
+    def to_buffer(self) -> bytes:
+        """
+        Encode to binary, the inverse of `from_buffer`. Used by the emulated device.
+        """
+        return struct.pack(
+            "<HHBBBBH",
+            int(round(self.wind_speed * 100)),
+            int(self.wind_direction),
+            int(round(self.battery_level / 10)),
+            int(self.temperature) + 100,
+            int(self.roll) + 90,
+            int(self.pitch) + 90,
+            360 - int(self.heading),
+        )
+
     def adjusted(self):
         """
         Compensate sticky wind direction when wind speed goes zero.
@@ -155,15 +212,42 @@ class CalypsoReading:
             return dataclasses.replace(self, wind_direction=0)
         return self
 
+    def stamp(self, monotonic: Optional[float] = None, wall: Optional[float] = None, device: Optional[str] = None):
+        """
+        Record receive timestamps, defaulting to now, and the address of the sending device.
+        """
+        self.received_monotonic = monotonic if monotonic is not None else time.monotonic()
+        self.received_time = wall if wall is not None else time.time()
+        self.device = device
+        return self
+
     def asdict(self):
-        return dataclasses.asdict(self)
+        data = dataclasses.asdict(self)
+        del data["received_monotonic"]
+        del data["received_time"]
+        del data["device"]
+        if self.true_wind is None:
+            del data["true_wind"]
+        if self.ground_wind is None:
+            del data["ground_wind"]
+        return data
 
     def asjson(self):
-        return to_json(self)
+        return to_json(self.asdict())
 
     def dump(self):
         print(self.asjson())  # noqa: T201
 
 
+class QueueOverflowPolicy(Enum):
+    """
+    What to do when the queue between BLE notifications and processing pipeline is full.
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    BLOCK = "block"
+
+
 class CalypsoDeviceReadingCharacteristic(Enum):
     data = BleCharSpec(uuid="00002a39-0000-1000-8000-00805f9b34fb", name="data")
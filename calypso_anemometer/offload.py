@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Run the work of CPU- or I/O-heavy sinks on a thread pool or process pool.
+
+Sinks like recording files, database writes, or compression would block the
+event loop when running inline, delaying BLE notifications and all other
+tasks. `ExecutorSink` only puts readings into a bounded handoff queue, which
+never blocks. A consumer task collects readings into batches, and hands them
+over to the executor, one batch at a time, so ordering is preserved::
+
+    def record(readings: List[CalypsoReading]):
+        with open("readings.jsonl", "a") as f:
+            f.writelines(json.dumps(reading.asdict()) + "\\n" for reading in readings)
+
+    sink = ExecutorSink(record, executor="thread", batch_size=100, max_latency=1.0)
+    pipeline = Pipeline([FanOutStage([StdoutSink(), sink])])
+
+When using a process pool, the target function must be picklable, i.e. defined
+at module level, or a method of a picklable object.
+"""
+import asyncio
+import concurrent.futures
+import dataclasses
+import functools
+import logging
+import time
+import typing as t
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.model import CalypsoReading, QueueOverflowPolicy
+from calypso_anemometer.pipeline import Sink, StageMetrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class OffloadMetrics(StageMetrics):
+    """
+    Stage metrics, plus bookkeeping about offloaded work.
+
+    - `overflow`: Readings dropped because the handoff queue was full.
+    - `failed`: Readings within batches whose processing raised an exception.
+    - `busy_time`: Total wall-clock time the executor spent on batches, in seconds.
+    """
+
+    batches: int = 0
+    processed: int = 0
+    failed: int = 0
+    overflow: int = 0
+    busy_time: float = 0.0
+
+
+class ExecutorSink(Sink):
+    """
+    Wrap a function processing batches of readings, running it on an executor.
+
+    :param target: Function accepting a list of readings. For `Sink` instances, use `sink.send_batch`.
+    :param executor: One of `thread` or `process`, or a `concurrent.futures.Executor` instance.
+                     Executors created here use a single worker, and are shut down on `close`.
+    :param maxsize: Maximum number of readings waiting for processing.
+    :param policy: What to do when the handoff queue is full. `BLOCK` is not supported.
+    :param batch_size: Maximum number of readings per batch.
+    :param max_latency: Hand over an incomplete batch after this number of seconds.
+    :param drain_timeout: On `close`, give pending readings up to this number of seconds to be processed.
+    """
+
+    name = "executor"
+
+    def __init__(
+        self,
+        target: t.Callable[[t.List[CalypsoReading]], t.Any],
+        executor: t.Union[str, concurrent.futures.Executor] = "thread",
+        maxsize: int = 1024,
+        policy: QueueOverflowPolicy = QueueOverflowPolicy.DROP_OLDEST,
+        batch_size: int = 100,
+        max_latency: t.Optional[float] = 1.0,
+        drain_timeout: float = 5.0,
+        name: t.Optional[str] = None,
+    ):
+        super().__init__(name=name or getattr(target, "__name__", None))
+        if policy is QueueOverflowPolicy.BLOCK:
+            raise ValueError("Queue overflow policy 'block' is not supported by executor sinks")
+        if batch_size < 1:
+            raise ValueError(f"Batch size must be a positive number: {batch_size}")
+        self.target = target
+        self.executor_spec = executor
+        self.executor: t.Optional[concurrent.futures.Executor] = None
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.drain_timeout = drain_timeout
+        self.metrics: OffloadMetrics = OffloadMetrics()
+        self.queue = ReadingQueue(maxsize=maxsize, policy=policy)
+        self.consumer: t.Optional[asyncio.Future] = None
+
+    def start(self):
+        """
+        Create the executor, and start the consumer task. Invoked on the first reading.
+        """
+        if isinstance(self.executor_spec, concurrent.futures.Executor):
+            self.executor = self.executor_spec
+        elif self.executor_spec == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="calypso-sink")
+        elif self.executor_spec == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        else:
+            raise ValueError(f"Unknown executor: {self.executor_spec}")
+        self.queue.start()
+        self.consumer = asyncio.ensure_future(self.consume())
+
+    def send(self, reading: CalypsoReading):
+        if self.consumer is None:
+            self.start()
+        self.queue.put_nowait(reading)
+        self.metrics.overflow = self.queue.metrics.dropped
+
+    async def consume(self):
+        loop = asyncio.get_event_loop()
+        async for batch in self.queue.iterate(batch_size=self.batch_size, max_latency=self.max_latency):
+            started = time.monotonic()
+            try:
+                await loop.run_in_executor(self.executor, self.target, batch)
+                self.metrics.processed += len(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.metrics.failed += len(batch)
+                logger.exception(f"Processing batch of {len(batch)} readings in sink '{self.name}' failed")
+            finally:
+                self.metrics.batches += 1
+                self.metrics.busy_time += time.monotonic() - started
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of readings accepted, but not processed yet. This includes incomplete batches.
+        """
+        accepted = self.queue.metrics.received - self.queue.metrics.dropped
+        return accepted - self.metrics.processed - self.metrics.failed
+
+    async def drain(self):
+        while self.pending:
+            await asyncio.sleep(0.01)
+
+    async def close(self):
+        """
+        Process pending readings, stop the consumer task, and shut down the executor.
+        """
+        if self.consumer is None:
+            return
+        try:
+            await asyncio.wait_for(self.drain(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Sink '{self.name}' did not drain in time. Discarded readings: {self.pending}")
+        self.consumer.cancel()
+        try:
+            await self.consumer
+        except asyncio.CancelledError:
+            pass
+        self.consumer = None
+        if self.executor is not self.executor_spec:
+            # Wait for the running batch without blocking the event loop.
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, functools.partial(self.executor.shutdown, wait=True))
+        self.executor = None
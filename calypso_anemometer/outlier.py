@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Replace spikes within readings, using a Hampel filter.
+
+Ultrasonic sensors sometimes produce single-sample spikes, which pollute gust maxima,
+and trigger false alarms. A value is an outlier when it deviates from the median of the
+most recent `window` values by more than `threshold` times the median absolute deviation
+(MAD), scaled to match the standard deviation, and by more than the tolerance of its
+field. Outliers are replaced by the median.
+
+The window trails the current value, so the filter can run on live streams. In order to
+stay within O(log window) per value, the MAD is the running median of the deviations of
+each value from the median at the time it arrived, instead of from the current median.
+
+Angles are unwrapped, so that each value is within 180 degrees of its predecessor, and
+the median is computed on the unwrapped values. This way, wind directions around north
+are handled correctly.
+
+`hampel_filter` is the vectorized equivalent for recordings, using NumPy. It yields the
+same results as the streaming filter.
+"""
+import dataclasses
+import json
+import typing as t
+
+from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.pipeline import PipelineStage
+from calypso_anemometer.stats import RunningMedian
+
+if t.TYPE_CHECKING:
+    import numpy as np
+
+# Scale the MAD to estimate the standard deviation of normally distributed values.
+MAD_SCALE = 1.4826
+
+ANGLE_FIELDS = ["wind_direction", "heading"]
+
+DEFAULT_FIELDS = ["wind_speed", "wind_direction"]
+DEFAULT_WINDOW = 7
+DEFAULT_THRESHOLD = 3.0
+
+# Deviations within these tolerances are never outliers, even when the signal is flat and its MAD is zero.
+DEFAULT_TOLERANCES = {"wind_speed": 0.5, "wind_direction": 10.0, "heading": 10.0}
+
+# Only the measurement fields, excluding receive timestamps and derived wind.
+MEASUREMENT_FIELDS = [field.name for field in dataclasses.fields(CalypsoReading) if field.compare]
+
+
+class HampelFilter:
+    """
+    Detect outliers within a stream of values, and compute their replacements.
+
+    :param window: The number of recent values to compute the median on.
+    :param threshold: Values deviating by more than this multiple of the scaled MAD are outliers.
+    :param tolerance: Values deviating by no more than this are never outliers.
+    :param circular: Whether values are angles in degrees.
+    """
+
+    def __init__(
+        self,
+        window: int = DEFAULT_WINDOW,
+        threshold: float = DEFAULT_THRESHOLD,
+        tolerance: float = 0.0,
+        circular: bool = False,
+    ):
+        if window < 3:
+            raise ValueError(f"Window must be at least 3: {window}")
+        if threshold <= 0:
+            raise ValueError(f"Threshold must be a positive number: {threshold}")
+        self.window = window
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.circular = circular
+        self.recent = RunningMedian(window)
+        self.deviations = RunningMedian(window)
+        self.last: t.Optional[float] = None
+        self.unwrapped = 0.0
+
+    def unwrap(self, value: float) -> float:
+        """
+        Shift angle by multiples of 360 degrees, so it is within 180 degrees of its predecessor.
+        """
+        if self.last is None:
+            self.unwrapped = value
+        else:
+            difference = value - self.last
+            step = (difference + 180) % 360 - 180
+            if step == -180 and difference > 0:
+                step = 180
+            self.unwrapped += step
+        self.last = value
+        return self.unwrapped
+
+    def update(self, value: float) -> t.Optional[float]:
+        """
+        Account for a value. Return its replacement when it is an outlier, otherwise `None`.
+
+        Until the window has been filled, no value is an outlier.
+        """
+        if self.circular:
+            value = self.unwrap(value)
+        self.recent.push(value)
+        median = self.recent.median
+        deviation = abs(value - median)
+        self.deviations.push(deviation)
+        if len(self.recent) < self.window:
+            return None
+        if deviation <= max(self.threshold * MAD_SCALE * self.deviations.median, self.tolerance):
+            return None
+        if self.circular:
+            return median % 360
+        return median
+
+
+class HampelStage(PipelineStage):
+    """
+    Replace spikes within the given fields of readings by the running median. Place it before aggregation.
+
+    :param fields: Which fields of the readings to filter.
+    :param window: The number of recent readings to compute the median on.
+    :param threshold: Values deviating by more than this multiple of the scaled MAD are outliers.
+    :param tolerances: Deviations within these tolerances per field are never outliers.
+    """
+
+    name = "hampel"
+
+    def __init__(
+        self,
+        fields: t.Optional[t.List[str]] = None,
+        window: int = DEFAULT_WINDOW,
+        threshold: float = DEFAULT_THRESHOLD,
+        tolerances: t.Optional[t.Dict[str, float]] = None,
+        name: t.Optional[str] = None,
+    ):
+        super().__init__(name=name)
+        self.fields = check_fields(fields or DEFAULT_FIELDS)
+        tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+        self.filters = {
+            field: HampelFilter(
+                window=window,
+                threshold=threshold,
+                tolerance=tolerances.get(field, 0.0),
+                circular=field in ANGLE_FIELDS,
+            )
+            for field in self.fields
+        }
+        self.outliers: t.Dict[str, int] = dict.fromkeys(self.fields, 0)
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        replacements = {}
+        for field, hampel in self.filters.items():
+            value = getattr(reading, field)
+            replacement = hampel.update(value)
+            if replacement is not None:
+                replacements[field] = convert(value, replacement, circular=hampel.circular)
+                self.outliers[field] += 1
+        if replacements:
+            return dataclasses.replace(reading, **replacements)
+        return reading
+
+
+def check_fields(fields: t.List[str]) -> t.List[str]:
+    for field in fields:
+        if field not in MEASUREMENT_FIELDS:
+            raise ValueError(f"Unknown field: {field}")
+    return list(fields)
+
+
+def convert(original: t.Any, replacement: float, circular: bool = False) -> t.Any:
+    """
+    Keep integer fields integer, and angles within [0, 360).
+    """
+    if isinstance(original, int):
+        replacement = int(round(replacement))
+    if circular:
+        replacement = replacement % 360
+    return replacement
+
+
+def running_median(values: "np.ndarray", window: int) -> "np.ndarray":
+    """
+    Median of each value and the `window - 1` values before it. The first medians use fewer values.
+    """
+    import numpy as np
+
+    result = np.empty(len(values))
+    for index in range(min(window - 1, len(values))):
+        result[index] = np.median(values[: index + 1])
+    if len(values) >= window:
+        windows = np.lib.stride_tricks.sliding_window_view(values, window)
+        result[window - 1 :] = np.median(windows, axis=1)
+    return result
+
+
+def hampel_filter(
+    values: "np.ndarray",
+    window: int = DEFAULT_WINDOW,
+    threshold: float = DEFAULT_THRESHOLD,
+    tolerance: float = 0.0,
+    circular: bool = False,
+) -> t.Tuple["np.ndarray", "np.ndarray"]:
+    """
+    Vectorized equivalent of `HampelFilter`, for recordings. Returns the filtered values, and a mask of outliers.
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return values.copy(), np.zeros(0, dtype=bool)
+    series = values
+    if circular:
+        difference = np.diff(values)
+        step = (difference + 180) % 360 - 180
+        step[(step == -180) & (difference > 0)] = 180
+        # Accumulate sequentially, like the streaming filter does.
+        series = np.cumsum(np.concatenate([values[:1], step]))
+
+    median = running_median(series, window)
+    deviation = np.abs(series - median)
+    mad = running_median(deviation, window)
+    outliers = deviation > np.maximum(threshold * MAD_SCALE * mad, tolerance)
+    outliers[: window - 1] = False
+    if circular:
+        median = median % 360
+    return np.where(outliers, median, values), outliers
+
+
+def filter_recording(
+    infile: t.TextIO,
+    outfile: t.TextIO,
+    fields: t.Optional[t.List[str]] = None,
+    window: int = DEFAULT_WINDOW,
+    threshold: float = DEFAULT_THRESHOLD,
+    tolerances: t.Optional[t.Dict[str, float]] = None,
+) -> t.Dict[str, int]:
+    """
+    Replace spikes within readings recorded in JSON Lines format, see `RecordingSink`.
+
+    Returns the number of outliers per field.
+    """
+    import numpy as np
+
+    fields = check_fields(fields or DEFAULT_FIELDS)
+    tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+    records = [json.loads(line) for line in infile if line.strip()]
+    outliers = {}
+    for field in fields:
+        original = [record[field] for record in records]
+        filtered, mask = hampel_filter(
+            np.array(original, dtype=float),
+            window=window,
+            threshold=threshold,
+            tolerance=tolerances.get(field, 0.0),
+            circular=field in ANGLE_FIELDS,
+        )
+        for index in np.flatnonzero(mask).tolist():
+            records[index][field] = convert(original[index], float(filtered[index]), circular=field in ANGLE_FIELDS)
+        outliers[field] = int(mask.sum())
+    for record in records:
+        outfile.write(json.dumps(record) + "\n")
+    return outliers
@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Process readings through a pipeline of pluggable stages.
+
+Readings are received and decoded by the workhorse, i.e. the device driver.
+From there, each reading runs through a sequence of stages, for example
+filtering, aggregating, and finally fanning out to a number of sinks, like
+STDOUT or telemetry. Each stage accounts for its own counters.
+
+A stage returns the reading to hand it over to the next stage, a different
+reading to replace it, or `None` to stop processing it. This way, filters
+and aggregators need no special treatment::
+
+    pipeline = Pipeline([
+        FilterStage(lambda reading: reading.wind_speed > 0),
+        FanOutStage([StdoutSink(), TelemetrySink(TelemetryAdapter(uri=...))]),
+    ])
+    await calypso.subscribe_reading(pipeline)
+"""
+import dataclasses
+import inspect
+import json
+import logging
+import os
+import time
+import typing as t
+
+from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.stats import TDigest, circular_mean
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class StageMetrics:
+    received: int = 0
+    emitted: int = 0
+    dropped: int = 0
+    errors: int = 0
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+
+class PipelineStage:
+    """
+    Base class for pipeline stages. Override `process`.
+    """
+
+    name = "stage"
+
+    def __init__(self, name: t.Optional[str] = None):
+        if name is not None:
+            self.name = name
+        self.metrics = StageMetrics()
+
+    def __call__(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        self.metrics.received += 1
+        try:
+            result = self.process(reading)
+        except Exception:
+            self.metrics.errors += 1
+            raise
+        if result is None:
+            self.metrics.dropped += 1
+        else:
+            self.metrics.emitted += 1
+        return result
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        return reading
+
+    async def close(self):
+        """
+        Release resources, and flush pending work. Invoked once, when shutting down.
+        """
+        pass
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class SourceStage(PipelineStage):
+    """
+    Entry point of the pipeline. Counts all readings, and remembers the most recent one.
+    """
+
+    name = "source"
+
+    def __init__(self, name: t.Optional[str] = None):
+        super().__init__(name=name)
+        self.last: t.Optional[CalypsoReading] = None
+        # Optionally trace latencies, see `calypso_anemometer.tracing.Tracer`.
+        self.tracer = None
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        self.last = reading
+        if self.tracer is not None:
+            self.tracer.record_since("pipeline", reading)
+        return reading
+
+
+class FunctionStage(PipelineStage):
+    """
+    Run readings through a function, which returns a reading, or `None` to drop it.
+    """
+
+    name = "function"
+
+    def __init__(
+        self, function: t.Callable[[CalypsoReading], t.Optional[CalypsoReading]], name: t.Optional[str] = None
+    ):
+        super().__init__(name=name or getattr(function, "__name__", None))
+        self.function = function
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        return self.function(reading)
+
+
+class FilterStage(PipelineStage):
+    """
+    Only pass readings for which the predicate is true.
+    """
+
+    name = "filter"
+
+    def __init__(self, predicate: t.Callable[[CalypsoReading], bool], name: t.Optional[str] = None):
+        super().__init__(name=name)
+        self.predicate = predicate
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        if self.predicate(reading):
+            return reading
+        return None
+
+
+class AggregateStage(PipelineStage):
+    """
+    Aggregate each `window` readings into one, in order to reduce the data rate downstream.
+
+    Wind speed and the remaining scalar values are arithmetic means. Wind direction is the
+    direction of the mean wind vector, and heading is the circular mean. Receive timestamps
+    are taken from the most recent reading.
+    """
+
+    name = "aggregate"
+
+    def __init__(self, window: int, name: t.Optional[str] = None):
+        super().__init__(name=name)
+        if window < 1:
+            raise ValueError(f"Aggregation window must be a positive number: {window}")
+        self.window = window
+        self.readings: t.List[CalypsoReading] = []
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of readings within the incomplete window. They are discarded when closing.
+        """
+        return len(self.readings)
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        self.readings.append(reading)
+        if len(self.readings) < self.window:
+            return None
+        readings, self.readings = self.readings, []
+        return self.aggregate(readings)
+
+    @staticmethod
+    def aggregate(readings: t.List[CalypsoReading]) -> CalypsoReading:
+        count = len(readings)
+        wind_direction = circular_mean(
+            [reading.wind_direction for reading in readings], weights=[reading.wind_speed for reading in readings]
+        )
+        heading = circular_mean([reading.heading for reading in readings])
+        last = readings[-1]
+        return CalypsoReading(
+            wind_speed=round(sum(reading.wind_speed for reading in readings) / count, 2),
+            wind_direction=0 if wind_direction is None else round(wind_direction) % 360,
+            battery_level=round(sum(reading.battery_level for reading in readings) / count),
+            temperature=round(sum(reading.temperature for reading in readings) / count),
+            roll=round(sum(reading.roll for reading in readings) / count),
+            pitch=round(sum(reading.pitch for reading in readings) / count),
+            heading=last.heading if heading is None else round(heading) % 360,
+            received_monotonic=last.received_monotonic,
+            received_time=last.received_time,
+            device=last.device,
+        )
+
+
+class QuantileStage(PipelineStage):
+    """
+    Estimate percentiles of a field over all readings, in bounded memory, using one `TDigest` per device.
+
+    When `path` is given, digests are resumed from that file, and written back each
+    `save_each` readings, and when closing. When it contains a `{device}` placeholder,
+    each device gets its own file. Otherwise, the digests of all devices are merged into
+    it. Digests of multiple files can be merged, see `calypso-anemometer percentiles`.
+    """
+
+    name = "quantiles"
+
+    def __init__(
+        self,
+        field: str = "wind_speed",
+        path: t.Optional[str] = None,
+        save_each: int = 600,
+        compression: float = 100.0,
+        name: t.Optional[str] = None,
+    ):
+        super().__init__(name=name)
+        if field not in [field.name for field in dataclasses.fields(CalypsoReading) if field.compare]:
+            raise ValueError(f"Unknown field: {field}")
+        if save_each < 1:
+            raise ValueError(f"Save interval must be a positive number: {save_each}")
+        self.field = field
+        self.path = path
+        self.save_each = save_each
+        self.compression = compression
+        self.per_device = path is not None and "{device}" in path
+        self.digests: t.Dict[t.Optional[str], TDigest] = {}
+
+        # Without placeholder, the resumed digest is kept aside, and merged when saving.
+        self.resumed = TDigest(compression=compression)
+        if path is not None and not self.per_device and os.path.exists(path):
+            self.resumed = TDigest.load(path)
+            logger.info(f"Resuming percentiles of {self.resumed.count} readings from {path}")
+
+    @property
+    def digest(self) -> TDigest:
+        """
+        The digest over all readings of all devices, including resumed ones.
+        """
+        if not self.digests:
+            return self.resumed
+        if len(self.digests) == 1 and not self.resumed.count:
+            return next(iter(self.digests.values()))
+        digest = TDigest(compression=self.compression)
+        digest.merge(self.resumed)
+        for item in self.digests.values():
+            digest.merge(item)
+        return digest
+
+    def device_path(self, device: t.Optional[str]) -> str:
+        # Colons of BLE addresses are not valid within file names on all platforms.
+        return self.path.replace("{device}", (device or "default").replace(":", "-"))
+
+    def device_digest(self, device: t.Optional[str]) -> TDigest:
+        digest = self.digests.get(device)
+        if digest is None:
+            digest = TDigest(compression=self.compression)
+            if self.per_device:
+                path = self.device_path(device)
+                if os.path.exists(path):
+                    digest = TDigest.load(path)
+                    logger.info(f"Resuming percentiles of {digest.count} readings from {path}")
+            self.digests[device] = digest
+        return digest
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        self.device_digest(reading.device).update(float(getattr(reading, self.field)))
+        if self.path is not None and self.metrics.received % self.save_each == 0:
+            self.save()
+        return reading
+
+    def save(self):
+        if self.per_device:
+            for device, digest in self.digests.items():
+                digest.save(self.device_path(device))
+        else:
+            self.digest.save(self.path)
+
+    async def close(self):
+        if self.path is not None and self.metrics.received:
+            self.save()
+
+
+class ProgressStage(PipelineStage):
+    """
+    Invoke a callback with the number of processed readings, each `each` readings.
+    """
+
+    name = "progress"
+
+    def __init__(self, callback: t.Callable[[int], None], each: int = 25, name: t.Optional[str] = None):
+        super().__init__(name=name)
+        self.callback = callback
+        self.each = each
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        if self.metrics.received % self.each == 0:
+            self.callback(self.metrics.received)
+        return reading
+
+
+class Sink(PipelineStage):
+    """
+    Base class for sinks, which consume readings without changing them. Override `send`.
+    """
+
+    name = "sink"
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        self.send(reading)
+        return reading
+
+    def send(self, reading: CalypsoReading):
+        raise NotImplementedError
+
+    def send_batch(self, readings: t.List[CalypsoReading]):
+        for reading in readings:
+            self.send(reading)
+
+
+class StdoutSink(Sink):
+    """
+    Dump readings to STDOUT, in JSON format.
+    """
+
+    name = "stdout"
+
+    def send(self, reading: CalypsoReading):
+        reading.dump()
+
+
+class RecordingSink(Sink):
+    """
+    Record readings to a file in JSON Lines format, including their receive timestamp.
+
+    Writes are buffered. Each `sync_each` readings, and when closing, the file is flushed
+    and synced to disk, so a power loss will lose at most that many readings.
+    """
+
+    name = "record"
+
+    def __init__(self, path: str, sync_each: int = 100, name: t.Optional[str] = None):
+        super().__init__(name=name)
+        if sync_each < 1:
+            raise ValueError(f"Sync interval must be a positive number: {sync_each}")
+        self.path = path
+        self.sync_each = sync_each
+        self.file: t.Optional[t.TextIO] = None
+        self.pending = 0
+
+    def send(self, reading: CalypsoReading):
+        if self.file is None:
+            self.file = open(self.path, "a")
+        data = reading.asdict()
+        data["time"] = reading.received_time
+        self.file.write(json.dumps(data) + "\n")
+        self.pending += 1
+        if self.pending >= self.sync_each:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush buffered readings, and sync them to disk.
+        """
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    async def close(self):
+        if self.file is None:
+            return
+        self.sync()
+        self.file.close()
+        self.file = None
+
+
+class TelemetrySink(Sink):
+    """
+    Submit readings using a `calypso_anemometer.telemetry.adapter.TelemetryAdapter`.
+    """
+
+    name = "telemetry"
+
+    def __init__(self, telemetry, name: t.Optional[str] = None):
+        super().__init__(name=name)
+        self.telemetry = telemetry
+        # Optionally record latencies, see `calypso_anemometer.metrics.EngineMetrics`.
+        self.render_latency = None
+        self.send_latency = None
+        # Optionally trace latencies, see `calypso_anemometer.tracing.Tracer`.
+        self.tracer = None
+
+    async def close(self):
+        self.telemetry.close()
+
+    def send(self, reading: CalypsoReading):
+        if self.render_latency is None and self.tracer is None:
+            self.telemetry.submit(reading)
+            return
+        started = time.monotonic()
+        payload = self.telemetry.prepare(reading).render()
+        rendered = time.monotonic()
+        self.telemetry.send(payload)
+        sent = time.monotonic()
+        if self.render_latency is not None:
+            self.render_latency.observe(rendered - started)
+            self.send_latency.observe(sent - rendered)
+        if self.tracer is not None:
+            self.tracer.record("render", rendered - started)
+            self.tracer.record("send", sent - rendered)
+            self.tracer.record_since("total", reading, now=sent)
+
+
+class FanOutStage(PipelineStage):
+    """
+    Hand over each reading to all sinks. A failing sink will not affect the others.
+    """
+
+    name = "fanout"
+
+    ERROR_LOG_EACH = 100
+
+    def __init__(self, sinks: t.Optional[t.List[PipelineStage]] = None, name: t.Optional[str] = None):
+        super().__init__(name=name)
+        self.sinks: t.List[PipelineStage] = list(sinks or [])
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        for sink in self.sinks:
+            try:
+                sink(reading)
+            except Exception:
+                if sink.metrics.errors % self.ERROR_LOG_EACH == 1:
+                    logger.exception(f"Sink '{sink.name}' failed. Errors: {sink.metrics.errors}")
+        return reading
+
+    async def close(self):
+        for sink in self.sinks:
+            await close_stage(sink)
+
+
+class ReloadableStage(PipelineStage):
+    """
+    Run readings through an inner pipeline, which can be replaced at runtime without
+    interrupting the stream of readings, for example when reloading a configuration file.
+    """
+
+    name = "reloadable"
+
+    def __init__(self, pipeline: "Pipeline", name: t.Optional[str] = None):
+        super().__init__(name=name)
+        self.pipeline = pipeline
+        # Optionally trace latencies, see `calypso_anemometer.tracing.Tracer`.
+        self.tracer = None
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        return self.pipeline.process(reading)
+
+    def replace(self, pipeline: "Pipeline") -> "Pipeline":
+        """
+        Swap the inner pipeline, and return the previous one. The caller is responsible for closing it.
+        """
+        if self.tracer is not None:
+            self.tracer.instrument(pipeline)
+        previous, self.pipeline = self.pipeline, pipeline
+        return previous
+
+    async def close(self):
+        await self.pipeline.close()
+
+
+class Pipeline:
+    """
+    Run readings through a sequence of stages. Instances can be used as callback for `subscribe_reading`.
+
+    :param stages: The stages, in order of processing.
+    """
+
+    def __init__(self, stages: t.Optional[t.List[PipelineStage]] = None):
+        self.stages: t.List[PipelineStage] = list(stages or [])
+        self.closed = False
+
+    def __call__(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        return self.process(reading)
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        for stage in self.stages:
+            reading = stage(reading)
+            if reading is None:
+                return None
+        return reading
+
+    def add(self, stage: PipelineStage, before: t.Optional[str] = None) -> "Pipeline":
+        """
+        Append a stage, or insert it before the stage with the given name.
+        """
+        if before is None:
+            self.stages.append(stage)
+        else:
+            self.stages.insert(self.stages.index(self[before]), stage)
+        return self
+
+    def remove(self, name: str) -> PipelineStage:
+        stage = self[name]
+        self.stages.remove(stage)
+        return stage
+
+    def __getitem__(self, name: str) -> PipelineStage:
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(f"Pipeline stage not found: {name}")
+
+    def walk(self) -> t.Iterator[PipelineStage]:
+        """
+        Iterate all stages, including the sinks of fan-out stages, and the stages of reloadable pipelines.
+        """
+        for stage in self.stages:
+            yield stage
+            if isinstance(stage, FanOutStage):
+                yield from stage.sinks
+            elif isinstance(stage, ReloadableStage):
+                yield from stage.pipeline.walk()
+
+    async def close(self):
+        """
+        Close all stages. Calling it again is a no-op, so handlers shared by multiple devices can invoke it safely.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for stage in self.stages:
+            await close_stage(stage)
+
+    def asdict(self):
+        return {stage.name: stage.metrics.asdict() for stage in self.walk()}
+
+
+async def close_stage(stage: PipelineStage):
+    """
+    Close a stage, logging errors instead of raising them, so all other stages will be closed.
+    """
+    try:
+        result = stage.close()
+        if inspect.isawaitable(result):
+            await result
+    except Exception:
+        logger.exception(f"Closing pipeline stage '{stage.name}' failed")
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Profile CLI commands, in order to obtain real profiles from field deployments.
+
+Two profilers are available:
+
+- `cprofile`: Deterministic profiling using `cProfile`. Writes a `pstats` file,
+  which can be inspected using `python -m pstats`, or visualized using `snakeviz`.
+- `sampling`: Sample the stack of the main thread at a fixed interval. Its overhead
+  does not depend on the number of function calls, so it is suitable for low-power
+  computers. Writes a file of collapsed stacks, which can be rendered using
+  `flamegraph.pl` or `speedscope`.
+
+Profiling stops after a fixed duration, or after a number of processed readings,
+whatever comes first. Then, the command is cancelled, and shuts down gracefully.
+"""
+import asyncio
+import collections
+import io
+import logging
+import os
+import sys
+import threading
+import time
+import typing as t
+
+from calypso_anemometer.pipeline import PipelineStage, ProgressStage
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ["cprofile", "sampling"]
+
+
+class SamplingProfiler:
+    """
+    Periodically sample the stack of the thread which started the profiler.
+
+    :param interval: The sampling interval, in seconds.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: t.Counter[t.Tuple[str, ...]] = collections.Counter()
+        self.samples = 0
+        self.thread_id: t.Optional[int] = None
+        self.thread: t.Optional[threading.Thread] = None
+        self.running = threading.Event()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="calypso-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running.is_set():
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.stacks[self.collapse(frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def collapse(frame) -> t.Tuple[str, ...]:
+        """
+        Convert a frame into a stack of function labels, outermost first.
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def dump(self, path: str):
+        """
+        Write collapsed stacks, one per line, followed by the number of samples.
+        """
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def summary(self, limit: int = 20) -> str:
+        """
+        List the functions most often found on top of the stack, and their share of all samples.
+        """
+        hottest: t.Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            hottest[stack[-1]] += count
+        lines = [f"{'samples':>8} {'share':>7}  function"]
+        for label, count in hottest.most_common(limit):
+            lines.append(f"{count:>8} {count / self.samples:>7.1%}  {label}")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """
+    Wrap the execution of a CLI command into a profiler, and write the profile afterwards.
+
+    :param path: Where to write the profile to.
+    :param mode: One of `cprofile` or `sampling`.
+    :param duration: Stop after this number of seconds.
+    :param readings: Stop after this number of processed readings.
+    :param interval: The sampling interval of the `sampling` profiler, in seconds.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str = "cprofile",
+        duration: t.Optional[float] = None,
+        readings: t.Optional[int] = None,
+        interval: float = 0.005,
+    ):
+        if mode == "cprofile":
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+        elif mode == "sampling":
+            self.profiler = SamplingProfiler(interval=interval)
+        else:
+            raise ValueError(f"Unknown profiler: {mode}")
+        self.path = path
+        self.mode = mode
+        self.duration = duration
+        self.readings = readings
+        self.done: t.Optional[asyncio.Event] = None
+
+    def __enter__(self):
+        logger.info(f"Profiling using {self.mode}")
+        if self.mode == "cprofile":
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.mode == "cprofile":
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
+        else:
+            self.profiler.stop()
+            self.profiler.dump(self.path)
+        logger.info(f"Wrote profile to {self.path}")
+
+    def stages(self) -> t.List[PipelineStage]:
+        """
+        Pipeline stages for stopping after a number of readings.
+        """
+        if self.readings is None:
+            return []
+        return [ProgressStage(callback=self.on_readings, each=self.readings, name="profile")]
+
+    def on_readings(self, count: int):
+        logger.info(f"Stopping profiler after {count} readings")
+        if self.done is not None:
+            self.done.set()
+
+    async def run(self, coro: t.Awaitable):
+        """
+        Run the command, cancelling it when the duration or the number of readings has been reached.
+        """
+        self.done = asyncio.Event()
+        task = asyncio.ensure_future(coro)
+        waiter = asyncio.ensure_future(self.done.wait())
+        try:
+            await asyncio.wait([task, waiter], timeout=self.duration, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        if task.done():
+            return task.result()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return None
+
+    def summary(self, limit: int = 20) -> str:
+        """
+        A short text summary of the hottest functions.
+        """
+        if self.mode == "sampling":
+            return self.profiler.summary(limit=limit)
+        import pstats
+
+        buffer = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=buffer)
+        stats.strip_dirs().sort_stats(pstats.SortKey.TIME).print_stats(limit)
+        return buffer.getvalue().strip()
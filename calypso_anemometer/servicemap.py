@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Plain snapshot of the GATT service map of a device, as resolved by Bleak when connecting.
+
+It includes handles and properties, so characteristics and descriptors can be
+read by handle, without walking the services again.
+"""
+import dataclasses
+import typing as t
+
+
+@dataclasses.dataclass
+class GattDescriptor:
+    uuid: str
+    handle: int
+    description: str = ""
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle}): {self.description}"
+
+
+@dataclasses.dataclass
+class GattCharacteristic:
+    uuid: str
+    handle: int
+    description: str = ""
+    properties: t.List[str] = dataclasses.field(default_factory=list)
+    descriptors: t.List[GattDescriptor] = dataclasses.field(default_factory=list)
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle}): {self.description}"
+
+
+@dataclasses.dataclass
+class GattService:
+    uuid: str
+    handle: int
+    description: str = ""
+    characteristics: t.List[GattCharacteristic] = dataclasses.field(default_factory=list)
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle}): {self.description}"
+
+
+@dataclasses.dataclass
+class GattServiceMap:
+    services: t.List[GattService] = dataclasses.field(default_factory=list)
+
+    @classmethod
+    def from_bleak(cls, services) -> "GattServiceMap":
+        """
+        Convert from Bleak's `BleakGATTServiceCollection`.
+        """
+        return cls(
+            services=[
+                GattService(
+                    uuid=service.uuid,
+                    handle=service.handle,
+                    description=service.description,
+                    characteristics=[
+                        GattCharacteristic(
+                            uuid=char.uuid,
+                            handle=char.handle,
+                            description=char.description,
+                            properties=list(char.properties),
+                            descriptors=[
+                                GattDescriptor(
+                                    uuid=descriptor.uuid,
+                                    handle=descriptor.handle,
+                                    description=descriptor.description,
+                                )
+                                for descriptor in char.descriptors
+                            ],
+                        )
+                        for char in service.characteristics
+                    ],
+                )
+                for service in services
+            ]
+        )
+
+    def asdict(self):
+        return dataclasses.asdict(self)
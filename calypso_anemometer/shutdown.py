@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Shut down in an orderly manner when receiving SIGTERM or SIGINT.
+
+Buffered readings must not get lost when a service manager like systemd stops
+the program. Shutting down takes these steps, in order:
+
+1. Stop receiving readings, using `unsubscribe_reading`.
+2. Drain the reading queue into the pipeline, within a deadline.
+3. Close the pipeline, which flushes buffering sinks, and syncs recordings to disk.
+4. Disconnect from the device, when leaving the workhorse context.
+
+Readings which were still buffered are accounted for at each buffer they pass,
+i.e. the reading queue and each buffering sink. Sending the signal again will
+terminate the program immediately.
+"""
+import asyncio
+import dataclasses
+import logging
+import signal
+import time
+import typing as t
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class ShutdownReport:
+    """
+    How many buffered readings were flushed, and how many were dropped when shutting down. Durations are in seconds.
+    """
+
+    flushed: int = 0
+    dropped: int = 0
+    duration: float = 0.0
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+    def __str__(self):
+        return f"flushed={self.flushed}, dropped={self.dropped}, duration={self.duration:.3f}s"
+
+
+class ShutdownSignal:
+    """
+    Wait for SIGTERM or SIGINT, in order to shut down in an orderly manner. Not available on Windows.
+    """
+
+    SIGNALS = ["SIGTERM", "SIGINT"]
+
+    def __init__(self):
+        self.event: t.Optional[asyncio.Event] = None
+        self.signals: t.List[int] = []
+
+    @property
+    def requested(self) -> bool:
+        return self.event is not None and self.event.is_set()
+
+    def install(self):
+        """
+        Install signal handlers. Calling it again is a no-op, so handlers shared by multiple devices can invoke it.
+        """
+        if self.event is None:
+            self.event = asyncio.Event()
+        if self.signals or self.requested:
+            return
+        loop = asyncio.get_event_loop()
+        for name in self.SIGNALS:
+            signum = getattr(signal, name, None)
+            if signum is None:  # pragma: no cover
+                continue
+            try:
+                loop.add_signal_handler(signum, self.trigger, signum)
+            except (NotImplementedError, RuntimeError, ValueError) as ex:  # pragma: no cover
+                logger.warning(f"Unable to shut down gracefully on signal {name}: {ex}")
+                continue
+            self.signals.append(signum)
+
+    def remove(self):
+        loop = asyncio.get_event_loop()
+        for signum in self.signals:
+            loop.remove_signal_handler(signum)
+        self.signals.clear()
+
+    def trigger(self, signum: t.Optional[int] = None):
+        """
+        Request shutdown. Signal handlers are removed, so sending the signal again takes the default action.
+        """
+        if self.event is None:
+            self.event = asyncio.Event()
+        if signum is not None:
+            logger.info(f"Received signal {signal.Signals(signum).name}, shutting down. Send again to terminate")
+        self.remove()
+        self.event.set()
+
+    async def run_until_requested(self, coro: t.Awaitable) -> asyncio.Future:
+        """
+        Run the subscription until shutdown is requested, and return its task.
+
+        Subscribing to a real device returns immediately, while the fake device produces readings
+        until it is unsubscribed. When the subscription fails, the error is propagated.
+        """
+        if self.event is None:
+            self.event = asyncio.Event()
+        task = asyncio.ensure_future(coro)
+        waiter = asyncio.ensure_future(self.event.wait())
+        try:
+            await asyncio.wait([task, waiter], return_when=asyncio.FIRST_COMPLETED)
+            if not waiter.done():
+                task.result()
+                await waiter
+        except BaseException:
+            task.cancel()
+            raise
+        finally:
+            waiter.cancel()
+        return task
+
+
+async def unsubscribe(device, subscription: t.Optional[asyncio.Future] = None, timeout: t.Optional[float] = None):
+    """
+    Stop receiving readings from the device, and stop the subscription task.
+    """
+    try:
+        await asyncio.wait_for(device.unsubscribe_reading(), timeout=timeout)
+    except asyncio.CancelledError:
+        raise
+    except Exception as ex:
+        message = str(ex) or ex.__class__.__name__
+        logger.warning(f"Unsubscribing failed: {message}")
+    if subscription is not None and not subscription.done():
+        subscription.cancel()
+        await asyncio.gather(subscription, return_exceptions=True)
+
+
+def pending(pipeline: Pipeline) -> int:
+    """
+    The number of readings buffered within the stages of a pipeline.
+    """
+    return sum(getattr(stage, "pending", 0) for stage in pipeline.walk())
+
+
+async def drain(
+    pipeline: Pipeline, queue: t.Optional[ReadingQueue] = None, timeout: t.Optional[float] = None
+) -> ShutdownReport:
+    """
+    Drain the reading queue into the pipeline within `timeout` seconds, then close the pipeline.
+    """
+    report = ShutdownReport()
+    started = time.monotonic()
+    if queue is not None:
+        buffered = queue.depth
+        discarded = await queue.stop(drain_timeout=timeout)
+        report.flushed += buffered - discarded
+        report.dropped += discarded
+    buffered = pending(pipeline)
+    await pipeline.close()
+    discarded = pending(pipeline)
+    report.flushed += buffered - discarded
+    report.dropped += discarded
+    report.duration = time.monotonic() - started
+    return report
@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Running statistics about the stream of readings, and about the event loop.
+"""
+import asyncio
+import collections
+import heapq
+import json
+import math
+import os
+import time
+import typing as t
+
+
+def percentile(values: t.Sequence[float], fraction: float) -> t.Optional[float]:
+    """
+    Compute percentile of sequence, using the nearest-rank method.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def circular_mean(angles: t.Sequence[float], weights: t.Optional[t.Sequence[float]] = None) -> t.Optional[float]:
+    """
+    Compute the mean of angles in degrees, optionally weighted, within [0, 360).
+
+    Returns `None` when the mean vector vanishes, for example when all weights are zero.
+    """
+    if weights is None:
+        weights = [1.0] * len(angles)
+    x = sum(weight * math.cos(math.radians(angle)) for angle, weight in zip(angles, weights))  # noqa: B905
+    y = sum(weight * math.sin(math.radians(angle)) for angle, weight in zip(angles, weights))  # noqa: B905
+    if math.isclose(x, 0.0, abs_tol=1e-9) and math.isclose(y, 0.0, abs_tol=1e-9):
+        return None
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+class RunningMedian:
+    """
+    Median of the most recent `window` values, in O(log window) per value.
+
+    The lower half of the values is kept in a max-heap, the upper half in a min-heap.
+    Values leaving the window are deleted lazily, when they reach the top of a heap.
+    When too many of them pile up, both heaps are rebuilt, which amortizes to O(1).
+
+    :param window: The number of recent values to compute the median on.
+    """
+
+    def __init__(self, window: int):
+        if window < 1:
+            raise ValueError(f"Window must be a positive number: {window}")
+        self.window = window
+        self.recent: t.Deque[float] = collections.deque()
+        # The lower half is negated, in order to use `heapq` as a max-heap.
+        self.low: t.List[float] = []
+        self.high: t.List[float] = []
+        self.low_size = 0
+        self.high_size = 0
+        self.delayed: t.Counter[float] = collections.Counter()
+
+    def __len__(self):
+        return len(self.recent)
+
+    def push(self, value: float):
+        """
+        Add a value, evicting the oldest one when the window is full.
+        """
+        if not self.low or value <= -self.low[0]:
+            heapq.heappush(self.low, -value)
+            self.low_size += 1
+        else:
+            heapq.heappush(self.high, value)
+            self.high_size += 1
+        self.balance()
+        self.recent.append(value)
+        if len(self.recent) > self.window:
+            self.remove(self.recent.popleft())
+        # Evicted values buried within the heaps are never pruned, so rebuild them now and then.
+        if len(self.low) + len(self.high) > 2 * self.window + 16:
+            self.rebuild()
+
+    def rebuild(self):
+        """
+        Rebuild both heaps from the values within the window, dropping evicted values. O(window log window).
+        """
+        ordered = sorted(self.recent)
+        middle = (len(ordered) + 1) // 2
+        self.low = [-value for value in ordered[:middle]]
+        self.high = ordered[middle:]
+        heapq.heapify(self.low)
+        heapq.heapify(self.high)
+        self.low_size = len(self.low)
+        self.high_size = len(self.high)
+        self.delayed.clear()
+
+    def remove(self, value: float):
+        self.delayed[value] += 1
+        if value <= -self.low[0]:
+            self.low_size -= 1
+            if value == -self.low[0]:
+                self.prune(self.low, sign=-1)
+        else:
+            self.high_size -= 1
+            if value == self.high[0]:
+                self.prune(self.high, sign=1)
+        self.balance()
+
+    def balance(self):
+        """
+        Keep the lower half as large as the upper half, or larger by one.
+        """
+        if self.low_size > self.high_size + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.low_size -= 1
+            self.high_size += 1
+            self.prune(self.low, sign=-1)
+        elif self.low_size < self.high_size:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.low_size += 1
+            self.high_size -= 1
+            self.prune(self.high, sign=1)
+
+    def prune(self, heap: t.List[float], sign: int):
+        """
+        Pop values from the top of the heap which already left the window.
+        """
+        while heap:
+            value = sign * heap[0]
+            if not self.delayed[value]:
+                break
+            self.delayed[value] -= 1
+            if not self.delayed[value]:
+                del self.delayed[value]
+            heapq.heappop(heap)
+
+    @property
+    def median(self) -> t.Optional[float]:
+        if not self.recent:
+            return None
+        if self.low_size > self.high_size:
+            return -self.low[0]
+        return (-self.low[0] + self.high[0]) / 2
+
+
+class ArrivalStatistics:
+    """
+    Running inter-arrival statistics of readings.
+
+    Jitter is the absolute deviation of an interval from the expected interval, which is derived
+    from the configured data rate. Percentiles are computed over a sliding window of intervals,
+    while count, mean, and missed intervals account for the whole lifetime.
+
+    :param expected_interval: The expected interval between two readings, in seconds.
+    :param window: The number of recent intervals to compute percentiles on.
+    """
+
+    def __init__(self, expected_interval: float = 0.25, window: int = 1024):
+        self.expected_interval = expected_interval
+        self.intervals: t.Deque[float] = collections.deque(maxlen=window)
+        self.count = 0
+        self.interval_sum = 0.0
+        self.missed = 0
+        self.last: t.Optional[float] = None
+
+    def update(self, timestamp: float):
+        """
+        Account for a reading received at the given monotonic timestamp.
+        """
+        self.count += 1
+        if self.last is not None:
+            interval = timestamp - self.last
+            self.intervals.append(interval)
+            self.interval_sum += interval
+            # Each full expected interval beyond the first one is a missed reading.
+            missed = round(interval / self.expected_interval) - 1
+            if missed > 0:
+                self.missed += missed
+        self.last = timestamp
+
+    @property
+    def mean(self) -> t.Optional[float]:
+        if self.count < 2:
+            return None
+        return self.interval_sum / (self.count - 1)
+
+    def jitter(self, fraction: float) -> t.Optional[float]:
+        return percentile([abs(interval - self.expected_interval) for interval in self.intervals], fraction)
+
+    def asdict(self):
+        return {
+            "count": self.count,
+            "expected_interval": self.expected_interval,
+            "mean_interval": self.mean,
+            "jitter_p50": self.jitter(0.50),
+            "jitter_p99": self.jitter(0.99),
+            "missed": self.missed,
+        }
+
+    def __str__(self):
+        def fmt(value):
+            return "n/a" if value is None else f"{value * 1000:.1f}ms"
+
+        return (
+            f"mean_interval={fmt(self.mean)}, jitter_p50={fmt(self.jitter(0.50))}, "
+            f"jitter_p99={fmt(self.jitter(0.99))}, missed={self.missed}"
+        )
+
+
+class LoopLagProbe:
+    """
+    Measure the responsiveness of the event loop.
+
+    A task sleeps for `interval` seconds repeatedly, and records by how much it oversleeps.
+    When callbacks hog the event loop, the lag will grow, and so will the latency of
+    all other tasks, like receiving BLE notifications.
+
+    :param interval: How often to probe, in seconds.
+    :param window: The number of recent samples to compute percentiles on.
+    """
+
+    def __init__(self, interval: float = 0.1, window: int = 1024):
+        self.interval = interval
+        self.samples: t.Deque[float] = collections.deque(maxlen=window)
+        self.count = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self.task: t.Optional[asyncio.Future] = None
+
+    def start(self):
+        """
+        Start probing. Calling it again while running is a no-op, so a probe can be shared.
+        """
+        if self.task is not None and not self.task.done():
+            return
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.update(time.monotonic() - started - self.interval)
+
+    def update(self, lag: float):
+        lag = max(0.0, lag)
+        self.count += 1
+        self.lag_sum += lag
+        self.lag_max = max(self.lag_max, lag)
+        self.samples.append(lag)
+
+    @property
+    def mean(self) -> t.Optional[float]:
+        if not self.count:
+            return None
+        return self.lag_sum / self.count
+
+    def asdict(self):
+        return {
+            "count": self.count,
+            "lag_mean": self.mean,
+            "lag_p50": percentile(self.samples, 0.50),
+            "lag_p99": percentile(self.samples, 0.99),
+            "lag_max": self.lag_max if self.count else None,
+        }
+
+    def __str__(self):
+        def fmt(value):
+            return "n/a" if value is None else f"{value * 1000:.1f}ms"
+
+        data = self.asdict()
+        return (
+            f"lag_mean={fmt(data['lag_mean'])}, lag_p50={fmt(data['lag_p50'])}, "
+            f"lag_p99={fmt(data['lag_p99'])}, lag_max={fmt(data['lag_max'])}"
+        )
+
+
+class HdrHistogram:
+    """
+    Record durations into a histogram with a fixed relative precision, like HdrHistogram.
+
+    Values are counted in integer units of `resolution` seconds, within log-linear buckets:
+    each power of two is divided into the same number of linear sub-buckets. This keeps
+    recording cheap and memory bounded, while percentiles are accurate to `significant_figures`
+    decimal digits, from microseconds up to minutes. Minimum, maximum, and mean are exact.
+
+    :param resolution: The smallest distinguishable duration, in seconds.
+    :param significant_figures: The relative precision of recorded values, in decimal digits.
+    """
+
+    def __init__(self, resolution: float = 1e-6, significant_figures: int = 2):
+        if not 1 <= significant_figures <= 5:
+            raise ValueError(f"Significant figures must be between 1 and 5: {significant_figures}")
+        self.resolution = resolution
+        self.significant_figures = significant_figures
+        # Number of sub-buckets needed to tell apart values which differ in the last significant digit.
+        self.sub_bucket_bits = math.ceil(math.log2(2 * 10**significant_figures))
+        self.sub_bucket_mask = (1 << self.sub_bucket_bits) - 1
+        self.half_count_bits = self.sub_bucket_bits - 1
+        self.half_count = 1 << self.half_count_bits
+        self.counts: t.Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min: t.Optional[float] = None
+        self.max: t.Optional[float] = None
+
+    def record(self, value: float):
+        """
+        Account for a duration, in seconds. Negative values are clamped to zero.
+        """
+        value = max(0.0, value)
+        units = int(value / self.resolution)
+        bucket = max(0, (units | self.sub_bucket_mask).bit_length() - self.sub_bucket_bits)
+        index = ((bucket + 1) << self.half_count_bits) + (units >> bucket) - self.half_count
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def value_at_index(self, index: int) -> float:
+        """
+        The highest value which is recorded into the sub-bucket at the given index, in seconds.
+        """
+        bucket = (index >> self.half_count_bits) - 1
+        sub_bucket = (index & (self.half_count - 1)) + self.half_count
+        if bucket < 0:
+            sub_bucket -= self.half_count
+            bucket = 0
+        return (((sub_bucket + 1) << bucket) - 1) * self.resolution
+
+    def percentile(self, fraction: float) -> t.Optional[float]:
+        """
+        Compute percentile using the nearest-rank method. Never exceeds the maximum recorded value.
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.value_at_index(index), self.max)
+        return self.max  # pragma: no cover
+
+    @property
+    def mean(self) -> t.Optional[float]:
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def reset(self):
+        self.counts.clear()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def asdict(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.mean,
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max,
+        }
+
+
+class TDigest:
+    """
+    Estimate percentiles of an unbounded stream of values in bounded memory, using a merging t-digest.
+
+    Values are buffered, and merged into a sorted list of centroids, i.e. weighted means,
+    when the buffer is full. Centroids near the tails hold few values, so extreme percentiles
+    like p99 stay accurate, while the number of centroids is bounded by `compression`.
+    Digests can be merged, for example in order to combine daily digests to seasonal ones,
+    without going back to the recorded values. Count, minimum, maximum, and mean are exact.
+
+    - https://arxiv.org/abs/1902.04023
+
+    :param compression: Trade memory for accuracy. The number of centroids stays below this value.
+    """
+
+    def __init__(self, compression: float = 100.0):
+        if compression < 10:
+            raise ValueError(f"Compression must be at least 10: {compression}")
+        self.compression = compression
+        self.buffer_size = int(5 * compression)
+        self.centroids: t.List[t.Tuple[float, float]] = []
+        self.buffer: t.List[float] = []
+        self.count = 0
+        self.total = 0.0
+        self.min: t.Optional[float] = None
+        self.max: t.Optional[float] = None
+
+    def update(self, value: float):
+        """
+        Account for a value. Amortized O(log compression).
+        """
+        self.buffer.append(value)
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+
+    def merge(self, other: "TDigest"):
+        """
+        Account for all values of another digest.
+        """
+        if not other.count:
+            return
+        self.centroids = self.merge_centroids(
+            sorted(self.centroids + other.centroids + [(value, 1.0) for value in self.buffer + other.buffer])
+        )
+        self.buffer = []
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def compress(self):
+        """
+        Merge buffered values into the centroids.
+        """
+        if not self.buffer:
+            return
+        self.centroids = self.merge_centroids(sorted(self.centroids + [(value, 1.0) for value in self.buffer]))
+        self.buffer = []
+
+    def merge_centroids(self, centroids: t.List[t.Tuple[float, float]]) -> t.List[t.Tuple[float, float]]:
+        """
+        Merge adjacent centroids of a sorted list, as long as each stays within one unit of the scale function.
+        """
+        total = sum(weight for _, weight in centroids)
+        merged = []
+        mean, weight = centroids[0]
+        # Quantile of the left edge of the current centroid, and the limit of its right edge.
+        left = 0.0
+        limit = self.quantile_limit(left)
+        for next_mean, next_weight in centroids[1:]:
+            if left + (weight + next_weight) / total <= limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                merged.append((mean, weight))
+                left += weight / total
+                limit = self.quantile_limit(left)
+                mean, weight = next_mean, next_weight
+        merged.append((mean, weight))
+        return merged
+
+    def quantile_limit(self, quantile: float) -> float:
+        """
+        The quantile one unit above the given one, on the scale function `k(q) = compression / 2π * asin(2q - 1)`.
+        """
+        k = self.compression / (2 * math.pi) * math.asin(max(-1.0, min(1.0, 2 * quantile - 1)))
+        k += 1
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def percentile(self, fraction: float) -> t.Optional[float]:
+        """
+        Estimate percentile, interpolating between the centers of adjacent centroids.
+        """
+        if not self.count:
+            return None
+        self.compress()
+        centroids = self.centroids
+        target = fraction * self.count
+        first_mean, first_weight = centroids[0]
+        if target < first_weight / 2:
+            if first_weight == 1:
+                return self.min
+            return self.min + (first_mean - self.min) * target / (first_weight / 2)
+        seen = 0.0
+        for (mean, weight), (next_mean, next_weight) in zip(centroids, centroids[1:]):  # noqa: B905
+            center = seen + weight / 2
+            next_center = seen + weight + next_weight / 2
+            if target < next_center:
+                # Centroids holding a single value represent it exactly, using the nearest rank.
+                if weight == 1 and target <= seen + weight:
+                    return mean
+                if next_weight == 1 and target >= seen + weight:
+                    return next_mean
+                return mean + (next_mean - mean) * (target - center) / (next_center - center)
+            seen += weight
+        last_mean, last_weight = centroids[-1]
+        if last_weight == 1:
+            return self.max
+        remaining = self.count - (seen + last_weight / 2)
+        return last_mean + (self.max - last_mean) * min(1.0, (target - seen - last_weight / 2) / remaining)
+
+    @property
+    def mean(self) -> t.Optional[float]:
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def serialize(self) -> t.Dict[str, t.Any]:
+        """
+        The state of the digest, for storing it in JSON format.
+        """
+        self.compress()
+        return {
+            "compression": self.compression,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "centroids": [[mean, weight] for mean, weight in self.centroids],
+        }
+
+    @classmethod
+    def deserialize(cls, data: t.Dict[str, t.Any]) -> "TDigest":
+        try:
+            digest = cls(compression=data["compression"])
+            digest.centroids = [(float(mean), float(weight)) for mean, weight in data["centroids"]]
+            digest.count = int(data["count"])
+            digest.total = float(data["total"])
+            digest.min = data["min"]
+            digest.max = data["max"]
+        except (KeyError, TypeError, ValueError) as ex:
+            raise ValueError(f"Invalid digest: {ex}") from ex
+        return digest
+
+    @classmethod
+    def load(cls, path: str) -> "TDigest":
+        with open(path, "r") as f:
+            return cls.deserialize(json.load(f))
+
+    def save(self, path: str):
+        """
+        Write the digest to a file in JSON format. The file is replaced atomically.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.serialize(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def asdict(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.mean,
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+    def __str__(self):
+        def fmt(value):
+            return "n/a" if value is None else f"{value:.2f}"
+
+        data = self.asdict()
+        return f"p50={fmt(data['p50'])}, p90={fmt(data['p90'])}, p99={fmt(data['p99'])}, max={fmt(data['max'])}"
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Keep the conversation with the Calypso UP10 alive, even when the BLE link drops.
+
+Instead of exiting the program and relying on systemd to restart it, the supervisor
+reconnects to the device in-process, restores its settings, and resumes the
+subscription. The callback receiving readings, and with it all telemetry sinks,
+stays untouched while the link is down.
+"""
+import asyncio
+import dataclasses
+import logging
+import random
+import time
+import typing as t
+
+from bleak import BleakError
+
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.exception import CalypsoError
+from calypso_anemometer.model import Settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class SupervisorMetrics:
+    """
+    Bookkeeping about link losses and reconnects. All durations are in seconds.
+
+    - `reconnect_latency`: Time from detecting the link loss until the device is connected again.
+    - `gap_duration`: Time from detecting the link loss until readings are subscribed again.
+    """
+
+    disconnects: int = 0
+    reconnects: int = 0
+    reconnect_attempts: int = 0
+    last_reconnect_latency: t.Optional[float] = None
+    last_gap_duration: t.Optional[float] = None
+    total_gap_duration: float = 0.0
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+
+def backoff_delay(attempt: int, initial: float, maximum: float, jitter: float) -> float:
+    """
+    Compute exponential backoff delay for the given attempt number, starting at 1.
+
+    A random fraction of up to `jitter` is subtracted from the delay, in order to
+    prevent multiple gateways from hammering the BLE stack in lockstep.
+    """
+    delay = min(maximum, initial * 2 ** (attempt - 1))
+    return delay * (1 - jitter * random.random())  # noqa: S311
+
+
+class CalypsoDeviceSupervisor:
+    """
+    Wrap a workhorse instance and transparently reconnect it after link loss.
+
+    All other attributes are delegated to the wrapped workhorse, so the
+    supervisor can be used as a drop-in replacement within `run_engine`.
+    """
+
+    def __init__(
+        self,
+        settings: t.Optional[Settings] = None,
+        workhorse: t.Type = CalypsoDeviceApi,
+        backoff_initial: float = 0.5,
+        backoff_maximum: float = 30.0,
+        backoff_jitter: float = 0.5,
+    ):
+        self.device = workhorse(settings=settings)
+        self.device.disconnected_callback = self.on_disconnected
+        self.backoff_initial = backoff_initial
+        self.backoff_maximum = backoff_maximum
+        self.backoff_jitter = backoff_jitter
+        self.metrics = SupervisorMetrics()
+
+        self.loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self.reconnect_task: t.Optional[asyncio.Future] = None
+        self.subscription: t.Optional[t.Tuple[t.Optional[t.Callable], t.Dict[str, t.Any]]] = None
+        self.disconnected_at: t.Optional[float] = None
+        self.closing = False
+
+    def __getattr__(self, name):
+        if name == "device":
+            raise AttributeError(name)
+        return getattr(self.device, name)
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_event_loop()
+        self.closing = False
+        await self.device.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.closing = True
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        await self.device.__aexit__(exc_type, exc_val, exc_tb)
+
+    async def subscribe_reading(self, callback: t.Optional[t.Callable] = None, **kwargs):
+        """
+        Subscribe to readings, and remember the subscription for resuming it after reconnecting.
+        """
+        self.subscription = (callback, kwargs)
+        await self.device.subscribe_reading(callback, **kwargs)
+
+    async def unsubscribe_reading(self):
+        self.subscription = None
+        await self.device.unsubscribe_reading()
+
+    # Subscribe through the supervisor, in order to resume streaming after reconnecting.
+    stream = CalypsoDeviceApi.stream
+
+    def on_disconnected(self, client=None):
+        """
+        Receive the disconnect notification from Bleak, and start reconnecting.
+
+        Bleak may invoke this callback from a different thread, so hand over to the event loop.
+        """
+        if self.closing or self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.start_reconnect, client)
+
+    def start_reconnect(self, client=None):
+        if self.closing:
+            return
+        if self.reconnect_task is not None and not self.reconnect_task.done():
+            return
+        # Ignore late notifications about clients which have already been replaced.
+        if client is not None and client is not self.device.client:
+            return
+        logger.warning(f"Lost connection to device at '{self.device.ble_address}'")
+        self.metrics.disconnects += 1
+        self.disconnected_at = time.monotonic()
+        self.reconnect_task = asyncio.ensure_future(self.reconnect())
+        self.reconnect_task.add_done_callback(self.on_reconnect_done)
+
+    def on_reconnect_done(self, task: asyncio.Future):
+        """
+        Make sure the reconnect task does not die silently.
+        """
+        if task.cancelled():
+            return
+        ex = task.exception()
+        if ex is not None:
+            logger.critical(f"Reconnecting to device at '{self.device.ble_address}' failed permanently", exc_info=ex)
+
+    async def recycle(self):
+        """
+        Force a reconnect, even though the link looks alive. Used by the watchdog.
+        """
+        if self.reconnect_task is None or self.reconnect_task.done():
+            logger.warning(f"Recycling connection to device at '{self.device.ble_address}'")
+            self.metrics.disconnects += 1
+            self.disconnected_at = time.monotonic()
+            self.reconnect_task = asyncio.ensure_future(self.disconnect_reconnect())
+            self.reconnect_task.add_done_callback(self.on_reconnect_done)
+        await self.reconnect_task
+
+    async def disconnect_reconnect(self):
+        await self.device.disconnect()
+        await self.reconnect()
+
+    async def reconnect(self):
+        """
+        Reconnect to the device with jittered exponential backoff, restore its settings, and resubscribe.
+        """
+        attempt = 0
+        while not self.closing:
+            attempt += 1
+            self.metrics.reconnect_attempts += 1
+            logger.info(f"Reconnecting to device, attempt #{attempt}")
+            connected = False
+            try:
+                await self.device.connect()
+                connected = True
+                self.metrics.last_reconnect_latency = time.monotonic() - self.disconnected_at
+                await self.restore()
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if isinstance(ex, (CalypsoError, BleakError)):
+                    message = str(ex)
+                else:
+                    message = f"{ex.__class__.__name__}: {ex}"
+                    logger.exception("Reconnecting failed unexpectedly")
+                # Do not leave a half-initialized connection behind, when restoring the settings failed.
+                if connected:
+                    await self.device.disconnect()
+                delay = backoff_delay(attempt, self.backoff_initial, self.backoff_maximum, self.backoff_jitter)
+                logger.warning(f"Reconnecting failed: {message}. Retrying in {delay:.2f} seconds")
+                await asyncio.sleep(delay)
+        else:  # pragma: no cover
+            return
+
+        gap_duration = time.monotonic() - self.disconnected_at
+        self.metrics.reconnects += 1
+        self.metrics.last_gap_duration = gap_duration
+        self.metrics.total_gap_duration += gap_duration
+        logger.info(
+            f"Reconnected to device. "
+            f"Reconnect latency: {self.metrics.last_reconnect_latency:.3f}s, gap duration: {gap_duration:.3f}s"
+        )
+
+    async def restore(self):
+        """
+        Restore device settings and subscription after reconnecting.
+        """
+        if self.device.mode is not None:
+            await self.device.set_mode(self.device.mode)
+        if self.device.datarate is not None:
+            await self.device.set_datarate(self.device.datarate)
+        if self.device.compass is not None:
+            await self.device.set_compass(self.device.compass)
+        if self.subscription is not None:
+            callback, kwargs = self.subscription
+            await self.device.subscribe_reading(callback, **kwargs)
@@ -56,16 +56,30 @@ class TelemetryAdapter:
             )
 
     def submit(self, reading: CalypsoReading):
+        bucket = self.prepare(reading)
+        self.send(bucket.render())
+        return bucket
+
+    def prepare(self, reading: CalypsoReading) -> t.Union[SignalKDeltaMessage, Nmea0183Envelope]:
+        """
+        Convert reading into the message format of the telemetry protocol.
+        """
         if self.handler is None:
             raise KeyError("No telemetry handler established")
         if self.protocol == TelemetryProtocol.UDP_SIGNALK_DELTA:
             # TODO: Parameterize `source` and `location`.
             bucket = SignalKDeltaMessage(source="Calypso UP10", location="Mast")
             bucket.set_reading(reading)
-            self.handler.send(bucket.render())
             return bucket
         elif self.protocol == TelemetryProtocol.UDP_BROADCAST_NMEA0183:
             bucket = Nmea0183Envelope()
             bucket.set_reading(reading)
-            self.handler.send(bucket.render())
             return bucket
+        raise KeyError(f"NetworkProtocol {self.protocol} not supported")  # pragma: no cover
+
+    def send(self, payload: str):
+        self.handler.send(payload)
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
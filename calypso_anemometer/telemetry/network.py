@@ -46,3 +46,6 @@ class NetworkTelemetry:
             self.socket.close()
         elif self.protocol == NetworkProtocol.UDP:
             self.socket.sendto(payload, address)
+
+    def close(self):
+        self.socket.close()
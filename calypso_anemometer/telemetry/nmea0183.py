@@ -74,6 +74,28 @@ class Nmea0183GenericMessage:
         message += f"*{checksum}"
         return message
 
+    @classmethod
+    def parse(cls, sentence: str) -> "Nmea0183GenericMessage":
+        """
+        Parse NMEA-0183 sentence, the inverse of `render`. The checksum is verified when present.
+        """
+        sentence = sentence.strip()
+        if not sentence.startswith(("$", "!")):
+            raise ValueError(f"Invalid NMEA-0183 sentence: {sentence}")
+        message, _, checksum = sentence.partition("*")
+        if checksum and checksum.upper() != cls.checksum_hexlified(message):
+            raise ValueError(f"Invalid NMEA-0183 checksum: {sentence}")
+        identifier, *fields = message.split(",")
+        return cls(identifier=identifier, fields=fields)
+
+    @property
+    def talker(self) -> str:
+        return self.identifier[1:-3]
+
+    @property
+    def sentence_type(self) -> str:
+        return self.identifier[-3:]
+
     @classmethod
     def checksum(cls, message) -> int:
         """
@@ -205,6 +227,107 @@ class Nmea0183MessageVWR(Nmea0183MessageBase):
         )
 
 
+@dataclasses.dataclass
+class Nmea0183MessageMWV(Nmea0183MessageBase):
+    """
+    Represent and serialize NMEA-0183 MWV message.
+
+    MWV - Wind Speed and Angle
+
+    Here, it will be used to emit true wind, i.e. relative to the water.
+
+            1   2 3   4 5
+            |   | |   | |
+     $--MWV,x.x,a,x.x,a,a*hh<CR><LF>
+
+     Field Number:
+      1) Wind Angle, 0 to 359 degrees, relative to the bow
+      2) Reference, R = Relative, T = True
+      3) Wind Speed
+      4) Wind Speed Units, K/M/N
+      5) Status, A = Data Valid
+      6) Checksum
+
+    References:
+    - https://gpsd.gitlab.io/gpsd/NMEA.html#_mwv_wind_speed_and_angle
+    """
+
+    IDENTIFIER = "$MLMWV"
+    angle_degrees: float
+    speed_meters_per_second: float
+    reference: str = "T"
+
+    def to_message(self):
+        """
+        Factory for generic `Nmea0183Message`.
+        """
+        return Nmea0183GenericMessage(
+            identifier=self.IDENTIFIER,
+            fields=[
+                self.float_value(self.angle_degrees),
+                self.reference,
+                self.float_value(self.speed_meters_per_second),
+                "M",
+                "A",
+            ],
+        )
+
+
+@dataclasses.dataclass
+class Nmea0183MessageMWD(Nmea0183MessageBase):
+    """
+    Represent and serialize NMEA-0183 MWD message.
+
+    MWD - Wind Direction and Speed
+
+    Here, it will be used to emit ground wind, with its direction relative to true north.
+
+            1   2 3   4 5   6 7   8
+            |   | |   | |   | |   |
+     $--MWD,x.x,T,x.x,M,x.x,N,x.x,M*hh<CR><LF>
+
+     Field Number:
+      1) Wind Direction, 0 to 359 degrees, True
+      2) T = True
+      3) Wind Direction, 0 to 359 degrees, Magnetic
+      4) M = Magnetic
+      5) Wind Speed
+      6) N = Knots
+      7) Wind Speed
+      8) M = Meters Per Second
+      9) Checksum
+
+    References:
+    - https://gpsd.gitlab.io/gpsd/NMEA.html#_mwd_wind_direction_speed
+    """
+
+    IDENTIFIER = "$MLMWD"
+    direction_degrees: float
+    speed_meters_per_second: float
+
+    @property
+    def speed_knots(self) -> float:
+        return round(self.speed_meters_per_second * 1.943844, 2)
+
+    def to_message(self):
+        """
+        Factory for generic `Nmea0183Message`.
+        """
+        return Nmea0183GenericMessage(
+            identifier=self.IDENTIFIER,
+            fields=[
+                self.float_value(self.direction_degrees),
+                "T",
+                None,
+                "M",
+                self.float_value(self.speed_knots),
+                "N",
+                self.float_value(self.speed_meters_per_second),
+                "M",
+            ],
+        )
+
+
 @dataclasses.dataclass
 class Nmea0183MessageXDRGeneric(Nmea0183MessageBase):
     """
@@ -332,7 +455,7 @@ class Nmea0183Envelope:
 
     def set_reading(self, reading: CalypsoReading):
         """
-        Derive NMEA-0183 VWR message from measurement reading.
+        Derive NMEA-0183 messages from measurement reading.
         """
         reading = reading.adjusted()
         hdt = Nmea0183MessageHDT(
@@ -366,6 +489,23 @@ class Nmea0183Envelope:
             xdr_battery_level.to_message(),
         ]
 
+        # True wind and ground wind, when computed from boat motion.
+        # MWV with reference `T` means true wind, relative to the water, so ground wind never stands in for it.
+        # When only true wind is available, it stands in for the wind direction of MWD.
+        ground_wind = reading.ground_wind or reading.true_wind
+        if reading.true_wind is not None:
+            mwv = Nmea0183MessageMWV(
+                angle_degrees=reading.true_wind.angle,
+                speed_meters_per_second=reading.true_wind.speed,
+            )
+            self.items.append(mwv.to_message())
+        if ground_wind is not None:
+            mwd = Nmea0183MessageMWD(
+                direction_degrees=ground_wind.direction,
+                speed_meters_per_second=ground_wind.speed,
+            )
+            self.items.append(mwd.to_message())
+
     def aslist(self):
         """
         Render measurement items to multiple NMEA-0183 sentences.
@@ -6,9 +6,8 @@ import json
 import logging
 import typing as t
 
-from calypso_anemometer.core import CalypsoDeviceApi
-from calypso_anemometer.model import CalypsoReading
-from calypso_anemometer.util import celsius2kelvin, deg2rad
+from calypso_anemometer.model import DEVICE_NAME, CalypsoReading
+from calypso_anemometer.util import celsius2kelvin, deg2rad, to_iso8601
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +30,7 @@ class SignalKDeltaMessage:
     source: str
     location: str
     items: t.Optional[t.List[SignalKDeltaItem]] = None
+    timestamp: t.Optional[float] = None
 
     def set_reading(self, reading: CalypsoReading):
         """
@@ -41,6 +41,7 @@ class SignalKDeltaMessage:
         [1] https://github.com/maritime-labs/signalk-calypso-ultrasonic/blob/1.0.18/lib/calypso-ultrasonic.js#L446-L472
         """
         reading = reading.adjusted()
+        self.timestamp = reading.received_time
         self.items = [
             SignalKDeltaItem(path="environment.outside.temperature", value=celsius2kelvin(reading.temperature)),
             SignalKDeltaItem(path="environment.wind.angleApparent", value=deg2rad(reading.wind_direction)),
@@ -57,6 +58,21 @@ class SignalKDeltaMessage:
             ),
         ]
 
+        # True wind and ground wind, when computed from boat motion.
+        if reading.true_wind is not None:
+            self.items += [
+                SignalKDeltaItem(path="environment.wind.angleTrueWater", value=deg2rad(reading.true_wind.angle)),
+                SignalKDeltaItem(path="environment.wind.speedTrue", value=reading.true_wind.speed),
+            ]
+        if reading.ground_wind is not None:
+            self.items += [
+                SignalKDeltaItem(path="environment.wind.angleTrueGround", value=deg2rad(reading.ground_wind.angle)),
+                SignalKDeltaItem(path="environment.wind.speedOverGround", value=reading.ground_wind.speed),
+            ]
+        wind = reading.ground_wind or reading.true_wind
+        if wind is not None:
+            self.items.append(SignalKDeltaItem(path="environment.wind.directionTrue", value=deg2rad(wind.direction)))
+
     def asdict(self):
         """
         Create message in SignalK Delta Format [1,2],
@@ -68,14 +84,13 @@ class SignalKDeltaMessage:
         [3] https://github.com/itemir/rpi_boat_utils/blob/f639653/sensord/sensord.py#L58-L63
         [4] https://github.com/andyrbarrow/M5StickEngineTemp/blob/609109d/src/tempsensor.cpp#L83-L111
         """
-        data = {
-            "updates": [
-                {
-                    "$source": CalypsoDeviceApi.NAME,
-                    "values": list(map(SignalKDeltaItem.asdict, self.items)),
-                },
-            ]
+        update = {
+            "$source": DEVICE_NAME,
+            "values": list(map(SignalKDeltaItem.asdict, self.items)),
         }
+        if self.timestamp is not None:
+            update["timestamp"] = to_iso8601(self.timestamp)
+        data = {"updates": [update]}
         return data
 
     def render(self):
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Trace where time is spent between receiving a BLE notification and sending telemetry.
+
+All spans are measured using the monotonic clock, relative to the receive timestamp
+of each reading, i.e. the point in time when the BLE notification handler was invoked.
+
+- `decode`: Decoding the notification payload.
+- `pipeline`: Until the reading enters the processing pipeline, including waiting in the queue.
+- `render`: Rendering the telemetry message, i.e. NMEA-0183 sentences or a SignalK delta message.
+- `send`: Handing the telemetry message over to the network.
+- `total`: From the notification until the telemetry message is on the wire.
+
+Durations are recorded into HDR-style histograms. When tracing is disabled, no tracer is
+attached to the instrumentation points, which reduces their overhead to a single attribute
+check per reading::
+
+    tracer = Tracer()
+    tracer.instrument(pipeline)
+    tracer.instrument_device(calypso)
+    ...
+    print(tracer.report())
+"""
+import asyncio
+import logging
+import signal
+import time
+import typing as t
+
+from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.pipeline import ReloadableStage, SourceStage, TelemetrySink
+from calypso_anemometer.stats import HdrHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """
+    Record per-stage latencies of readings into HDR-style histograms.
+    """
+
+    SPANS = ["decode", "pipeline", "render", "send", "total"]
+
+    def __init__(self):
+        self.histograms: t.Dict[str, HdrHistogram] = {span: HdrHistogram() for span in self.SPANS}
+        self.signals: t.List[int] = []
+        self.closed = False
+
+    def record(self, span: str, duration: float):
+        self.histograms[span].record(duration)
+
+    def record_since(self, span: str, reading: CalypsoReading, now: t.Optional[float] = None):
+        """
+        Record the time elapsed since the reading has been received.
+        """
+        if reading.received_monotonic is None:
+            return
+        if now is None:
+            now = time.monotonic()
+        self.histograms[span].record(now - reading.received_monotonic)
+
+    def instrument(self, pipeline):
+        """
+        Attach the tracer to the source stage and the telemetry sinks of a `calypso_anemometer.pipeline.Pipeline`.
+        Reloadable stages keep it, in order to instrument their replacement pipelines.
+        """
+        for stage in pipeline.walk():
+            if isinstance(stage, (SourceStage, TelemetrySink, ReloadableStage)):
+                stage.tracer = self
+
+    def instrument_device(self, device):
+        """
+        Attach the tracer to a device, in order to trace decoding. Reaches through a supervisor.
+        """
+        device = getattr(device, "device", device)
+        if hasattr(device, "tracer"):
+            device.tracer = self
+
+    def install_signal_handler(self, signum: t.Optional[int] = None):
+        """
+        Log the report when receiving the given signal, by default SIGUSR1. Not available on Windows.
+        Calling it again is a no-op, so handlers shared by multiple devices can invoke it safely.
+        """
+        if signum is None:
+            signum = getattr(signal, "SIGUSR1", None)
+        if signum is None or signum in self.signals:
+            return
+        try:
+            asyncio.get_event_loop().add_signal_handler(signum, self.log_report)
+        except (NotImplementedError, RuntimeError, ValueError) as ex:
+            logger.warning(f"Unable to dump latency trace on signal {signum}: {ex}")
+            return
+        self.signals.append(signum)
+        logger.info(f"Send signal {signal.Signals(signum).name} to dump latency trace")
+
+    def close(self):
+        """
+        Remove signal handlers, and log the final report. Calling it again is a no-op.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        loop = asyncio.get_event_loop()
+        for signum in self.signals:
+            loop.remove_signal_handler(signum)
+        self.signals.clear()
+        self.log_report()
+
+    def asdict(self):
+        return {span: histogram.asdict() for span, histogram in self.histograms.items()}
+
+    def report(self) -> str:
+        """
+        Render percentiles of all spans as a text table, in milliseconds.
+        """
+
+        def fmt(value):
+            return "n/a" if value is None else f"{value * 1000:.3f}"
+
+        columns = ["count", "min", "mean", "p50", "p90", "p99", "p999", "max"]
+        lines = [f"{'span':<10}" + "".join(f"{column:>10}" for column in columns) + "  (ms)"]
+        for span, data in self.asdict().items():
+            cells = [str(data["count"])] + [fmt(data[column]) for column in columns[1:]]
+            lines.append(f"{span:<10}" + "".join(f"{cell:>10}" for cell in cells))
+        return "\n".join(lines)
+
+    def log_report(self):
+        logger.info(f"Latency trace:\n{self.report()}")
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Compute true wind and ground wind from apparent wind and boat motion.
+
+The device measures the apparent wind, which is the sum of the true wind and the
+head wind caused by the motion of the boat. Subtracting the motion of the boat yields
+
+- the true wind, relative to the water, using heading and speed through water,
+- the ground wind, relative to the ground, using course and speed over ground.
+
+Without current, both are the same. The wind angle is relative to the bow, while the
+wind direction is relative to true north. Speeds are in m/s, angles in degrees.
+
+Boat motion is obtained from fixed values, from NMEA-0183 sentences received over UDP,
+or from an NMEA-0183 log file, when processing recordings in bulk. Computations are
+vectorized with NumPy, so recordings are processed in batches.
+
+Synopsis::
+
+    stage = make_true_wind_stage(nmea_input="0.0.0.0:10110")
+    handler = await handler_factory(subscribe=True, stages=[stage])
+"""
+import asyncio
+import dataclasses
+import datetime as dt
+import json
+import logging
+import math
+import time
+import typing as t
+
+import numpy as np
+
+from calypso_anemometer.model import CalypsoReading, TrueWind
+from calypso_anemometer.pipeline import PipelineStage
+from calypso_anemometer.telemetry.nmea0183 import Nmea0183GenericMessage
+
+logger = logging.getLogger(__name__)
+
+# Conversion factor from knots to m/s.
+KNOTS = 1852.0 / 3600.0
+
+# Below this speed, in m/s, wind direction is undefined, and reported as zero, like the device does.
+CALM_SPEED = 1e-6
+
+# Boat motion older than this number of seconds is not used.
+MAX_AGE = 5.0
+
+# Only the measurement fields, excluding receive timestamps and derived wind.
+MEASUREMENT_FIELDS = [field.name for field in dataclasses.fields(CalypsoReading) if field.compare]
+
+
+@dataclasses.dataclass
+class BoatMotion:
+    """
+    Motion of the boat. Speeds are in m/s, angles in degrees relative to true north.
+
+    When the heading is unknown, the course over ground is used instead.
+    """
+
+    heading: t.Optional[float] = None
+    speed_through_water: t.Optional[float] = None
+    speed_over_ground: t.Optional[float] = None
+    course_over_ground: t.Optional[float] = None
+
+    @classmethod
+    def fixed(cls, speed: float, course: float, heading: t.Optional[float] = None) -> "BoatMotion":
+        """
+        Motion at constant speed and course, without current, so true wind and ground wind are the same.
+        """
+        return cls(
+            heading=course if heading is None else heading,
+            speed_through_water=speed,
+            speed_over_ground=speed,
+            course_over_ground=course,
+        )
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+    def asarrays(self, count: int) -> t.Dict[str, np.ndarray]:
+        """
+        Repeat the motion `count` times, using NaN for missing values.
+        """
+        return {
+            key: np.full(count, np.nan if value is None else value, dtype=float) for key, value in self.asdict().items()
+        }
+
+
+def true_wind(
+    wind_speed: np.ndarray,
+    wind_angle: np.ndarray,
+    heading: np.ndarray,
+    boat_speed: np.ndarray,
+    boat_course: np.ndarray,
+) -> t.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compute speed, angle, and direction of the wind, by subtracting the motion of the boat from the apparent wind.
+
+    Angles are in degrees, where `wind_angle` is relative to the bow, and `heading` and
+    `boat_course` are relative to true north. Missing values propagate as NaN.
+    """
+    apparent_direction = np.radians(heading + wind_angle)
+    course = np.radians(boat_course)
+    # The velocity of the air, as east and north components, pointing where the wind blows to.
+    east = boat_speed * np.sin(course) - wind_speed * np.sin(apparent_direction)
+    north = boat_speed * np.cos(course) - wind_speed * np.cos(apparent_direction)
+    speed = np.hypot(east, north)
+    calm = speed < CALM_SPEED
+    direction = np.where(calm, 0.0, np.degrees(np.arctan2(-east, -north)) % 360)
+    angle = np.where(calm, 0.0, (direction - heading) % 360)
+    return speed, angle, direction
+
+
+def make_true_winds(speed: np.ndarray, angle: np.ndarray, direction: np.ndarray) -> t.List[t.Optional[TrueWind]]:
+    """
+    Convert computed columns to `TrueWind` items, rounded like the device does. NaN yields `None`.
+    """
+    return [
+        None if math.isnan(item[0]) else TrueWind(round(item[0], 2), round(item[1], 1) % 360, round(item[2], 1) % 360)
+        for item in zip(speed.tolist(), angle.tolist(), direction.tolist())  # noqa: B905
+    ]
+
+
+def apply_true_wind(readings: t.List[CalypsoReading], motion: t.Dict[str, np.ndarray]):
+    """
+    Compute true wind and ground wind for a batch of readings, and attach them to the readings.
+
+    :param motion: Boat motion at the time of each reading, as columns, like `BoatMotion.asarrays`.
+    """
+    wind_speed = np.array([reading.wind_speed for reading in readings], dtype=float)
+    wind_angle = np.array([reading.wind_direction for reading in readings], dtype=float)
+    course = motion["course_over_ground"]
+    heading = np.where(np.isnan(motion["heading"]), course, motion["heading"])
+
+    true_winds = make_true_winds(*true_wind(wind_speed, wind_angle, heading, motion["speed_through_water"], heading))
+    ground_winds = make_true_winds(*true_wind(wind_speed, wind_angle, heading, motion["speed_over_ground"], course))
+    for reading, true, ground in zip(readings, true_winds, ground_winds):  # noqa: B905
+        reading.true_wind = true
+        reading.ground_wind = ground
+
+
+def parse_motion(sentence: str) -> t.Dict[str, float]:
+    """
+    Decode boat motion from an NMEA-0183 sentence, using `RMC`, `VTG`, `VHW`, and `HDT`.
+
+    `RMC` also yields its timestamp as `time`, in seconds since the epoch. Sentences
+    emitted by this program are ignored. Raises `ValueError` on invalid sentences.
+    """
+    message = Nmea0183GenericMessage.parse(sentence)
+    fields = message.fields + [""] * 9
+    kind = message.sentence_type
+    values: t.Dict[str, t.Optional[float]] = {}
+    if message.talker == "ML":
+        pass
+    elif kind == "RMC" and fields[1] == "A":
+        values["time"] = rmc_time(fields[0], fields[8])
+        values["speed_over_ground"] = knots(fields[6])
+        values["course_over_ground"] = number(fields[7])
+    elif kind == "VTG":
+        values["course_over_ground"] = number(fields[0])
+        values["speed_over_ground"] = knots(fields[4])
+    elif kind == "VHW":
+        values["heading"] = number(fields[0])
+        values["speed_through_water"] = knots(fields[4])
+    elif kind == "HDT":
+        values["heading"] = number(fields[0])
+    return {key: value for key, value in values.items() if value is not None}
+
+
+def number(value: str) -> t.Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def knots(value: str) -> t.Optional[float]:
+    speed = number(value)
+    if speed is None:
+        return None
+    return speed * KNOTS
+
+
+def rmc_time(time_of_day: str, date: str) -> t.Optional[float]:
+    """
+    Decode `hhmmss.ss` and `ddmmyy` fields of an `RMC` sentence into seconds since the epoch.
+    """
+    try:
+        stamp = dt.datetime.strptime(f"{date} {time_of_day[:6]}", "%d%m%y %H%M%S").replace(tzinfo=dt.timezone.utc)
+        return stamp.timestamp() + float(f"0{time_of_day[6:]}")
+    except ValueError:
+        return None
+
+
+class FixedMotionSource:
+    """
+    Provide fixed boat motion, for example when motoring at constant speed.
+    """
+
+    def __init__(self, motion: BoatMotion):
+        self._motion = motion
+
+    def start(self):
+        pass
+
+    def motion(self) -> t.Optional[BoatMotion]:
+        return self._motion
+
+    def close(self):
+        pass
+
+
+class NmeaMotionSource:
+    """
+    Receive boat motion from NMEA-0183 sentences over UDP, for example from a GPS receiver or a multiplexer.
+
+    Values which have not been updated within `max_age` seconds are considered missing.
+
+    :param host: Listen on this address. Use `0.0.0.0` to receive broadcasts.
+    :param port: Listen on this port. Port 10110 is designated for NMEA-0183.
+    :param max_age: Discard values older than this number of seconds.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 10110, max_age: float = MAX_AGE):  # noqa: S104
+        self.host = host
+        self.port = port
+        self.max_age = max_age
+        # The most recent value of each boat motion field, with its monotonic timestamp.
+        self.latest: t.Dict[str, t.Tuple[float, float]] = {}
+        self.task: t.Optional[asyncio.Future] = None
+        self.transport: t.Optional[asyncio.DatagramTransport] = None
+
+    @classmethod
+    def from_address(cls, address: str, max_age: float = MAX_AGE) -> "NmeaMotionSource":
+        """
+        Create source from an address like `0.0.0.0:10110`, or `:10110` for listening on all interfaces.
+        """
+        host, _, port = address.rpartition(":")
+        try:
+            return cls(host=host or "0.0.0.0", port=int(port), max_age=max_age)  # noqa: S104
+        except ValueError:
+            raise ValueError(f"Invalid NMEA-0183 input address: {address}") from None
+
+    def start(self):
+        """
+        Start listening. Calling it again is a no-op.
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.listen())
+
+    async def listen(self):
+        loop = asyncio.get_event_loop()
+        try:
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: NmeaMotionProtocol(self), local_addr=(self.host, self.port)
+            )
+        except OSError as ex:
+            logger.warning(f"Unable to receive NMEA-0183 on {self.host}:{self.port}: {ex}")
+            return
+        logger.info(f"Receiving boat motion as NMEA-0183 on {self.host}:{self.port}")
+
+    def feed(self, data: str, timestamp: t.Optional[float] = None):
+        """
+        Update boat motion from NMEA-0183 sentences, one per line.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                values = parse_motion(line)
+            except ValueError as ex:
+                logger.debug(f"Skipping NMEA-0183 sentence: {ex}")
+                continue
+            values.pop("time", None)
+            for key, value in values.items():
+                self.latest[key] = (value, timestamp)
+
+    def motion(self, now: t.Optional[float] = None) -> t.Optional[BoatMotion]:
+        """
+        The current boat motion, or `None` when no values are available.
+        """
+        if now is None:
+            now = time.monotonic()
+        values = {key: value for key, (value, timestamp) in self.latest.items() if now - timestamp <= self.max_age}
+        if not values:
+            return None
+        return BoatMotion(**values)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+class NmeaMotionProtocol(asyncio.DatagramProtocol):
+    def __init__(self, source: NmeaMotionSource):
+        self.source = source
+
+    def datagram_received(self, data: bytes, addr: t.Tuple[str, int]):
+        self.source.feed(data.decode("ascii", errors="replace"))
+
+
+class MotionTrack:
+    """
+    Boat motion over time, decoded from an NMEA-0183 log, for processing recordings in bulk.
+
+    Each `RMC` sentence, which carries date and time, starts a new sample. Values received
+    until the next `RMC` sentence belong to it. Values which have not been updated within
+    `max_age` seconds are missing. In between samples, motion is interpolated, but not
+    across gaps longer than `max_age` seconds.
+    """
+
+    def __init__(self, times: np.ndarray, columns: t.Dict[str, np.ndarray], max_age: float = MAX_AGE):
+        self.times = times
+        self.columns = columns
+        self.max_age = max_age
+
+    @classmethod
+    def from_nmea(cls, lines: t.Iterable[str], max_age: float = MAX_AGE) -> "MotionTrack":
+        fields = [field.name for field in dataclasses.fields(BoatMotion)]
+        times: t.List[float] = []
+        samples: t.Dict[str, t.List[float]] = {field: [] for field in fields}
+        current: t.Dict[str, t.Tuple[float, float]] = {}
+        sample_time: t.Optional[float] = None
+
+        def flush():
+            times.append(sample_time)
+            for field in fields:
+                value, timestamp = current.get(field, (math.nan, -math.inf))
+                samples[field].append(value if sample_time - timestamp <= max_age else math.nan)
+
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                values = parse_motion(line)
+            except ValueError as ex:
+                logger.debug(f"Skipping NMEA-0183 sentence: {ex}")
+                continue
+            if "time" in values:
+                if sample_time is not None:
+                    flush()
+                sample_time = values.pop("time")
+            if sample_time is None:
+                continue
+            for key, value in values.items():
+                current[key] = (value, sample_time)
+        if sample_time is not None:
+            flush()
+
+        order = np.argsort(times, kind="stable")
+        columns = {field: np.array(samples[field], dtype=float)[order] for field in fields}
+        return cls(times=np.array(times, dtype=float)[order], columns=columns, max_age=max_age)
+
+    @classmethod
+    def from_file(cls, path: str, max_age: float = MAX_AGE) -> "MotionTrack":
+        with open(path, "r", errors="replace") as f:
+            return cls.from_nmea(f, max_age=max_age)
+
+    def at(self, times: np.ndarray) -> t.Dict[str, np.ndarray]:
+        """
+        Interpolate boat motion at the given times, in seconds since the epoch, as columns.
+        """
+        times = np.asarray(times, dtype=float)
+        if not len(self.times):
+            return BoatMotion().asarrays(len(times))
+
+        # Do not interpolate across gaps, and do not extrapolate beyond the track.
+        index = np.searchsorted(self.times, times)
+        before = self.times[np.clip(index - 1, 0, len(self.times) - 1)]
+        after = self.times[np.clip(index, 0, len(self.times) - 1)]
+        valid = (
+            (times >= self.times[0])
+            & (times <= self.times[-1])
+            & (np.minimum(np.abs(times - before), np.abs(after - times)) <= self.max_age)
+        )
+
+        result = {}
+        for field, values in self.columns.items():
+            if field in ["heading", "course_over_ground"]:
+                # Interpolate angles on the unit circle, in order to wrap around north correctly.
+                radians = np.radians(values)
+                x = np.interp(times, self.times, np.cos(radians))
+                y = np.interp(times, self.times, np.sin(radians))
+                interpolated = np.degrees(np.arctan2(y, x)) % 360
+                # Tiny negative angles wrap to exactly 360.
+                interpolated[interpolated >= 360] = 0.0
+            else:
+                interpolated = np.interp(times, self.times, values)
+            result[field] = np.where(valid, interpolated, np.nan)
+        return result
+
+
+class TrueWindStage(PipelineStage):
+    """
+    Compute true wind and ground wind for each reading, using the current boat motion.
+
+    Readings pass unchanged, without true wind, while no boat motion is available.
+    The motion source is started on the first reading.
+    """
+
+    name = "true-wind"
+
+    def __init__(self, source: t.Union[FixedMotionSource, NmeaMotionSource], name: t.Optional[str] = None):
+        super().__init__(name=name)
+        self.source = source
+        self.started = False
+
+    def process(self, reading: CalypsoReading) -> t.Optional[CalypsoReading]:
+        if not self.started:
+            self.source.start()
+            self.started = True
+        motion = self.source.motion()
+        if motion is not None:
+            apply_true_wind([reading], motion.asarrays(1))
+        return reading
+
+    def close(self):
+        self.source.close()
+        self.started = False
+
+
+def make_true_wind_stage(
+    speed: t.Optional[float] = None,
+    course: t.Optional[float] = None,
+    heading: t.Optional[float] = None,
+    nmea_input: t.Optional[str] = None,
+    max_age: float = MAX_AGE,
+    name: t.Optional[str] = None,
+) -> TrueWindStage:
+    """
+    Create a pipeline stage computing true wind, from either fixed boat motion, or NMEA-0183 input over UDP.
+    """
+    if nmea_input is not None:
+        if speed is not None or course is not None or heading is not None:
+            raise ValueError("Use either fixed boat motion, or NMEA-0183 input")
+        return TrueWindStage(NmeaMotionSource.from_address(nmea_input, max_age=max_age), name=name)
+    if speed is None or course is None:
+        raise ValueError("Fixed boat motion needs both speed and course")
+    return TrueWindStage(FixedMotionSource(BoatMotion.fixed(speed=speed, course=course, heading=heading)), name=name)
+
+
+def process_recording(
+    infile: t.TextIO,
+    outfile: t.TextIO,
+    motion: t.Union[MotionTrack, BoatMotion],
+    batch_size: int = 10000,
+) -> int:
+    """
+    Compute true wind and ground wind for readings recorded in JSON Lines format, see `RecordingSink`.
+
+    Readings are processed in batches of `batch_size`, and written to `outfile`, including
+    `true_wind` and `ground_wind` items, when boat motion is available at their `time`.
+    Returns the number of processed readings.
+    """
+    count = 0
+    batch: t.List[t.Dict[str, t.Any]] = []
+
+    def flush():
+        readings = [CalypsoReading(**{field: record[field] for field in MEASUREMENT_FIELDS}) for record in batch]
+        if isinstance(motion, MotionTrack):
+            columns = motion.at(np.array([record.get("time", math.nan) for record in batch], dtype=float))
+        else:
+            columns = motion.asarrays(len(batch))
+        apply_true_wind(readings, columns)
+        for record, reading in zip(batch, readings):  # noqa: B905
+            record.pop("true_wind", None)
+            record.pop("ground_wind", None)
+            if reading.true_wind is not None:
+                record["true_wind"] = reading.true_wind.asdict()
+            if reading.ground_wind is not None:
+                record["ground_wind"] = reading.ground_wind.asdict()
+            outfile.write(json.dumps(record) + "\n")
+        batch.clear()
+
+    for line in infile:
+        if not line.strip():
+            continue
+        batch.append(json.loads(line))
+        count += 1
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return count
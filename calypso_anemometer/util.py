@@ -3,6 +3,7 @@
 # License: GNU Affero General Public License, Version 3
 import asyncio
 import dataclasses
+import datetime
 import enum
 import functools
 import json
@@ -24,15 +25,43 @@ def make_sync(func):
     Click entrypoint decorator for wrapping asynchronous functions.
 
     https://github.com/pallets/click/issues/2033
+
+    When the `--profile` option is used, the command runs within the profiler,
+    see `calypso_anemometer.profiling.Profiler`.
     """
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        return asyncio.run(func(*args, **kwargs))
+        ctx = click.get_current_context(silent=True)
+        profiler = ctx and ctx.meta.get("calypso.profiler")
+        if not profiler:
+            return asyncio.run(func(*args, **kwargs))
+        with profiler:
+            return asyncio.run(profiler.run(func(*args, **kwargs)))
 
     return wrapper
 
 
+EVENT_LOOPS = ["asyncio", "uvloop"]
+
+
+def setup_event_loop(name: str = "asyncio"):
+    """
+    Select the event loop implementation used by `make_sync`.
+
+    `uvloop` is a drop-in replacement based on libuv, with less overhead per
+    callback. It is an optional dependency, and not available on Windows.
+    """
+    if name == "asyncio":
+        asyncio.set_event_loop_policy(None)
+    elif name == "uvloop":
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        raise ValueError(f"Unknown event loop: {name}")
+
+
 class JsonEncoderPlus(json.JSONEncoder):
     """
     JSON encoder with support for serializing Enums and Data Classes.
@@ -74,11 +103,6 @@ class EnumChoice(click.Choice):
         return self.enum_type[value]
 
 
-async def wait_forever():
-    future = asyncio.Future()
-    return await asyncio.wait_for(future, timeout=None)
-
-
 def deg2rad(value: float) -> float:
     """
     Convert angles from degrees to radians. SignalK needs it.
@@ -95,3 +119,13 @@ def celsius2kelvin(value: float) -> float:
     https://signalk.org/specification/1.7.0/doc/vesselsBranch.html
     """
     return value + 273.15
+
+
+def to_iso8601(timestamp: float) -> str:
+    """
+    Format Unix timestamp as ISO 8601 string in UTC, with millisecond precision. SignalK needs it.
+
+    https://signalk.org/specification/1.7.0/doc/data_model.html#full-data-model
+    """
+    value = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+    return value.isoformat(timespec="milliseconds").replace("+00:00", "Z")
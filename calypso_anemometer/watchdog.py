@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Watch the stream of BLE notifications, and recover when it stalls.
+
+The BLE connection may look alive, while no more notifications arrive. The
+watchdog knows the expected interval between readings from the configured
+data rate. When no reading arrives within a multiple of that interval, it
+escalates through the following recovery steps:
+
+1. Resubscribe to readings.
+2. Reconnect to the device, when running under the supervisor.
+3. As a last resort, when the asyncio domain stalls completely, a thread
+   independent of the event loop kills the process, in order to hand over
+   to the service manager.
+"""
+import asyncio
+import dataclasses
+import logging
+import os
+import threading
+import time
+import typing as t
+
+from calypso_anemometer.model import CalypsoDeviceDataRate, CalypsoReading
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class WatchdogMetrics:
+    """
+    Bookkeeping about stalls and recoveries. All durations are in seconds.
+
+    - `last_time_to_recovery`: Time from the last reading before the stall until the first reading after it.
+    """
+
+    stalls: int = 0
+    resubscribes: int = 0
+    reconnects: int = 0
+    recoveries: int = 0
+    last_time_to_recovery: t.Optional[float] = None
+
+    def asdict(self):
+        return dataclasses.asdict(self)
+
+
+def hard_kill():  # pragma: no cover
+    os._exit(1)
+
+
+class NotificationWatchdog:
+    """
+    Supervise the notification stream of a workhorse instance.
+
+    :param device: The workhorse instance, optionally wrapped into a `CalypsoDeviceSupervisor`.
+    :param callback: The function receiving readings.
+    :param tolerance: Multiple of the expected notification interval after which the stream is considered stalled.
+    :param hard_timeout: Seconds without any reading after which the process will be killed. `None` disables it.
+    :param kill: Function to invoke for killing the process.
+    """
+
+    DEFAULT_DATARATE = CalypsoDeviceDataRate.HZ_4
+
+    def __init__(
+        self,
+        device,
+        callback: t.Callable,
+        tolerance: float = 10.0,
+        hard_timeout: t.Optional[float] = None,
+        kill: t.Callable = hard_kill,
+    ):
+        self.device = device
+        self.callback = callback
+        self.tolerance = tolerance
+        self.hard_timeout = hard_timeout
+        self.kill = kill
+        self.metrics = WatchdogMetrics()
+
+        self.last_reading_at = time.monotonic()
+        self.last_recovery_at = 0.0
+        self.stalled_since: t.Optional[float] = None
+        self.consecutive_stalls = 0
+
+        self.subscribe_kwargs: t.Dict[str, t.Any] = {}
+        self.monitor_task: t.Optional[asyncio.Future] = None
+        self.subscribe_task: t.Optional[asyncio.Future] = None
+        self.guard_thread: t.Optional[threading.Thread] = None
+        self.guard_stop = threading.Event()
+
+    @property
+    def interval(self) -> float:
+        """
+        The expected interval between two readings, in seconds.
+        """
+        datarate = getattr(self.device, "datarate", None) or self.DEFAULT_DATARATE
+        return datarate.interval
+
+    @property
+    def timeout(self) -> float:
+        return self.interval * self.tolerance
+
+    def feed(self):
+        now = time.monotonic()
+        if self.stalled_since is not None:
+            self.metrics.recoveries += 1
+            self.metrics.last_time_to_recovery = now - self.stalled_since
+            logger.info(f"Notification stream recovered after {self.metrics.last_time_to_recovery:.3f} seconds")
+            self.stalled_since = None
+        self.consecutive_stalls = 0
+        self.last_reading_at = now
+
+    def on_reading(self, reading: CalypsoReading):
+        self.feed()
+        self.callback(reading)
+
+    async def subscribe(self, **kwargs):
+        """
+        Subscribe to readings, feeding the watchdog on each reading.
+        """
+        self.subscribe_kwargs = kwargs
+        self.feed()
+        await self.device.subscribe_reading(self.on_reading, **kwargs)
+
+    def start(self):
+        self.last_reading_at = time.monotonic()
+        self.monitor_task = asyncio.ensure_future(self.monitor())
+        if self.hard_timeout is not None:
+            self.guard_stop.clear()
+            self.guard_thread = threading.Thread(target=self.guard, name="calypso-watchdog", daemon=True)
+            self.guard_thread.start()
+
+    def stop(self):
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+        if self.subscribe_task is not None:
+            self.subscribe_task.cancel()
+        self.guard_stop.set()
+
+    async def monitor(self):
+        """
+        Periodically check for a stalled notification stream, and run recovery steps.
+        """
+        while True:
+            await asyncio.sleep(self.timeout / 2)
+            # After a recovery step, give it a chance to succeed before escalating.
+            elapsed = time.monotonic() - max(self.last_reading_at, self.last_recovery_at)
+            if elapsed > self.timeout:
+                await self.recover(elapsed)
+
+    async def recover(self, elapsed: float):
+        if self.stalled_since is None:
+            self.stalled_since = self.last_reading_at
+        self.consecutive_stalls += 1
+        self.metrics.stalls += 1
+        logger.warning(
+            f"Notification stream stalled, no reading within {elapsed:.3f} seconds. "
+            f"Expected interval: {self.interval:.3f} seconds"
+        )
+        self.last_recovery_at = time.monotonic()
+        try:
+            recycle = getattr(self.device, "recycle", None)
+            if self.consecutive_stalls == 1 or recycle is None:
+                await self.resubscribe()
+            else:
+                self.metrics.reconnects += 1
+                logger.warning("Recovering notification stream by reconnecting")
+                await recycle()
+        except Exception:
+            logger.exception("Recovering notification stream failed")
+
+    async def resubscribe(self):
+        self.metrics.resubscribes += 1
+        logger.warning("Recovering notification stream by resubscribing")
+        try:
+            await self.device.unsubscribe_reading()
+        except Exception as ex:
+            logger.warning(f"Unsubscribing failed: {ex}")
+        if self.subscribe_task is not None:
+            self.subscribe_task.cancel()
+        # Do not await the subscription here, because the fake device will block while producing readings.
+        self.subscribe_task = asyncio.ensure_future(
+            self.device.subscribe_reading(self.on_reading, **self.subscribe_kwargs)
+        )
+
+    def guard(self):
+        """
+        Thread-based last resort: Kill the process when no reading arrived within `hard_timeout` seconds.
+
+        This also works when the asyncio domain stalls completely, because it does not depend on the event loop.
+        """
+        while not self.guard_stop.wait(timeout=min(1.0, self.hard_timeout / 2)):
+            elapsed = time.monotonic() - self.last_reading_at
+            if elapsed > self.hard_timeout:
+                logger.critical(f"No reading within {elapsed:.3f} seconds, killing process")
+                self.kill()
+                return
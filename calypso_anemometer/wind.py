@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+"""
+Seeded stochastic wind model for the fake device.
+
+Real wind is a mean flow with superimposed gusts and turbulence, while its
+direction wanders slowly. Each fluctuating quantity is modelled as an
+Ornstein-Uhlenbeck process, i.e. first-order autoregressive noise with an
+exponentially decaying autocorrelation. Its spectrum is flat below, and falls
+off with the square of the frequency above the corner frequency `1 / timescale`.
+Wind speed is the sum of a slow gust component and a fast turbulence component.
+
+Readings are computed in chunks with NumPy, so the model stays cheap at high
+data rates. Using the same seed will produce the same sequence of readings.
+"""
+import dataclasses
+import math
+import typing as t
+
+import numpy as np
+
+from calypso_anemometer.model import CalypsoReading
+
+# Keep `exp(block / timescale)` well within the range of float64, see `ornstein_uhlenbeck`.
+BLOCK_DECAY_LIMIT = 30.0
+
+
+def ornstein_uhlenbeck(
+    x0: float, count: int, interval: float, timescale: float, sigma: float, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Compute `count` steps of an Ornstein-Uhlenbeck process with zero mean, starting after `x0`.
+
+    The recursion `x[n] = a * x[n-1] + e[n]` is vectorized as `x[n] = a^n * (x0 + cumsum(e[k] / a^k))`.
+    In order not to overflow `1 / a^k`, the computation is split into blocks.
+    """
+    decay = math.exp(-interval / timescale)
+    noise = rng.standard_normal(count) * sigma * math.sqrt(1.0 - decay**2)
+    block = max(1, int(BLOCK_DECAY_LIMIT * timescale / interval))
+    result = np.empty(count)
+    for start in range(0, count, block):
+        chunk = noise[start : start + block]
+        powers = decay ** np.arange(1, len(chunk) + 1)
+        result[start : start + len(chunk)] = powers * (x0 + np.cumsum(chunk / powers))
+        x0 = result[start + len(chunk) - 1]
+    return result
+
+
+@dataclasses.dataclass
+class WindModelSettings:
+    """
+    Parameters of the wind model. Speeds are in m/s, angles in degrees, durations in seconds.
+    """
+
+    mean_speed: float = 6.0
+    gust_intensity: float = 0.15
+    gust_timescale: float = 20.0
+    turbulence_intensity: float = 0.1
+    turbulence_timescale: float = 1.5
+    mean_direction: float = 220.0
+    direction_wander: float = 15.0
+    direction_timescale: float = 120.0
+    temperature: float = 18.0
+    temperature_wander: float = 2.0
+    temperature_timescale: float = 3600.0
+    battery_level: float = 100.0
+    battery_drain_per_hour: float = 2.0
+    motion_amplitude: float = 5.0
+    motion_timescale: float = 4.0
+    heading: float = 180.0
+    heading_wander: float = 10.0
+    heading_timescale: float = 60.0
+
+
+class WindModel:
+    """
+    Generate realistic readings in chunks, reproducible by seed.
+
+    :param seed: Seed for the random number generator. `None` will use fresh entropy.
+    :param settings: Parameters of the wind model.
+    """
+
+    PROCESSES = ("gust", "turbulence", "direction", "temperature", "roll", "pitch", "heading")
+
+    def __init__(self, seed: t.Optional[int] = None, settings: t.Optional[WindModelSettings] = None):
+        self.seed = seed
+        self.settings = settings or WindModelSettings()
+        self.elapsed = 0.0
+        self.state: t.Dict[str, float] = dict.fromkeys(self.PROCESSES, 0.0)
+        # Use an independent random number generator per process, so the outcome does not depend on chunk sizes.
+        seeds = np.random.SeedSequence(seed).spawn(len(self.PROCESSES))
+        self.rngs = {name: np.random.default_rng(seed) for name, seed in zip(self.PROCESSES, seeds)}  # noqa: B905
+
+    def process(self, name: str, count: int, interval: float, timescale: float, sigma: float) -> np.ndarray:
+        values = ornstein_uhlenbeck(self.state[name], count, interval, timescale, sigma, self.rngs[name])
+        self.state[name] = values[-1]
+        return values
+
+    def generate(self, count: int, interval: float) -> t.List[CalypsoReading]:
+        """
+        Generate the next `count` readings, spaced by `interval` seconds.
+        """
+        settings = self.settings
+        mean_speed = settings.mean_speed
+
+        gust = self.process("gust", count, interval, settings.gust_timescale, settings.gust_intensity * mean_speed)
+        turbulence = self.process(
+            "turbulence", count, interval, settings.turbulence_timescale, settings.turbulence_intensity * mean_speed
+        )
+        speed = np.clip(mean_speed + gust + turbulence, 0.0, 655.35)
+
+        direction = settings.mean_direction + self.process(
+            "direction", count, interval, settings.direction_timescale, settings.direction_wander
+        )
+        temperature = settings.temperature + self.process(
+            "temperature", count, interval, settings.temperature_timescale, settings.temperature_wander
+        )
+        roll = self.process("roll", count, interval, settings.motion_timescale, settings.motion_amplitude)
+        pitch = self.process("pitch", count, interval, settings.motion_timescale, settings.motion_amplitude)
+        heading = settings.heading + self.process(
+            "heading", count, interval, settings.heading_timescale, settings.heading_wander
+        )
+
+        # Battery drains linearly, and is reported in steps of 10%.
+        hours = (self.elapsed + interval * np.arange(1, count + 1)) / 3600.0
+        battery = np.clip(settings.battery_level - settings.battery_drain_per_hour * hours, 0.0, 100.0)
+        self.elapsed += interval * count
+
+        # Quantize like the device does.
+        columns = [
+            np.round(speed, 2).tolist(),
+            (np.rint(direction).astype(int) % 360).tolist(),
+            (np.rint(battery / 10.0).astype(int) * 10).tolist(),
+            np.rint(temperature).astype(int).tolist(),
+            np.clip(np.rint(roll), -90, 90).astype(int).tolist(),
+            np.clip(np.rint(pitch), -90, 90).astype(int).tolist(),
+            (np.rint(heading).astype(int) % 360).tolist(),
+        ]
+        return [CalypsoReading(*values) for values in zip(*columns)]  # noqa: B905
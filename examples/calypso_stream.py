@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.model import CalypsoDeviceDataRate
+
+
+async def calypso_stream_demo():
+    async with CalypsoDeviceApi() as calypso:
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+
+        # Process readings in chunks of up to 16 items, at least once per second.
+        async for readings in calypso.stream(batch_size=16, max_latency=1.0):
+            wind_speeds = [reading.wind_speed for reading in readings]
+            print(f"Readings: {len(readings)}. Maximum wind speed: {max(wind_speeds)}")  # noqa: T201
+
+
+if __name__ == "__main__":  # pragma: nocover
+    asyncio.run(calypso_stream_demo())
@@ -5,16 +5,19 @@ import asyncio
 
 from calypso_anemometer.core import CalypsoDeviceApi
 from calypso_anemometer.model import CalypsoReading
-from calypso_anemometer.util import wait_forever
+from calypso_anemometer.shutdown import ShutdownSignal
 
 
 async def calypso_subscribe_demo():
     def process_reading(reading: CalypsoReading):
         reading.dump()
 
+    # Receive readings until SIGTERM or SIGINT.
+    shutdown = ShutdownSignal()
+    shutdown.install()
     async with CalypsoDeviceApi() as calypso:
-        await calypso.subscribe_reading(process_reading)
-        await wait_forever()
+        await shutdown.run_until_requested(calypso.subscribe_reading(process_reading))
+        await calypso.unsubscribe_reading()
 
 
 if __name__ == "__main__":  # pragma: nocover
@@ -22,3 +22,11 @@ def clean_environment_variables(mocker: MockerFixture):
     Make sure the tests will run with a deterministic set of application-specific environment variables.
     """
     mocker.patch.dict(os.environ, {"CALYPSO_QUIET": "false"})
+
+
+@pytest.fixture(autouse=True)
+def isolate_cache_directory(mocker: MockerFixture, tmp_path):
+    """
+    Make sure the tests will not write to the cache directory of the user.
+    """
+    mocker.patch.dict(os.environ, {"XDG_CACHE_HOME": str(tmp_path / "cache")})
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import pytest
+
+from calypso_anemometer.bench import Bench, BenchPeripheral
+from calypso_anemometer.model import CalypsoDeviceDataRate, CalypsoReading
+from calypso_anemometer.telemetry.model import TelemetryProtocol
+
+
+def test_bench_peripheral():
+    peripheral = BenchPeripheral(variety=2)
+    assert peripheral.interval == 0.0
+    first, second, third = [CalypsoReading.from_buffer(peripheral.produce_reading()) for _ in range(3)]
+    assert first.wind_speed == 1.0
+    assert second.wind_speed == 2.0
+    assert third == first
+    assert BenchPeripheral(datarate=CalypsoDeviceDataRate.HZ_8).interval == 0.125
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("protocol", list(TelemetryProtocol))
+@pytest.mark.parametrize("queue_size", [0, 128])
+async def test_bench_run(protocol, queue_size):
+    report = await Bench(protocol=protocol, duration=0.2, queue_size=queue_size).run()
+    assert report.protocol == protocol.value
+    assert report.readings > 10
+    assert report.readings_per_second == pytest.approx(report.readings / report.duration)
+    assert report.cpu_per_reading > 0
+    assert report.cpu_load["HZ_8"] == pytest.approx(report.cpu_per_reading / 0.125 * 100)
+    assert 0 < report.latency_p50 <= report.latency_p99 <= report.latency_max
+    assert report.dropped == 0
+    assert "readings_per_second=" in str(report)
+
+
+@pytest.mark.asyncio
+async def test_bench_datarate():
+    report = await Bench(
+        protocol=TelemetryProtocol.UDP_SIGNALK_DELTA, duration=0.3, datarate=CalypsoDeviceDataRate.HZ_8
+    ).run()
+    assert 1 <= report.readings <= 3
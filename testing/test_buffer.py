@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import sys
+import time
+from unittest.mock import Mock
+
+import pytest
+from pytest_mock import MockerFixture
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.model import QueueOverflowPolicy
+from testing.data import dummy_reading, dummy_wire_message_good
+
+
+@pytest.mark.asyncio
+async def test_queue_drop_oldest(caplog):
+    queue = ReadingQueue(maxsize=2, policy=QueueOverflowPolicy.DROP_OLDEST)
+    queue.start()
+    for item in range(5):
+        await queue.put(item)
+    assert queue.depth == 2
+    assert list(queue.queue._queue) == [3, 4]
+    assert queue.metrics.received == 5
+    assert queue.metrics.dropped == 3
+    assert "Reading queue overflow, policy=drop-oldest. Dropped readings: 1, depth: 2" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_queue_drop_newest():
+    queue = ReadingQueue(maxsize=2, policy=QueueOverflowPolicy.DROP_NEWEST)
+    queue.start()
+    for item in range(5):
+        await queue.put(item)
+    assert list(queue.queue._queue) == [0, 1]
+    assert queue.metrics.dropped == 3
+
+
+@pytest.mark.asyncio
+async def test_queue_block():
+    queue = ReadingQueue(maxsize=2, policy=QueueOverflowPolicy.BLOCK)
+    queue.start()
+    await queue.put(0)
+    await queue.put(1)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(queue.put(2), timeout=0.05)
+    assert queue.metrics.dropped == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_consume_failing_sink():
+    """
+    A failing sink will not stop the consumer, and all readings will be processed.
+    """
+    callback = Mock(side_effect=[Exception("Sink failed"), None, None])
+    queue = ReadingQueue(maxsize=10)
+    queue.start(callback)
+    for item in range(3):
+        await queue.put(item)
+    await queue.join()
+    await queue.stop()
+
+    assert callback.call_count == 3
+    assert queue.metrics.processed == 2
+    assert queue.metrics.errors == 1
+    assert queue.metrics.depth_max == 3
+    assert queue.running is False
+
+
+@pytest.mark.asyncio
+async def test_queue_put_nowait():
+    queue = ReadingQueue(maxsize=2, policy=QueueOverflowPolicy.DROP_OLDEST)
+    queue.start()
+    for item in range(3):
+        queue.put_nowait(item)
+    assert list(queue.queue._queue) == [1, 2]
+    assert queue.metrics.received == 3
+    assert queue.metrics.dropped == 1
+    assert queue.metrics.depth_max == 2
+
+
+@pytest.mark.asyncio
+async def test_queue_stop_drain(caplog):
+    """
+    Buffered readings will be processed on shutdown, within the drain timeout.
+    """
+    callback = Mock()
+    queue = ReadingQueue(maxsize=10)
+    queue.start(callback)
+    for item in range(3):
+        await queue.put(item)
+    await queue.stop(drain_timeout=1.0)
+    assert callback.call_count == 3
+    assert not any("Discarded readings" in message for message in caplog.messages)
+
+
+@pytest.mark.asyncio
+async def test_queue_stop_discard(caplog):
+    """
+    Readings which could not be processed within the drain timeout will be discarded, and accounted for.
+    """
+    queue = ReadingQueue(maxsize=10)
+    queue.start()
+    # Emulate a stuck consumer.
+    queue.consumer = asyncio.ensure_future(asyncio.sleep(10))
+    for item in range(3):
+        await queue.put(item)
+    await queue.stop(drain_timeout=0.05)
+    assert queue.depth == 3
+    assert "Reading queue stopped. Discarded readings: 3" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_queue_core_subscribe(mocker: MockerFixture):
+    if sys.version_info < (3, 8, 0):
+        raise pytest.skip(reason="AsyncMock not supported on Python 3.7")
+
+    from unittest.mock import AsyncMock
+
+    from calypso_anemometer.core import CalypsoDeviceApi
+
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+    start_notify = mocker.patch("calypso_anemometer.core.BleakClient.start_notify", AsyncMock(return_value=None))
+
+    callback = Mock()
+    queue = ReadingQueue()
+    async with CalypsoDeviceApi(ble_address="bar") as calypso:
+        await calypso.subscribe_reading(callback=callback, queue=queue)
+
+        # Emulate BLE notification.
+        handler = start_notify.call_args.args[1]
+        handler(42, bytearray(dummy_wire_message_good))
+        callback.assert_not_called()
+        await queue.join()
+        await queue.stop()
+
+    callback.assert_called_once_with(dummy_reading)
+
+
+@pytest.mark.asyncio
+async def test_queue_core_subscribe_slow_sink(mocker: MockerFixture):
+    """
+    A slow sink will not delay the BLE notification handler.
+    """
+    if sys.version_info < (3, 8, 0):
+        raise pytest.skip(reason="AsyncMock not supported on Python 3.7")
+
+    from unittest.mock import AsyncMock
+
+    from calypso_anemometer.core import CalypsoDeviceApi
+
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+    start_notify = mocker.patch("calypso_anemometer.core.BleakClient.start_notify", AsyncMock(return_value=None))
+
+    callback = Mock(side_effect=lambda reading: time.sleep(0.05))
+    queue = ReadingQueue()
+    async with CalypsoDeviceApi(ble_address="bar") as calypso:
+        await calypso.subscribe_reading(callback=callback, queue=queue)
+
+        # Emulate a burst of BLE notifications. The handler returns without invoking the sink.
+        handler = start_notify.call_args.args[1]
+        started = time.monotonic()
+        for _ in range(5):
+            handler(42, bytearray(dummy_wire_message_good))
+        assert time.monotonic() - started < 0.05
+        callback.assert_not_called()
+        assert queue.depth == 5
+
+        await queue.join()
+        await queue.stop()
+
+    assert callback.call_count == 5
+
+
+@pytest.mark.asyncio
+async def test_queue_core_subscribe_block_unsupported(mocker: MockerFixture):
+    if sys.version_info < (3, 8, 0):
+        raise pytest.skip(reason="AsyncMock not supported on Python 3.7")
+
+    from unittest.mock import AsyncMock
+
+    from calypso_anemometer.core import CalypsoDeviceApi
+
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+    start_notify = mocker.patch("calypso_anemometer.core.BleakClient.start_notify", AsyncMock(return_value=None))
+
+    queue = ReadingQueue(policy=QueueOverflowPolicy.BLOCK)
+    async with CalypsoDeviceApi(ble_address="bar") as calypso:
+        with pytest.raises(ValueError) as ex:
+            await calypso.subscribe_reading(callback=Mock(), queue=queue)
+    assert ex.match("Queue overflow policy 'block' is not supported with BLE notifications")
+    start_notify.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_queue_fake_subscribe():
+    callback = Mock()
+    queue = ReadingQueue()
+    async with CalypsoDeviceApiFake() as fake:
+        await fake.subscribe_reading(callback=callback, run_once=True, queue=queue)
+        await queue.join()
+        await queue.stop()
+    assert callback.call_count == 1
+    assert queue.metrics.processed == 1
@@ -20,6 +20,8 @@ from click.testing import CliRunner
 
 from calypso_anemometer.cli import cli
 from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.shutdown import ShutdownSignal
+from calypso_anemometer.util import setup_event_loop
 from testing.data import dummy_device_info, dummy_device_status, dummy_wire_message_bad, dummy_wire_message_good
 
 
@@ -71,6 +73,372 @@ def test_cli_fake_rate(caplog):
     assert "Producing reading" in caplog.messages
 
 
+def test_cli_fake_rate_unlimited(mocker: MockerFixture):
+    """
+    Test `calypso-anemometer fake --rate=unlimited --batch-size=1000`
+    """
+    run_engine = mocker.patch("calypso_anemometer.cli.run_engine", AsyncMock())
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("fake --rate=unlimited --batch-size=1000"), catch_exceptions=False)
+    assert result.exit_code == 0
+    workhorse = run_engine.call_args.kwargs["workhorse"]
+    assert workhorse.keywords == {"unlimited": True, "batch_size": 1000, "model": None}
+
+
+def test_cli_fake_record(tmp_path):
+    """
+    Test `calypso-anemometer --profile=... --profile-readings=20 fake --subscribe --rate=unlimited --record=...`
+    """
+    path = tmp_path / "readings.jsonl"
+    profile = tmp_path / "profile.pstats"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        shlex.split(
+            f"--quiet --profile={profile} --profile-readings=20 fake --subscribe --rate=unlimited --record={path}"
+        ),
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    readings = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(readings) >= 20
+    assert readings[0]["wind_speed"] == 1
+
+
+def test_cli_fake_true_wind():
+    """
+    Test `calypso-anemometer fake --boat-speed=5 --boat-course=90`
+    """
+    pytest.importorskip("numpy")
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("fake --boat-speed=5 --boat-course=90"), catch_exceptions=False)
+    assert result.exit_code == 0
+    data = json.loads(result.stdout)
+    assert data["true_wind"] == data["ground_wind"] == {"speed": 4.0, "angle": 179.8, "direction": 269.8}
+
+
+def test_cli_fake_true_wind_invalid():
+    """
+    Test `calypso-anemometer fake --boat-speed=5`
+    """
+    pytest.importorskip("numpy")
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("fake --boat-speed=5"), catch_exceptions=False)
+    assert result.exit_code == 2
+    assert "Error: Fixed boat motion needs both speed and course" in result.output
+
+
+def test_cli_true_wind_without_numpy(mocker, tmp_path):
+    """
+    Test `calypso-anemometer true-wind` without NumPy installed.
+    """
+    mocker.patch.dict("sys.modules", {"numpy": None})
+    readings = tmp_path / "readings.jsonl"
+    readings.write_text("")
+    runner = CliRunner()
+    for command in [f"true-wind {readings} --boat-speed=5 --boat-course=0", "fake --boat-speed=5 --boat-course=90"]:
+        result = runner.invoke(cli, shlex.split(command))
+        assert result.exit_code == 2
+        assert "Error: NumPy is not available" in result.output
+        assert "Install it using `pip install calypso-anemometer[truewind]`" in result.output
+
+
+def test_cli_true_wind(tmp_path):
+    """
+    Test `calypso-anemometer true-wind readings.jsonl --motion-file=nmea.log --output=true-wind.jsonl`
+    """
+    pytest.importorskip("numpy")
+    readings = tmp_path / "readings.jsonl"
+    readings.write_text(
+        '{"wind_speed": 5.0, "wind_direction": 0, "battery_level": 80, "temperature": 20, '
+        '"roll": 0, "pitch": 0, "heading": 0, "time": 1677196800.5}\n'
+    )
+    motion = tmp_path / "nmea.log"
+    motion.write_text(
+        "$GPRMC,000000,A,5430.000,N,01030.000,E,0.0,0.0,240223,,*18\n"
+        "$GPRMC,000001,A,5430.000,N,01030.000,E,0.0,0.0,240223,,*19\n"
+    )
+    output = tmp_path / "true-wind.jsonl"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, shlex.split(f"true-wind {readings} --motion-file={motion} --output={output}"), catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    data = json.loads(output.read_text())
+    assert data["time"] == 1677196800.5
+    # The boat is at rest, so ground wind is apparent wind.
+    assert data["ground_wind"] == {"speed": 5.0, "angle": 0.0, "direction": 0.0}
+    assert "true_wind" not in data
+
+    result = runner.invoke(cli, shlex.split(f"true-wind {readings} --boat-speed=5 --boat-course=0"))
+    assert json.loads(result.stdout)["true_wind"] == {"speed": 0.0, "angle": 0.0, "direction": 0.0}
+
+    result = runner.invoke(cli, shlex.split(f"true-wind {readings}"))
+    assert result.exit_code == 2
+    assert "Boat motion needs `--motion-file`, or both `--boat-speed` and `--boat-course`" in result.output
+
+    result = runner.invoke(cli, shlex.split(f"true-wind {readings} --motion-file={motion} --boat-speed=5"))
+    assert result.exit_code == 2
+    assert "Use either fixed boat motion, or `--motion-file`" in result.output
+
+
+def test_cli_fake_outlier_window():
+    """
+    Test `calypso-anemometer fake --outlier-window=5`
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("fake --outlier-window=5"), catch_exceptions=False)
+    assert result.exit_code == 0
+    assert json.loads(result.stdout)["wind_speed"] == 1
+
+    result = runner.invoke(cli, shlex.split("fake --outlier-window=2"))
+    assert result.exit_code == 2
+    assert "Invalid value for '--outlier-window'" in result.output
+
+
+def test_cli_filter_outliers(tmp_path):
+    """
+    Test `calypso-anemometer filter-outliers readings.jsonl --window=3 --output=filtered.jsonl`
+    """
+    pytest.importorskip("numpy")
+    readings = tmp_path / "readings.jsonl"
+    readings.write_text(
+        "".join(
+            f'{{"wind_speed": {wind_speed}, "wind_direction": 90, "battery_level": 80, "temperature": 20, '
+            f'"roll": 0, "pitch": 0, "heading": 0, "time": 1677196800.5}}\n'
+            for wind_speed in [5.0, 5.1, 4.9, 30.0, 5.0]
+        )
+    )
+    output = tmp_path / "filtered.jsonl"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, shlex.split(f"filter-outliers {readings} --window=3 --output={output}"), catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [record["wind_speed"] for record in records] == [5.0, 5.1, 4.9, 5.1, 5.0]
+    assert records[3]["time"] == 1677196800.5
+
+    result = runner.invoke(cli, shlex.split(f"filter-outliers {readings} --field=true_wind"))
+    assert result.exit_code == 2
+    assert "Error: Unknown field: true_wind" in result.output
+
+
+def test_cli_percentiles(tmp_path):
+    """
+    Test `calypso-anemometer fake --sketch=sketch.json`, and `calypso-anemometer percentiles sketch.json readings.jsonl`
+    """
+    sketch = tmp_path / "sketch.json"
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split(f"--quiet fake --sketch={sketch}"), catch_exceptions=False)
+    assert result.exit_code == 0
+    assert json.loads(sketch.read_text())["count"] == 1
+
+    readings = tmp_path / "readings.jsonl"
+    readings.write_text(
+        "".join(
+            f'{{"wind_speed": {wind_speed}, "wind_direction": 90, "battery_level": 80, "temperature": 20, '
+            f'"roll": 0, "pitch": 0, "heading": 0, "time": 1677196800.5}}\n'
+            for wind_speed in [2.0, 3.0, 4.0]
+        )
+    )
+    merged = tmp_path / "merged.json"
+    result = runner.invoke(
+        cli, shlex.split(f"percentiles {sketch} {readings} --output={merged}"), catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    assert json.loads(result.stdout) == {
+        "count": 4,
+        "min": 1.0,
+        "mean": 2.5,
+        "p50": 2.0,
+        "p90": 4.0,
+        "p99": 4.0,
+        "max": 4.0,
+    }
+    assert json.loads(merged.read_text())["count"] == 4
+
+    readings.write_text('{"wind_direction": 90}\n')
+    result = runner.invoke(cli, shlex.split(f"percentiles {readings}"))
+    assert result.exit_code == 2
+    assert 'Invalid reading: {"wind_direction": 90}' in result.output
+
+
+def test_cli_filter_outliers_without_numpy(mocker, tmp_path):
+    """
+    Test `calypso-anemometer filter-outliers` without NumPy installed.
+    """
+    mocker.patch.dict("sys.modules", {"numpy": None})
+    readings = tmp_path / "readings.jsonl"
+    readings.write_text("")
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split(f"filter-outliers {readings}"))
+    assert result.exit_code == 2
+    assert "Error: NumPy is not available" in result.output
+    assert "Install it using `pip install calypso-anemometer[outlier]`" in result.output
+
+
+def test_cli_fake_wind_model():
+    """
+    Test `calypso-anemometer fake --wind-model --seed=42`
+    """
+    pytest.importorskip("numpy")
+    from calypso_anemometer.wind import WindModel
+
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("fake --wind-model --seed=42"), catch_exceptions=False)
+    assert result.exit_code == 0
+    assert result.stdout.strip() == WindModel(seed=42).generate(1, interval=0.25)[0].asjson()
+
+
+def test_cli_fake_devices(caplog):
+    """
+    Test `calypso-anemometer fake --subscribe --devices=3 --duration=0.3`
+    """
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, shlex.split("fake --subscribe --devices=3 --duration=0.3 --rate=hz_8"), catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    assert '"devices": 3' in result.output
+    assert '"cpu_per_reading"' in result.output
+    assert "Starting fleet of 3 fake devices" in caplog.messages
+
+
+def test_cli_fake_uvloop(caplog):
+    """
+    Test `calypso-anemometer --loop=uvloop fake`
+    """
+    pytest.importorskip("uvloop")
+    runner = CliRunner()
+    try:
+        result = runner.invoke(cli, shlex.split("--loop=uvloop fake"), catch_exceptions=False)
+    finally:
+        setup_event_loop("asyncio")
+    assert result.exit_code == 0
+    assert "wind_speed" in json.loads(result.stdout)
+
+
+def test_cli_loop_unavailable(mocker):
+    """
+    Test `calypso-anemometer --loop=uvloop fake` without uvloop installed
+    """
+    mocker.patch.dict(sys.modules, {"uvloop": None})
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("--loop=uvloop fake"))
+    assert result.exit_code == 2
+    assert "Event loop 'uvloop' is not available" in result.output
+
+
+def test_cli_fake_profile(tmp_path):
+    """
+    Test `calypso-anemometer --profile=... --profile-readings=10 fake --subscribe --rate=unlimited`
+    """
+    path = tmp_path / "profile.pstats"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        shlex.split(f"--profile={path} --profile-readings=10 fake --subscribe --rate=unlimited"),
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert f"Profile summary, full profile written to {path}" in result.output
+    assert "Ordered by: internal time" in result.output
+    assert path.exists()
+
+
+def test_cli_fake_profile_sampling(tmp_path):
+    """
+    Test `calypso-anemometer --profile=... --profile-mode=sampling --profile-duration=0.3 fake --subscribe`
+    """
+    path = tmp_path / "profile.folded"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        shlex.split(f"--profile={path} --profile-mode=sampling --profile-duration=0.3 fake --subscribe"),
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "samples   share  function" in result.output
+    assert "run_until_complete" in path.read_text()
+
+
+def test_cli_profile_limit_without_profile():
+    """
+    Test `calypso-anemometer --profile-duration=1 fake`
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("--profile-duration=1 fake"))
+    assert result.exit_code == 2
+    assert "Options `--profile-duration` and `--profile-readings` require `--profile`" in result.output
+
+
+def test_cli_bench(caplog):
+    """
+    Test `calypso-anemometer bench --protocol=udp_broadcast_nmea0183 --duration=0.2`
+    """
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, shlex.split("bench --protocol=udp_broadcast_nmea0183 --duration=0.2"), catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    reports = json.loads(result.stdout)
+    assert [report["protocol"] for report in reports] == ["udp+broadcast+nmea0183"]
+    assert reports[0]["readings"] > 0
+    assert reports[0]["latency_p99"] > 0
+    assert "Benchmarking udp+broadcast+nmea0183 for 0.2 seconds" in caplog.messages
+
+
+def test_cli_serve(tmp_path, caplog):
+    """
+    Test `calypso-anemometer --profile=... --profile-readings=3 serve --config=calypso.toml`
+    """
+    config = tmp_path / "calypso.toml"
+    config.write_text(
+        "[[devices]]\n"
+        'name = "masthead"\n'
+        'driver = "emulated"\n'
+        'rate = "HZ_8"\n'
+        "[pipelines.default]\n"
+        "stdout = true\n"
+    )
+    profile = tmp_path / "serve.prof"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["--profile", str(profile), "--profile-readings", "3", "serve", "--config", str(config)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert result.output.count('"wind_speed"') >= 3
+    assert "Connecting to device 'masthead'" in caplog.messages
+
+
+def test_cli_serve_invalid(tmp_path, caplog):
+    """
+    Test `calypso-anemometer serve --config=calypso.toml` with an invalid configuration
+    """
+    config = tmp_path / "calypso.toml"
+    config.write_text('[[devices]]\nname = "masthead"\n')
+    runner = CliRunner()
+    result = runner.invoke(cli, ["serve", "--config", str(config)], catch_exceptions=False)
+    assert result.exit_code == 1
+    assert "Unknown pipeline for device 'masthead': default" in caplog.messages
+
+
+def test_cli_read_emulate(caplog):
+    """
+    Test `calypso-anemometer read --emulate`, running the real driver against the emulated peripheral
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, shlex.split("read --emulate"), catch_exceptions=False)
+    assert result.exit_code == 0
+    reading = json.loads(result.stdout)
+    assert reading["wind_speed"] == 1.0
+    assert "Connecting to device at '00:00:00:00:CA:1F' with adapter 'hci0'" in caplog.messages
+    assert "Disconnecting" in caplog.messages
+
+
 @mock.patch(
     "calypso_anemometer.core.BleakScanner.find_device_by_filter",
     AsyncMock(return_value=BLEDevice(name="foo", address="bar")),
@@ -146,7 +514,9 @@ def test_cli_read_stdout_success(caplog):
 @mock.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
 @mock.patch("calypso_anemometer.core.BleakClient.write_gatt_char", AsyncMock(return_value=None))
 @mock.patch("calypso_anemometer.core.BleakClient.start_notify", AsyncMock(return_value=None))
-@mock.patch("calypso_anemometer.engine.wait_forever", AsyncMock(return_value=None))
+@mock.patch("calypso_anemometer.core.BleakClient.stop_notify", AsyncMock(return_value=None))
+# Request shutdown right away, instead of waiting for a signal.
+@mock.patch("calypso_anemometer.shutdown.ShutdownSignal.install", ShutdownSignal.trigger)
 def test_cli_subscribe_rate_compass_stdout_success(caplog):
     """
     Test successful `calypso-anemometer read --subscribe`
@@ -166,7 +536,10 @@ def test_cli_subscribe_rate_compass_stdout_success(caplog):
     assert "Setting data rate to 8" in caplog.messages
     assert "Setting compass status to 1" in caplog.messages
     assert "Subscribing to readings" in caplog.messages
+    assert "Unsubscribing from readings" in caplog.messages
+    assert "Shutdown: flushed=0, dropped=0" in caplog.text
     assert "Disconnecting" in caplog.messages
+    assert caplog.messages.index("Unsubscribing from readings") < caplog.messages.index("Disconnecting")
 
 
 @mock.patch(
@@ -194,6 +567,26 @@ def test_cli_read_failure(caplog):
     assert "Disconnecting" in caplog.messages
 
 
+def test_cli_read_watchdog_hard_timeout_without_tolerance():
+    """
+    Test `calypso-anemometer read --subscribe --watchdog-hard-timeout=60` fails without `--watchdog-tolerance`
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, ["read", "--subscribe", "--watchdog-hard-timeout=60"], catch_exceptions=False)
+    assert result.exit_code == 2
+    assert "Option `--watchdog-hard-timeout` requires `--watchdog-tolerance`" in result.output
+
+
+def test_cli_read_queue_overflow_block_unsupported():
+    """
+    Test `calypso-anemometer read --subscribe --queue-overflow=BLOCK` fails
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, ["read", "--subscribe", "--queue-overflow=BLOCK"], catch_exceptions=False)
+    assert result.exit_code == 2
+    assert "Option `--queue-overflow=BLOCK` is only supported by the fake device" in result.output
+
+
 @mock.patch(
     "calypso_anemometer.core.BleakScanner.find_device_by_filter",
     AsyncMock(return_value=BLEDevice(name="foo", address="bar")),
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import dataclasses
+import time
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from calypso_anemometer.controller import AdaptiveController, AdaptiveSettings
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.model import CalypsoDeviceDataRate, CalypsoDeviceMode
+from testing.data import dummy_reading
+
+NOON = time.mktime((2023, 2, 24, 12, 0, 0, 0, 0, -1))
+MIDNIGHT = time.mktime((2023, 2, 24, 0, 0, 0, 0, 0, -1))
+
+
+def make_readings(speeds, battery_level=90, interval=0.25):
+    return [
+        dataclasses.replace(dummy_reading, wind_speed=speed, battery_level=battery_level).stamp(
+            monotonic=index * interval
+        )
+        for index, speed in enumerate(speeds)
+    ]
+
+
+def test_adaptive_settings_night():
+    settings = AdaptiveSettings(night_start=21, night_end=6)
+    assert settings.is_night(23) is True
+    assert settings.is_night(3) is True
+    assert settings.is_night(12) is False
+    assert AdaptiveSettings(night_start=1, night_end=5).is_night(3) is True
+    assert AdaptiveSettings(night_start=None).is_night(3) is False
+
+
+@pytest.mark.parametrize(
+    "speeds,battery_level,clock,mode,rate",
+    [
+        ([5.0, 5.5] * 10, 90, NOON, CalypsoDeviceMode.NORMAL, CalypsoDeviceDataRate.HZ_4),
+        ([2.0, 9.0] * 10, 90, NOON, CalypsoDeviceMode.NORMAL, CalypsoDeviceDataRate.HZ_8),
+        ([0.2, 0.3] * 10, 90, NOON, CalypsoDeviceMode.NORMAL, CalypsoDeviceDataRate.HZ_1),
+        ([2.0, 9.0] * 10, 20, NOON, CalypsoDeviceMode.LOW_POWER, CalypsoDeviceDataRate.HZ_1),
+        ([2.0, 9.0] * 10, 90, MIDNIGHT, CalypsoDeviceMode.LOW_POWER, CalypsoDeviceDataRate.HZ_1),
+    ],
+)
+def test_adaptive_controller_decide(speeds, battery_level, clock, mode, rate):
+    controller = AdaptiveController(device=CalypsoDeviceApiFake(), callback=Mock(), clock=lambda: clock)
+    for reading in make_readings(speeds, battery_level=battery_level):
+        controller.samples.append((reading.received_monotonic, reading.wind_speed))
+    assert controller.decide(battery_level=battery_level)[:2] == (mode, rate)
+
+
+@pytest.mark.asyncio
+async def test_adaptive_controller_apply():
+    callback = Mock()
+    async with CalypsoDeviceApiFake() as fake:
+        controller = AdaptiveController(device=fake, callback=callback, clock=lambda: NOON)
+
+        # Gusty conditions will increase the data rate.
+        for reading in make_readings([2.0, 9.0] * 10):
+            controller.on_reading(reading)
+        await controller.apply_task
+        assert fake.mode is CalypsoDeviceMode.NORMAL
+        assert fake.datarate is CalypsoDeviceDataRate.HZ_8
+        assert controller.metrics.changes == 1
+        assert controller.metrics.last_reason == "gusty, stdev 3.50 m/s"
+
+        # Within the hold time, the configuration will not change again, even at low battery.
+        for reading in make_readings([2.0, 9.0] * 10, battery_level=10):
+            controller.on_reading(reading)
+        assert controller.metrics.changes == 1
+        assert fake.mode is CalypsoDeviceMode.NORMAL
+
+    assert callback.call_count == 40
+
+
+@pytest.mark.asyncio
+async def test_adaptive_controller_low_power():
+    async with CalypsoDeviceApiFake() as fake:
+        controller = AdaptiveController(device=fake, callback=Mock(), clock=lambda: MIDNIGHT)
+        for reading in make_readings([5.0] * 10):
+            controller.on_reading(reading)
+        await controller.apply_task
+        assert fake.mode is CalypsoDeviceMode.LOW_POWER
+        assert fake.datarate is CalypsoDeviceDataRate.HZ_1
+        controller.stop()
+
+
+@pytest.mark.asyncio
+async def test_adaptive_controller_min_samples():
+    async with CalypsoDeviceApiFake() as fake:
+        controller = AdaptiveController(device=fake, callback=Mock(), clock=lambda: MIDNIGHT)
+        for reading in make_readings([5.0] * 9):
+            controller.on_reading(reading)
+        assert controller.apply_task is None
+        assert fake.datarate is CalypsoDeviceDataRate.HZ_4
+
+
+@pytest.mark.asyncio
+async def test_adaptive_controller_mode_unsupported(caplog):
+    async with CalypsoDeviceApiFake() as fake:
+        fake.set_mode = AsyncMock(side_effect=Exception("Write not permitted"))
+        controller = AdaptiveController(device=fake, callback=Mock(), clock=lambda: MIDNIGHT)
+        for reading in make_readings([5.0] * 10):
+            controller.on_reading(reading)
+        await controller.apply_task
+
+    # The data rate is adjusted nevertheless.
+    assert fake.datarate is CalypsoDeviceDataRate.HZ_1
+    assert controller.mode_supported is False
+    assert "Setting device mode failed, continuing with data rate only: Write not permitted" in caplog.messages
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import sys
+from types import SimpleNamespace
+
+import pytest
+from pytest_mock import MockerFixture
+
+if sys.version_info < (3, 8, 0):
+    raise pytest.skip(reason="AsyncMock not supported on Python 3.7", allow_module_level=True)
+from unittest.mock import AsyncMock, PropertyMock
+
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.servicemap import GattServiceMap
+
+bleak_services = [
+    SimpleNamespace(
+        uuid="0000180a-0000-1000-8000-00805f9b34fb",
+        handle=16,
+        description="Device Information",
+        characteristics=[
+            SimpleNamespace(
+                uuid="00002a29-0000-1000-8000-00805f9b34fb",
+                handle=17,
+                description="Manufacturer Name String",
+                properties=["read"],
+                descriptors=[
+                    SimpleNamespace(
+                        uuid="00002902-0000-1000-8000-00805f9b34fb",
+                        handle=19,
+                        description="Client Characteristic Configuration",
+                    ),
+                ],
+            ),
+            SimpleNamespace(
+                uuid="0000a002-0000-1000-8000-00805f9b34fb",
+                handle=20,
+                description="Unknown",
+                properties=["write"],
+                descriptors=[],
+            ),
+        ],
+    ),
+]
+
+
+def test_servicemap_from_bleak():
+    service_map = GattServiceMap.from_bleak(bleak_services)
+    char = service_map.services[0].characteristics[0]
+    assert str(char) == "00002a29-0000-1000-8000-00805f9b34fb (Handle: 17): Manufacturer Name String"
+    assert char.descriptors[0].handle == 19
+    assert service_map.asdict()["services"][0]["characteristics"][1]["properties"] == ["write"]
+
+
+@pytest.mark.asyncio
+async def test_explore(mocker: MockerFixture, caplog):
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+    mocker.patch("calypso_anemometer.core.BleakClient.services", PropertyMock(return_value=bleak_services))
+    read_gatt_char = mocker.patch(
+        "calypso_anemometer.core.BleakClient.read_gatt_char", AsyncMock(return_value=b"Calypso Instruments")
+    )
+    mocker.patch("calypso_anemometer.core.BleakClient.read_gatt_descriptor", AsyncMock(return_value=b"\x00\x00"))
+
+    async with CalypsoDeviceApi(ble_address="bar") as calypso:
+        await calypso.explore()
+
+    # Only readable characteristics are read, by handle.
+    assert read_gatt_char.call_count == 1
+    read_gatt_char.assert_called_with(17)
+
+    assert "Found service: 0000180a-0000-1000-8000-00805f9b34fb (Handle: 16): Device Information" in caplog.messages
+    assert (
+        "  Found characteristic: 00002a29-0000-1000-8000-00805f9b34fb (Handle: 17): Manufacturer Name String. "
+        "properties=read" in caplog.messages
+    )
+    assert "  Value: b'Calypso Instruments'" in caplog.messages
+    assert "  Value: None" in caplog.messages
+    assert "    Value: b'\\x00\\x00'" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_explore_read_failure(mocker: MockerFixture, caplog):
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+    mocker.patch("calypso_anemometer.core.BleakClient.services", PropertyMock(return_value=bleak_services))
+    mocker.patch("calypso_anemometer.core.BleakClient.read_gatt_char", AsyncMock(side_effect=Exception("Failed")))
+    mocker.patch("calypso_anemometer.core.BleakClient.read_gatt_descriptor", AsyncMock(side_effect=Exception("Failed")))
+
+    async with CalypsoDeviceApi(ble_address="bar") as calypso:
+        await calypso.explore()
+
+    assert (
+        "  Reading characteristic failed: 00002a29-0000-1000-8000-00805f9b34fb (Handle: 17): Manufacturer Name String"
+        in caplog.messages
+    )
+    assert (
+        "    Reading descriptor failed: 00002902-0000-1000-8000-00805f9b34fb (Handle: 19): "
+        "Client Characteristic Configuration" in caplog.messages
+    )
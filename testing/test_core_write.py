@@ -13,7 +13,7 @@ from pytest_mock import MockerFixture
 
 import calypso_anemometer
 from calypso_anemometer.core import CalypsoDeviceApi
-from calypso_anemometer.model import CalypsoDeviceCompassStatus, CalypsoDeviceDataRate
+from calypso_anemometer.model import CalypsoDeviceCompassStatus, CalypsoDeviceDataRate, CalypsoDeviceMode
 
 
 @pytest.mark.asyncio
@@ -32,6 +32,20 @@ async def test_set_datarate_success(mocker: MockerFixture, caplog):
     assert "Disconnecting" in caplog.messages
 
 
+@pytest.mark.asyncio
+async def test_set_mode_success(mocker: MockerFixture, caplog):
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+    mocker.patch("calypso_anemometer.core.BleakClient.write_gatt_char", AsyncMock(return_value=None))
+
+    spy = mocker.spy(calypso_anemometer.core.BleakClient, "write_gatt_char")
+    async with CalypsoDeviceApi(ble_address="bar") as calypso:
+        await calypso.set_mode(CalypsoDeviceMode.LOW_POWER)
+        assert calypso.mode is CalypsoDeviceMode.LOW_POWER
+
+    assert spy.mock_calls == [call("0000a001-0000-1000-8000-00805f9b34fb", data=b"\x01", response=True)]
+    assert "Setting device mode to 1" in caplog.messages
+
+
 @pytest.mark.asyncio
 async def test_set_compass_enabled(mocker: MockerFixture, caplog):
     mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import logging
+
+import pytest
+
+from calypso_anemometer.daemon import Daemon, DaemonConfig, DeviceConfig, PipelineConfig, make_stage
+from calypso_anemometer.exception import CalypsoConfigurationError
+from calypso_anemometer.model import (
+    CalypsoDeviceCompassStatus,
+    CalypsoDeviceDataRate,
+    CalypsoReading,
+    QueueOverflowPolicy,
+)
+from calypso_anemometer.pipeline import AggregateStage, FilterStage
+
+CONFIG = """
+[[devices]]
+name = "masthead"
+driver = "fake"
+rate = "hz_8"
+queue_size = 0
+
+[pipelines.default]
+stdout = true
+
+[[pipelines.default.stages]]
+type = "filter"
+field = "wind_speed"
+min = 1.0
+"""
+
+
+def test_config_from_file(tmp_path):
+    path = tmp_path / "calypso.toml"
+    path.write_text(CONFIG)
+    config = DaemonConfig.from_file(str(path))
+    assert config.devices == [
+        DeviceConfig(name="masthead", driver="fake", rate=CalypsoDeviceDataRate.HZ_8, queue_size=0),
+    ]
+    assert config.pipelines == {
+        "default": PipelineConfig(stdout=True, stages=[{"type": "filter", "field": "wind_speed", "min": 1.0}])
+    }
+    assert config.devices[0].queue_overflow is QueueOverflowPolicy.DROP_OLDEST
+
+
+@pytest.mark.parametrize(
+    "data,message",
+    [
+        ({}, "No devices configured"),
+        ({"devices": [{"name": "a"}], "foo": {}}, "Unknown sections: foo"),
+        ({"devices": [{"driver": "fake"}]}, "Device #1 needs a name"),
+        ({"devices": [{"name": "a", "foo": 1}]}, "Unknown settings for device 'a': foo"),
+        ({"devices": [{"name": "a", "rate": "HZ_2"}]}, "Invalid value for device 'a': rate='HZ_2'"),
+        ({"devices": [{"name": "a", "driver": "foo"}]}, "Invalid driver for device 'a': foo"),
+        ({"devices": [{"name": "a", "watchdog_hard_timeout": 5.0}]}, "requires `watchdog_tolerance`"),
+        ({"devices": [{"name": "a", "queue_overflow": "block"}]}, "only supported by the fake driver"),
+        ({"devices": [{"name": "a", "driver": "fake", "reconnect": True}]}, "not supported by the fake driver"),
+        ({"devices": [{"name": "a"}, {"name": "a"}], "pipelines": {"default": {}}}, "Duplicate device names: a"),
+        ({"devices": [{"name": "a", "pipeline": "foo"}]}, "Unknown pipeline for device 'a': foo"),
+        ({"devices": [{"name": "a"}], "pipelines": {"default": {"foo": 1}}}, "Unknown settings for pipeline"),
+        (
+            {"devices": [{"name": "a"}], "pipelines": {"default": {"stages": [{"type": "foo"}]}}},
+            "Unknown stage type in pipeline 'default': foo",
+        ),
+        (
+            {"devices": [{"name": "a"}], "pipelines": {"default": {"stages": [{"type": "aggregate"}]}}},
+            "Invalid stage 'aggregate' in pipeline 'default'",
+        ),
+    ],
+)
+def test_config_invalid(data, message):
+    with pytest.raises(CalypsoConfigurationError) as ex:
+        DaemonConfig.from_dict(data)
+    assert message in str(ex.value)
+
+
+def test_config_file_invalid(tmp_path):
+    path = tmp_path / "calypso.toml"
+    path.write_text("[[devices]\n")
+    with pytest.raises(CalypsoConfigurationError) as ex:
+        DaemonConfig.from_file(str(path))
+    assert ex.match("Unable to read configuration file")
+
+
+def test_make_stage():
+    aggregate = make_stage({"type": "aggregate", "window": 4})
+    assert isinstance(aggregate, AggregateStage)
+    assert aggregate.window == 4
+    stage = make_stage({"type": "filter", "field": "wind_speed", "min": 1.0, "max": 2.0})
+    assert isinstance(stage, FilterStage)
+    assert stage.name == "filter-wind_speed"
+    readings = [
+        CalypsoReading(
+            wind_speed=value, wind_direction=90, battery_level=80, temperature=20, roll=0, pitch=0, heading=0
+        )
+        for value in [0.5, 1.0, 2.0, 2.5]
+    ]
+    assert [stage(reading) is not None for reading in readings] == [False, True, True, False]
+    with pytest.raises(CalypsoConfigurationError) as ex:
+        make_stage({"type": "filter", "field": "received_time"})
+    assert ex.match("Unknown field: received_time")
+
+
+def test_make_stage_true_wind():
+    pytest.importorskip("numpy")
+    stage = make_stage({"type": "true_wind", "speed": 5.0, "course": 0.0})
+    assert stage.name == "true-wind"
+    reading = stage(
+        CalypsoReading(wind_speed=5.0, wind_direction=0, battery_level=80, temperature=20, roll=0, pitch=0, heading=0)
+    )
+    assert reading.true_wind.speed == 0.0
+    with pytest.raises(CalypsoConfigurationError) as ex:
+        make_stage({"type": "true_wind", "speed": 5.0})
+    assert ex.match("Invalid stage 'true_wind' in pipeline: Fixed boat motion needs both speed and course")
+
+
+def test_make_stage_true_wind_without_numpy(mocker):
+    mocker.patch.dict("sys.modules", {"numpy": None, "calypso_anemometer.truewind": None})
+    with pytest.raises(CalypsoConfigurationError) as ex:
+        make_stage({"type": "true_wind", "speed": 5.0, "course": 0.0})
+    assert ex.match("Invalid stage 'true_wind' in pipeline: import of calypso_anemometer.truewind halted")
+
+
+def test_make_stage_hampel():
+    stage = make_stage({"type": "hampel", "fields": ["wind_speed"], "window": 3, "tolerances": {"wind_speed": 1.0}})
+    assert stage.name == "hampel"
+    assert stage.filters["wind_speed"].tolerance == 1.0
+    with pytest.raises(CalypsoConfigurationError) as ex:
+        make_stage({"type": "hampel", "window": 2})
+    assert ex.match("Invalid stage 'hampel' in pipeline: Window must be at least 3: 2")
+
+
+def test_device_restart_settings():
+    device = DeviceConfig(name="a", rate=CalypsoDeviceDataRate.HZ_1)
+    update = DeviceConfig(name="a", rate=CalypsoDeviceDataRate.HZ_4, ble_adapter="hci1", reconnect=True)
+    assert device.restart_settings(update) == ["ble_adapter", "reconnect"]
+
+
+@pytest.mark.asyncio
+async def test_daemon_reload(tmp_path, capsys, caplog):
+    """
+    Changing pipelines and the data rate is applied without reconnecting, other changes are reported.
+    """
+    caplog.set_level(logging.INFO)
+    path = tmp_path / "calypso.toml"
+    path.write_text(CONFIG)
+    daemon = Daemon(config=DaemonConfig.from_file(str(path)), path=str(path))
+    task = asyncio.ensure_future(daemon.run())
+    await asyncio.sleep(0.5)
+    device = daemon.connected["masthead"]
+    assert device.datarate is CalypsoDeviceDataRate.HZ_8
+
+    update = (
+        CONFIG.replace('rate = "hz_8"', 'rate = "hz_4"\ncompass = "on"\nble_adapter = "hci1"')
+        .replace("min = 1.0", "min = 0.0")
+        .replace("[pipelines.default]", '[[devices]]\nname = "other"\ndriver = "fake"\n\n[pipelines.default]')
+    )
+    path.write_text(update)
+    assert await daemon.reload() is True
+    await asyncio.sleep(0.3)
+
+    # The device has not been reconnected.
+    assert daemon.connected["masthead"] is device
+    assert device.datarate is CalypsoDeviceDataRate.HZ_4
+    assert device.compass is CalypsoDeviceCompassStatus.ON
+    assert daemon.config.devices[0].rate is CalypsoDeviceDataRate.HZ_4
+    assert daemon.config.devices[0].ble_adapter == "hci0"
+    assert daemon.config.pipelines["default"].stages[0]["min"] == 0.0
+    assert "Changing ble_adapter of device 'masthead' requires a restart" in caplog.messages
+    assert "Adding device 'other' requires a restart" in caplog.messages
+    assert "Reloaded pipeline 'default'" in caplog.messages
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert daemon.pipelines["masthead"].pipeline.closed is True
+    assert capsys.readouterr().out.count('"wind_speed"') >= 4
+
+
+@pytest.mark.asyncio
+async def test_daemon_reload_invalid(tmp_path, caplog):
+    path = tmp_path / "calypso.toml"
+    path.write_text(CONFIG)
+    config = DaemonConfig.from_file(str(path))
+    daemon = Daemon(config=config, path=str(path))
+    path.write_text("foo")
+    assert await daemon.reload() is False
+    assert daemon.config is config
+    assert "Keeping current configuration" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_daemon_shutdown(tmp_path, caplog):
+    """
+    Shutting down stops all devices, and flushes their pipelines.
+    """
+    caplog.set_level(logging.INFO)
+    data = {
+        "devices": [{"name": "a", "driver": "fake"}, {"name": "b", "driver": "fake"}],
+        "pipelines": {"default": {"record": str(tmp_path / "readings-{device}.jsonl")}},
+    }
+    daemon = Daemon(config=DaemonConfig.from_dict(data))
+    task = asyncio.ensure_future(daemon.run())
+    await asyncio.sleep(0.5)
+    daemon.shutdown.trigger()
+    await asyncio.wait_for(task, timeout=5)
+    assert len([message for message in caplog.messages if message.startswith("Shutdown:")]) == 2
+    for name in ["a", "b"]:
+        assert len((tmp_path / f"readings-{name}.jsonl").read_text().splitlines()) >= 1
+        assert daemon.pipelines[name].pipeline.closed is True
+
+
+@pytest.mark.asyncio
+async def test_daemon_shared_pipeline(tmp_path):
+    """
+    Devices sharing a pipeline each run through their own instance of it, so their aggregates stay separate.
+    """
+    data = {
+        "devices": [
+            {"name": "a", "driver": "fake", "queue_size": 0},
+            {"name": "b", "driver": "fake", "queue_size": 0},
+        ],
+        "pipelines": {"default": {"stages": [{"type": "aggregate", "window": 2}]}},
+    }
+    daemon = Daemon(config=DaemonConfig.from_dict(data))
+    task = asyncio.ensure_future(daemon.run())
+    await asyncio.sleep(0.6)
+    aggregates = {name: daemon.pipelines[name].pipeline.stages[0] for name in ["a", "b"]}
+    devices = {name: daemon.connected[name] for name in ["a", "b"]}
+    daemon.shutdown.trigger()
+    await asyncio.wait_for(task, timeout=5)
+    readings = {name: device.arrival_statistics.count for name, device in devices.items()}
+
+    assert aggregates["a"] is not aggregates["b"]
+    for name in ["a", "b"]:
+        assert isinstance(aggregates[name], AggregateStage)
+        assert aggregates[name].metrics.received == readings[name]
+        assert daemon.pipelines[name].pipeline.closed is True
+
+
+def test_config_shared_recording():
+    data = {
+        "devices": [{"name": "a", "driver": "fake"}, {"name": "b", "driver": "fake"}],
+        "pipelines": {"default": {"record": "readings.jsonl"}},
+    }
+    with pytest.raises(CalypsoConfigurationError) as ex:
+        DaemonConfig.from_dict(data)
+    assert ex.match("Pipeline 'default' is used by multiple devices, so its `record` setting needs a `{device}`")
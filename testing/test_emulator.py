@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import time
+
+import pytest
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.emulator import EmulatedPeripheral, EmulatorSettings
+from calypso_anemometer.exception import BluetoothConversationError
+from calypso_anemometer.model import (
+    CalypsoDeviceCompassStatus,
+    CalypsoDeviceDataRate,
+    CalypsoDeviceMode,
+    CalypsoDeviceStatus,
+    Settings,
+)
+from calypso_anemometer.supervisor import CalypsoDeviceSupervisor
+
+
+def make_device(peripheral: EmulatedPeripheral) -> CalypsoDeviceApi:
+    return CalypsoDeviceApi(ble_address=peripheral.ADDRESS, client_factory=peripheral.client)
+
+
+async def collect(calypso, count: int, **kwargs):
+    readings = []
+    done = asyncio.Event()
+
+    def callback(reading):
+        readings.append(reading)
+        if len(readings) == count:
+            done.set()
+
+    await calypso.subscribe_reading(callback, **kwargs)
+    await asyncio.wait_for(done.wait(), timeout=5.0)
+    return readings
+
+
+@pytest.mark.asyncio
+async def test_emulator_info_status():
+    peripheral = EmulatedPeripheral()
+    async with make_device(peripheral) as calypso:
+        info = await calypso.get_info()
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        await calypso.set_compass(CalypsoDeviceCompassStatus.ON)
+        status = await calypso.get_status()
+        reading = await calypso.get_reading()
+
+    assert info.ble_address == "00:00:00:00:CA:1F"
+    assert info.manufacturer_name == "Calypso Instruments"
+    assert status == CalypsoDeviceStatus(
+        mode=CalypsoDeviceMode.NORMAL, rate=CalypsoDeviceDataRate.HZ_8, compass=CalypsoDeviceCompassStatus.ON
+    )
+    assert reading.wind_speed == 1.0
+    assert peripheral.metrics.connects == 1
+    assert peripheral.metrics.disconnects == 1
+
+
+@pytest.mark.asyncio
+async def test_emulator_subscribe():
+    peripheral = EmulatedPeripheral()
+    async with make_device(peripheral) as calypso:
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        started = time.monotonic()
+        queue = ReadingQueue()
+        readings = await collect(calypso, 3, queue=queue)
+        elapsed = time.monotonic() - started
+        await calypso.unsubscribe_reading()
+
+    # The consumer task of the queue does not outlive the device context.
+    assert not queue.running
+    assert [reading.wind_speed for reading in readings] == [1.0, 2.0, 3.0]
+    assert elapsed == pytest.approx(3 * 0.125, abs=0.1)
+    assert calypso.arrival_statistics.count == 3
+
+
+@pytest.mark.asyncio
+async def test_emulator_drop_jitter():
+    peripheral = EmulatedPeripheral(EmulatorSettings(drop_rate=0.5, notify_jitter=0.5, seed=42))
+    peripheral.source.datarate = CalypsoDeviceDataRate.HZ_8
+    peripheral.settings.seed = 42
+    async with make_device(peripheral) as calypso:
+        await collect(calypso, 5)
+    assert peripheral.metrics.notifications == 5
+    assert peripheral.metrics.dropped > 0
+
+
+@pytest.mark.asyncio
+async def test_emulator_unavailable():
+    peripheral = EmulatedPeripheral(EmulatorSettings(connect_latency=0.05))
+    peripheral.available = False
+    started = time.monotonic()
+    with pytest.raises(BluetoothConversationError) as ex:
+        async with make_device(peripheral):
+            pass
+    assert time.monotonic() - started >= 0.05
+    assert ex.match("Device with address 00:00:00:00:CA:1F was not found.")
+
+
+@pytest.mark.asyncio
+async def test_emulator_supervisor_force_disconnect():
+    """
+    End to end: Reconnect after link loss, restore the data rate, and resume the subscription.
+    """
+    peripheral = EmulatedPeripheral()
+    settings = Settings(ble_address=peripheral.ADDRESS)
+    supervisor = CalypsoDeviceSupervisor(
+        settings=settings, workhorse=lambda settings: CalypsoDeviceApi(settings, client_factory=peripheral.client)
+    )
+    async with supervisor as calypso:
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        readings = await collect(calypso, 2)
+
+        # The device forgets its settings, and the link drops.
+        peripheral.source.datarate = CalypsoDeviceDataRate.HZ_1
+        peripheral.force_disconnect()
+        await asyncio.sleep(0)
+        await supervisor.reconnect_task
+
+        count = len(readings)
+        while len(readings) < count + 2:
+            await asyncio.sleep(0.01)
+
+    assert peripheral.source.datarate is CalypsoDeviceDataRate.HZ_8
+    assert peripheral.metrics.connects == 2
+    assert supervisor.metrics.reconnects == 1
+
+
+@pytest.mark.asyncio
+async def test_emulator_disconnect_interval():
+    peripheral = EmulatedPeripheral(EmulatorSettings(disconnect_interval=0.05))
+    supervisor = CalypsoDeviceSupervisor(
+        settings=Settings(ble_address=peripheral.ADDRESS),
+        workhorse=lambda settings: CalypsoDeviceApi(settings, client_factory=peripheral.client),
+    )
+    async with supervisor:
+        await asyncio.sleep(0.12)
+    assert supervisor.metrics.disconnects >= 1
+    assert supervisor.metrics.reconnects >= 1
+
+
+@pytest.mark.asyncio
+async def test_emulator_sleep_mode():
+    peripheral = EmulatedPeripheral()
+    async with make_device(peripheral) as calypso:
+        await calypso.set_mode(CalypsoDeviceMode.SLEEP)
+        assert peripheral.interval is None
+        await calypso.set_mode(CalypsoDeviceMode.LOW_POWER)
+        assert peripheral.interval == 1.0
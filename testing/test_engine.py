@@ -43,3 +43,52 @@ async def test_run_engine_with_address_success(mocker: MockerFixture):
     handler = await handler_factory()
     worker: CalypsoDeviceApi = await run_engine(workhorse=CalypsoDeviceApi, settings=settings, handler=handler)
     assert worker.ble_address == "F8:C7:2C:EC:13:D0"
+
+
+@pytest.mark.asyncio
+async def test_run_engine_pipeline_stages(capsys):
+    """
+    Additional stages run before the sinks, and no STDOUT sink is used in quiet mode.
+    """
+    from calypso_anemometer.fake import CalypsoDeviceApiFake
+    from calypso_anemometer.pipeline import FilterStage, FunctionStage
+
+    readings = []
+    stages = [
+        FunctionStage(lambda reading: readings.append(reading) or reading, name="collect"),
+        FilterStage(lambda reading: False, name="drop-all"),
+    ]
+    handler = await handler_factory(quiet=True, stages=stages)
+    await run_engine(workhorse=CalypsoDeviceApiFake, handler=handler)
+
+    assert len(readings) == 1
+    assert stages[1].metrics.dropped == 1
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.asyncio
+async def test_run_engine_metrics_server(caplog):
+    """
+    The metrics server is started while subscribed to readings, and stopped afterwards.
+    """
+    from calypso_anemometer.fleet import FakeFleet
+
+    handler = await handler_factory(subscribe=True, quiet=True, metrics_address="localhost:0")
+    await FakeFleet(devices=2, report_interval=None).run(handler, duration=0.2)
+    assert len([message for message in caplog.messages if message.startswith("Serving metrics at")]) == 1
+
+
+@pytest.mark.asyncio
+async def test_run_engine_percentiles_per_device(tmp_path, caplog):
+    """
+    Wind speed percentiles are only estimated when requested, and kept per device.
+    """
+    from calypso_anemometer.fleet import FakeFleet
+
+    handler = await handler_factory(subscribe=True, quiet=True)
+    await FakeFleet(devices=2, report_interval=None).run(handler, duration=0.2)
+    assert not [message for message in caplog.messages if message.startswith("Wind speed at")]
+
+    handler = await handler_factory(subscribe=True, quiet=True, sketch=str(tmp_path / "{device}.json"))
+    await FakeFleet(devices=2, report_interval=None).run(handler, duration=0.2)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["00-00-00-FA-00-00.json", "00-00-00-FA-00-01.json"]
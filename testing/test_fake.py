@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@panodata.org>
 # License: GNU Affero General Public License, Version 3
+import asyncio
+from copy import deepcopy
 from unittest.mock import Mock
 
 import pytest
@@ -38,6 +40,56 @@ async def test_subscribe_once():
 @pytest.mark.asyncio
 async def test_reading_wrap_around():
     fake = CalypsoDeviceApiFake()
-    fake.reading = MAXIMUM_VALUES
+    fake.reading = deepcopy(MAXIMUM_VALUES)
     reading = await fake.produce_fake_reading()
     assert reading == MINIMUM_VALUES
+
+
+@pytest.mark.asyncio
+async def test_produce_fake_readings_chunk():
+    """
+    Producing readings in chunks yields the same sequence as producing them one by one.
+    """
+    fake = CalypsoDeviceApiFake()
+    fake.reading = deepcopy(MAXIMUM_VALUES)
+    fake.reading.temperature = 95
+    expected = [await fake.produce_fake_reading() for _ in range(250)]
+
+    fake.reading = deepcopy(MAXIMUM_VALUES)
+    fake.reading.temperature = 95
+    assert fake.produce_fake_readings(250) == expected
+    assert fake.reading == expected[-1]
+    assert fake.reading is not expected[-1]
+
+
+def test_batch_size_invalid():
+    with pytest.raises(ValueError) as ex:
+        CalypsoDeviceApiFake(batch_size=0)
+    assert ex.match("Batch size must be a positive number: 0")
+
+
+@pytest.mark.asyncio
+async def test_subscribe_unlimited_batch():
+    readings = []
+    async with CalypsoDeviceApiFake(unlimited=True, batch_size=100) as fake:
+
+        def callback(reading):
+            readings.append(reading)
+            if len(readings) == 1000:
+                fake.subscription = None
+
+        # Way more readings than at 8 Hz, within a short time.
+        await asyncio.wait_for(fake.subscribe_reading(callback), timeout=1.0)
+
+    assert len(readings) == 1000
+    assert [reading.wind_speed for reading in readings[:3]] == [1, 2, 3]
+    assert all(reading.received_time is not None for reading in readings)
+    assert fake.arrival_statistics.count == 10
+
+
+@pytest.mark.asyncio
+async def test_subscribe_batch_once():
+    callback = Mock()
+    async with CalypsoDeviceApiFake(batch_size=5) as fake:
+        await fake.subscribe_reading(callback=callback, run_once=True)
+    assert callback.call_count == 5
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import pytest
+
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.fleet import FakeFleet, FleetReport, fleet_address
+from calypso_anemometer.model import CalypsoDeviceDataRate
+
+
+def test_fleet_address():
+    assert fleet_address(0) == "00:00:00:FA:00:00"
+    assert fleet_address(1) == "00:00:00:FA:00:01"
+    assert fleet_address(299) == "00:00:00:FA:01:2B"
+
+
+def test_fleet_invalid():
+    with pytest.raises(ValueError) as ex:
+        FakeFleet(devices=0)
+    assert ex.match("Number of devices must be a positive number: 0")
+
+
+@pytest.mark.asyncio
+async def test_fleet_run():
+    """
+    All fleet members feed the same handler, and the report accounts for all of them.
+    """
+    fleet = FakeFleet(devices=10, report_interval=None)
+    addresses = set()
+    readings = []
+
+    async def handler(calypso):
+        addresses.add(calypso.ble_address)
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        await calypso.subscribe_reading(readings.append)
+
+    report = await fleet.run(handler, duration=0.3)
+
+    assert len(addresses) == 10
+    assert isinstance(report, FleetReport)
+    assert report.devices == 10
+    assert report.readings == len(readings)
+    assert 20 <= report.readings <= 40
+    assert report.duration == pytest.approx(0.3, abs=0.1)
+    assert report.cpu_per_reading > 0
+    assert report.loop_lag_max is not None
+    assert report.memory_peak > 0
+    assert "devices=10, readings=" in str(report)
+
+    # Devices have been disconnected.
+    assert all(device.reading is None for device in fleet.devices)
+
+
+@pytest.mark.asyncio
+async def test_fleet_device_factory_batch():
+    fleet = FakeFleet(
+        devices=2,
+        device_factory=lambda index: CalypsoDeviceApiFake(ble_address=fleet_address(index), batch_size=5),
+        report_interval=None,
+    )
+    readings = []
+
+    async def handler(calypso):
+        await calypso.subscribe_reading(readings.append, run_once=True)
+
+    report = await fleet.run(handler)
+    assert report.readings == len(readings) == 10
+
+
+@pytest.mark.asyncio
+async def test_fleet_handler_error():
+    fleet = FakeFleet(devices=3, report_interval=None)
+
+    async def handler(calypso):
+        raise RuntimeError("Something failed")
+
+    with pytest.raises(RuntimeError) as ex:
+        await fleet.run(handler, duration=1.0)
+    assert ex.match("Something failed")
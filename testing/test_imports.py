@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import subprocess
+import sys
+import typing as t
+
+import pytest
+
+# Modules which are expensive to import, and not needed for running commands which do not talk to a device.
+HEAVY_MODULES = [
+    "bleak",
+    "calypso_anemometer.core",
+    "calypso_anemometer.telemetry.adapter",
+    "calypso_anemometer.telemetry.nmea0183",
+    "calypso_anemometer.telemetry.signalk",
+    "calypso_anemometer.metrics",
+    "calypso_anemometer.truewind",
+    "numpy",
+]
+
+
+def imported_modules(code: str) -> t.List[str]:
+    """
+    Run Python code in a subprocess, and return the names of all imported modules, using `-X importtime`.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=60,
+    )
+    modules = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        modules.append(line.rsplit("|", 1)[-1].strip())
+    assert "calypso_anemometer.cli" in modules, process.stderr
+    return modules
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        pytest.param([], id="import"),
+        pytest.param(["--version"], id="version"),
+        pytest.param(["fake"], id="fake"),
+    ],
+)
+def test_cli_startup_skips_heavy_imports(args):
+    """
+    Starting the CLI without talking to a device must not import Bleak, the device driver, or telemetry renderers.
+    """
+    code = "from calypso_anemometer.cli import cli\n"
+    if args:
+        code += f"cli({args!r})\n"
+    modules = imported_modules(code)
+    for module in HEAVY_MODULES:
+        assert module not in modules, f"Module '{module}' imported on startup"
+
+
+def test_signalk_skips_device_driver():
+    """
+    Rendering SignalK messages must not import the device driver, and with it Bleak.
+    """
+    modules = imported_modules("import calypso_anemometer.telemetry.signalk, calypso_anemometer.cli")
+    assert "calypso_anemometer.telemetry.signalk" in modules
+    assert "calypso_anemometer.core" not in modules
+    assert "bleak" not in modules
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import dataclasses
+
+import pytest
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.exception import CalypsoDecodingError
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.metrics import (
+    Counter,
+    EngineMetrics,
+    Gauge,
+    Histogram,
+    MetricFamily,
+    MetricsRegistry,
+    MetricsServer,
+    Summary,
+    format_labels,
+)
+from calypso_anemometer.model import CalypsoDeviceDataRate
+from calypso_anemometer.pipeline import FanOutStage, Pipeline, QuantileStage, SourceStage, TelemetrySink
+from calypso_anemometer.stats import LoopLagProbe, TDigest
+from calypso_anemometer.supervisor import SupervisorMetrics
+from calypso_anemometer.telemetry.adapter import TelemetryAdapter
+from testing.data import dummy_reading, dummy_wire_message_bad, dummy_wire_message_good
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter("foo_total", "Number of foos."))
+    counter.inc()
+    counter.inc(2)
+    registry.register(Gauge("bar", "Current bar.", function=lambda: 0.5))
+    registry.register(Gauge("baz", "Unknown baz.", function=lambda: None))
+    histogram = registry.register(Histogram("qux_seconds", "Qux latency.", buckets=(0.1, 1.0), labels={"a": "b"}))
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(5.0)
+    registry.add_collector(lambda: [MetricFamily("fam", "Family.").add(1, x="1").add(2, x="2").add(None, x="3")])
+
+    assert registry.render() == (
+        "# HELP foo_total Number of foos.\n"
+        "# TYPE foo_total counter\n"
+        "foo_total 3\n"
+        "# HELP bar Current bar.\n"
+        "# TYPE bar gauge\n"
+        "bar 0.5\n"
+        "# HELP baz Unknown baz.\n"
+        "# TYPE baz gauge\n"
+        "# HELP qux_seconds Qux latency.\n"
+        "# TYPE qux_seconds histogram\n"
+        'qux_seconds_bucket{a="b",le="0.1"} 2\n'
+        'qux_seconds_bucket{a="b",le="1"} 2\n'
+        'qux_seconds_bucket{a="b",le="+Inf"} 3\n'
+        'qux_seconds_sum{a="b"} 5.15\n'
+        'qux_seconds_count{a="b"} 3\n'
+        "# HELP fam Family.\n"
+        "# TYPE fam gauge\n"
+        'fam{x="1"} 1\n'
+        'fam{x="2"} 2\n'
+    )
+
+
+def test_registry_render_families():
+    """
+    Metrics of the same name are rendered as one family, with a single header.
+    """
+    registry = MetricsRegistry()
+    registry.register(Histogram("latency", "Latency.", buckets=(), labels={"target": "a"}))
+    registry.register(Histogram("latency", "Latency.", buckets=(), labels={"target": "b"}))
+    text = registry.render()
+    assert text.count("# TYPE latency histogram") == 1
+    assert 'latency_count{target="a"} 0' in text
+    assert 'latency_count{target="b"} 0' in text
+
+
+def test_registry_render_summary():
+    registry = MetricsRegistry()
+    digest = TDigest()
+    summary = registry.register(Summary("speed", "Speed.", digest, quantiles=(0.5, 1.0)))
+    assert registry.render() == "# HELP speed Speed.\n# TYPE speed summary\nspeed_sum 0\nspeed_count 0\n"
+    for value in [1.0, 2.0, 4.0]:
+        digest.update(value)
+    assert list(summary.samples()) == [
+        ("speed", {"quantile": "0.5"}, 2.0),
+        ("speed", {"quantile": "1"}, 4.0),
+        ("speed_sum", {}, 7.0),
+        ("speed_count", {}, 3),
+    ]
+
+
+def test_registry_collector_failure(caplog):
+    def collector():
+        raise RuntimeError("Something failed")
+
+    registry = MetricsRegistry()
+    registry.add_collector(collector)
+    assert registry.render() == "\n"
+    assert "Collecting metrics failed" in caplog.messages
+
+
+def test_format_labels():
+    assert format_labels({}) == ""
+    assert format_labels({"a": 'x"y\\z\n'}) == '{a="x\\"y\\\\z\\n"}'
+
+
+def test_server_address():
+    registry = MetricsRegistry()
+    server = MetricsServer.from_address(registry, "localhost:9464")
+    assert (server.host, server.port) == ("localhost", 9464)
+    server = MetricsServer.from_address(registry, ":9464")
+    assert (server.host, server.port) == (None, 9464)
+    with pytest.raises(ValueError) as ex:
+        MetricsServer.from_address(registry, "localhost")
+    assert ex.match("Invalid metrics address: localhost")
+
+
+async def http_request(port: int, request: str) -> str:
+    reader, writer = await asyncio.open_connection("localhost", port)
+    writer.write(request.encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response.decode()
+
+
+@pytest.mark.asyncio
+async def test_server_http():
+    registry = MetricsRegistry()
+    registry.register(Counter("foo_total", "Number of foos.")).inc()
+    server = MetricsServer(registry, host="localhost", port=0)
+    await server.start()
+    await server.start()
+    assert server.running
+    try:
+        response = await http_request(server.port, "GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        assert response.startswith("HTTP/1.1 200 OK\r\n")
+        assert "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n" in response
+        assert response.endswith("\r\n\r\n# HELP foo_total Number of foos.\n# TYPE foo_total counter\nfoo_total 1\n")
+
+        response = await http_request(server.port, "HEAD /metrics HTTP/1.1\r\n\r\n")
+        assert response.startswith("HTTP/1.1 200 OK\r\n")
+        assert response.endswith("\r\n\r\n")
+
+        response = await http_request(server.port, "GET /foo HTTP/1.1\r\n\r\n")
+        assert response.startswith("HTTP/1.1 404 Not Found\r\n")
+
+        response = await http_request(server.port, "POST /metrics HTTP/1.1\r\n\r\n")
+        assert response.startswith("HTTP/1.1 405 Method Not Allowed\r\n")
+    finally:
+        await server.stop()
+        await server.stop()
+    assert not server.running
+
+
+@pytest.mark.asyncio
+async def test_engine_metrics():
+    device = CalypsoDeviceApiFake(ble_address="00:00:00:00:00:01")
+    await device.connect()
+    await device.set_datarate(CalypsoDeviceDataRate.HZ_8)
+    await device.subscribe_reading(lambda reading: None, run_once=True)
+
+    real_device = CalypsoDeviceApi(ble_address="00:00:00:00:00:02")
+    real_device.receive_reading(dummy_wire_message_good)
+    with pytest.raises(CalypsoDecodingError):
+        real_device.receive_reading(dummy_wire_message_bad)
+
+    source = SourceStage()
+    quantiles = QuantileStage()
+    telemetry_sink = TelemetrySink(TelemetryAdapter(uri="udp+signalk+delta://localhost:64123"))
+    pipeline = Pipeline([source, quantiles, FanOutStage([telemetry_sink])])
+    queue = ReadingQueue()
+    loop_lag = LoopLagProbe()
+    loop_lag.update(0.002)
+
+    metrics = EngineMetrics()
+    metrics.add_device(device)
+    metrics.add_device(device)
+    metrics.add_device(real_device)
+    metrics.source = source
+    metrics.queue = queue
+    metrics.loop_lag = loop_lag
+    metrics.quantiles = quantiles
+    metrics.instrument_telemetry(telemetry_sink)
+    pipeline(dataclasses.replace(dummy_reading, device="00:00:00:00:00:01"))
+    pipeline(dataclasses.replace(dummy_reading, device="00:00:00:00:00:01"))
+    pipeline(dataclasses.replace(dummy_reading, wind_speed=2.5, device="00:00:00:00:00:02"))
+
+    text = metrics.registry.render()
+    assert 'calypso_readings_received_total{device="00:00:00:00:00:01"} 1' in text
+    assert 'calypso_readings_received_total{device="00:00:00:00:00:02"} 1' in text
+    assert 'calypso_decoding_errors_total{device="00:00:00:00:00:02"} 1' in text
+    assert 'calypso_datarate_hertz{device="00:00:00:00:00:01"} 8' in text
+    assert "calypso_readings_processed_total 3" in text
+    assert "calypso_battery_level_percent 90" in text
+    assert 'calypso_telemetry_sent_total{target="udp+signalk+delta://localhost:64123"} 3' in text
+    assert 'calypso_telemetry_failures_total{target="udp+signalk+delta://localhost:64123"} 0' in text
+    assert 'calypso_telemetry_render_seconds_count{target="udp+signalk+delta://localhost:64123"} 3' in text
+    assert 'calypso_telemetry_send_seconds_count{target="udp+signalk+delta://localhost:64123"} 3' in text
+    assert "calypso_queue_depth 0" in text
+    assert "calypso_queue_dropped_total 0" in text
+    assert 'calypso_loop_lag_seconds{quantile="0.99"} 0.002' in text
+    assert "calypso_loop_lag_max_seconds 0.002" in text
+    assert 'calypso_wind_speed_meters_per_second{device="00:00:00:00:00:01",quantile="0.99"} 5.69' in text
+    assert 'calypso_wind_speed_meters_per_second_count{device="00:00:00:00:00:01"} 2' in text
+    assert 'calypso_wind_speed_meters_per_second{device="00:00:00:00:00:02",quantile="0.99"} 2.5' in text
+    assert 'calypso_wind_speed_meters_per_second_count{device="00:00:00:00:00:02"} 1' in text
+
+
+def test_engine_metrics_reconnects(mocker):
+    """
+    Reconnect latency and gap durations of supervised devices are exposed per device.
+    """
+    supervisor_metrics = SupervisorMetrics(
+        reconnects=2, last_reconnect_latency=1.5, last_gap_duration=2.25, total_gap_duration=4.5
+    )
+    device = mocker.Mock(
+        spec=["ble_address", "metrics", "datarate"], ble_address="00:00:00:00:00:03", metrics=supervisor_metrics
+    )
+    device.datarate = None
+    metrics = EngineMetrics()
+    metrics.add_device(device)
+    text = metrics.registry.render()
+    assert 'calypso_reconnects_total{device="00:00:00:00:00:03"} 2' in text
+    assert "# TYPE calypso_reconnect_latency_seconds gauge" in text
+    assert 'calypso_reconnect_latency_seconds{device="00:00:00:00:00:03"} 1.5' in text
+    assert 'calypso_gap_duration_seconds{device="00:00:00:00:00:03"} 2.25' in text
+    assert "# TYPE calypso_gap_seconds_total counter" in text
+    assert 'calypso_gap_seconds_total{device="00:00:00:00:00:03"} 4.5' in text
@@ -77,3 +77,26 @@ def test_device_info():
 
 def test_device_status():
     assert dummy_device_status.aslabeldict() == {"compass": "ON", "mode": "NORMAL", "rate": "HZ_8"}
+
+
+def test_calypso_reading_stamp():
+    reading = deepcopy(dummy_reading).stamp(monotonic=42.42, wall=1677196800.123)
+    assert reading.received_monotonic == 42.42
+    assert reading.received_time == 1677196800.123
+
+    # Timestamps do not participate in comparison, and are not part of the serialized data.
+    assert reading == dummy_reading
+    assert "received_time" not in reading.asdict()
+    assert "received_monotonic" not in reading.asdict()
+    assert "received_time" not in reading.asjson()
+
+
+def test_calypso_reading_stamp_default():
+    reading = deepcopy(dummy_reading).stamp()
+    assert reading.received_monotonic > 0
+    assert reading.received_time > 0
+
+
+def test_calypso_reading_to_buffer():
+    assert dummy_reading.to_buffer() == dummy_wire_message_good
+    assert CalypsoReading.from_buffer(dummy_reading.to_buffer()) == dummy_reading
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import functools
+import json
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+import pytest
+
+from calypso_anemometer.model import CalypsoReading, QueueOverflowPolicy
+from calypso_anemometer.offload import ExecutorSink
+from calypso_anemometer.pipeline import FanOutStage, Pipeline, StdoutSink
+
+
+def make_reading(wind_speed: float = 1.0) -> CalypsoReading:
+    return CalypsoReading(
+        wind_speed=wind_speed, wind_direction=90, battery_level=80, temperature=20, roll=0, pitch=0, heading=0
+    )
+
+
+def record(path: Path, readings: t.List[CalypsoReading]):
+    """
+    Module-level function, so it can be pickled for running on a process pool.
+    """
+    with open(path, "a") as f:
+        f.writelines(json.dumps(reading.asdict()) + "\n" for reading in readings)
+
+
+@pytest.mark.asyncio
+async def test_executor_sink_thread_batches():
+    batches = []
+    threads = set()
+
+    def target(readings):
+        threads.add(threading.current_thread().name)
+        batches.append([reading.wind_speed for reading in readings])
+
+    sink = ExecutorSink(target, batch_size=3, max_latency=0.05)
+    pipeline = Pipeline([FanOutStage([sink])])
+    for index in range(7):
+        pipeline(make_reading(float(index)))
+    await pipeline.close()
+
+    assert batches == [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0], [6.0]]
+    assert len(threads) == 1
+    assert threads.pop().startswith("calypso-sink")
+    assert sink.metrics.processed == 7
+    assert sink.metrics.batches == 3
+    assert sink.pending == 0
+    assert sink.executor is None
+
+
+@pytest.mark.asyncio
+async def test_executor_sink_does_not_block_loop():
+    """
+    A slow sink must not delay the event loop.
+    """
+    sink = ExecutorSink(lambda readings: time.sleep(0.3), batch_size=1)
+    started = time.monotonic()
+    sink(make_reading())
+    await asyncio.sleep(0.05)
+    sink(make_reading())
+    assert time.monotonic() - started < 0.2
+    await sink.close()
+    assert sink.metrics.processed == 2
+    assert sink.metrics.busy_time >= 0.5
+
+
+@pytest.mark.asyncio
+async def test_executor_sink_overflow():
+    release = threading.Event()
+    sink = ExecutorSink(lambda readings: release.wait(), maxsize=2, batch_size=1)
+    for _ in range(10):
+        sink(make_reading())
+    await asyncio.sleep(0.05)
+    assert sink.metrics.overflow >= 7
+    release.set()
+    await sink.close()
+    assert sink.metrics.processed + sink.metrics.overflow == 10
+
+
+@pytest.mark.asyncio
+async def test_executor_sink_failure(caplog):
+    def target(readings):
+        raise RuntimeError("Database unavailable")
+
+    sink = ExecutorSink(target, batch_size=2, max_latency=0.01, name="database")
+    sink(make_reading())
+    sink(make_reading())
+    await sink.close()
+    assert sink.metrics.failed == 2
+    assert sink.metrics.processed == 0
+    assert "Processing batch of 2 readings in sink 'database' failed" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_executor_sink_drain_timeout(caplog):
+    sink = ExecutorSink(lambda readings: time.sleep(0.3), batch_size=1, drain_timeout=0.05, name="slow")
+    for _ in range(3):
+        sink(make_reading())
+    await sink.close()
+    assert "Sink 'slow' did not drain in time. Discarded readings: 3" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_executor_sink_process(tmp_path):
+    path = tmp_path / "readings.jsonl"
+    sink = ExecutorSink(functools.partial(record, path), executor="process", batch_size=10, max_latency=0.05)
+    for index in range(5):
+        sink(make_reading(float(index)))
+    await sink.close()
+    readings = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [reading["wind_speed"] for reading in readings] == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+@pytest.mark.asyncio
+async def test_executor_sink_wraps_sink(capsys):
+    sink = ExecutorSink(StdoutSink().send_batch, batch_size=1)
+    sink(make_reading())
+    await sink.close()
+    assert json.loads(capsys.readouterr().out)["wind_speed"] == 1.0
+
+
+def test_executor_sink_invalid():
+    with pytest.raises(ValueError) as ex:
+        ExecutorSink(print, policy=QueueOverflowPolicy.BLOCK)
+    assert ex.match("Queue overflow policy 'block' is not supported by executor sinks")
+    with pytest.raises(ValueError) as ex:
+        ExecutorSink(print, batch_size=0)
+    assert ex.match("Batch size must be a positive number: 0")
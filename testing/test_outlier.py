@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import io
+import json
+import random
+
+import pytest
+
+from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.outlier import HampelFilter, HampelStage, filter_recording
+from calypso_anemometer.pipeline import Pipeline
+
+
+def make_reading(wind_speed: float = 5.0, wind_direction: int = 90) -> CalypsoReading:
+    return CalypsoReading(
+        wind_speed=wind_speed,
+        wind_direction=wind_direction,
+        battery_level=80,
+        temperature=20,
+        roll=0,
+        pitch=0,
+        heading=0,
+    )
+
+
+def test_hampel_filter_spike():
+    hampel = HampelFilter(window=5, threshold=3.0, tolerance=0.5)
+    values = [5.0, 5.2, 4.9, 5.1, 5.0, 25.0, 5.1, 4.8]
+    replacements = [hampel.update(value) for value in values]
+    assert replacements == [None, None, None, None, None, 5.1, None, None]
+
+
+def test_hampel_filter_warmup():
+    """
+    Until the window has been filled, no value is an outlier.
+    """
+    hampel = HampelFilter(window=5)
+    assert [hampel.update(value) for value in [5.0, 5.0, 5.0, 50.0]] == [None, None, None, None]
+
+
+def test_hampel_filter_tolerance():
+    """
+    Small deviations from a flat signal are not outliers, even though its MAD is zero.
+    """
+    hampel = HampelFilter(window=3, tolerance=0.5)
+    assert [hampel.update(value) for value in [5.0, 5.0, 5.0, 5.4, 5.0, 9.0]] == [None, None, None, None, None, 5.4]
+
+
+def test_hampel_filter_circular():
+    """
+    Wind directions oscillating around north are not outliers, and spikes are replaced by an angle near north.
+    """
+    hampel = HampelFilter(window=5, tolerance=10.0, circular=True)
+    values = [350, 355, 2, 358, 5, 180, 1, 356]
+    replacements = [hampel.update(value) for value in values]
+    assert replacements == [None, None, None, None, None, 2, None, None]
+
+
+def test_hampel_filter_invalid():
+    with pytest.raises(ValueError) as ex:
+        HampelFilter(window=2)
+    assert ex.match("Window must be at least 3: 2")
+    with pytest.raises(ValueError) as ex:
+        HampelFilter(threshold=0)
+    assert ex.match("Threshold must be a positive number: 0")
+
+
+@pytest.mark.parametrize("window", [3, 4, 7, 8])
+@pytest.mark.parametrize("circular", [False, True])
+def test_hampel_filter_vectorized(window, circular):
+    """
+    The vectorized filter yields the same results as the streaming filter.
+    """
+    np = pytest.importorskip("numpy")
+    from calypso_anemometer.outlier import hampel_filter  # noqa: E402
+
+    rng = random.Random(42)
+    if circular:
+        values = [(rng.gauss(0, 20) + (180 if rng.random() < 0.05 else 0)) % 360 for _ in range(500)]
+    else:
+        values = [rng.gauss(5, 1) + (20 if rng.random() < 0.05 else 0) for _ in range(500)]
+
+    hampel = HampelFilter(window=window, tolerance=0.5, circular=circular)
+    replacements = [hampel.update(value) for value in values]
+    filtered, mask = hampel_filter(np.array(values), window=window, tolerance=0.5, circular=circular)
+
+    assert mask.tolist() == [replacement is not None for replacement in replacements]
+    assert mask.sum() > 0
+    expected = [
+        value if replacement is None else replacement for value, replacement in zip(values, replacements)  # noqa: B905
+    ]
+    assert filtered.tolist() == pytest.approx(expected)
+
+
+def test_hampel_stage():
+    stage = HampelStage(window=3)
+    pipeline = Pipeline([stage])
+    readings = [
+        make_reading(5.0, 90),
+        make_reading(5.1, 92),
+        make_reading(4.9, 91),
+        make_reading(30.0, 270),
+        make_reading(5.0, 90),
+    ]
+    results = [pipeline(reading) for reading in readings]
+    assert [result.wind_speed for result in results] == [5.0, 5.1, 4.9, 5.1, 5.0]
+    assert [result.wind_direction for result in results] == [90, 92, 91, 92, 90]
+    assert isinstance(results[3].wind_direction, int)
+    assert results[3].battery_level == 80
+    assert stage.outliers == {"wind_speed": 1, "wind_direction": 1}
+
+
+def test_hampel_stage_invalid():
+    with pytest.raises(ValueError) as ex:
+        HampelStage(fields=["wind_speed", "true_wind"])
+    assert ex.match("Unknown field: true_wind")
+
+
+def test_filter_recording():
+    pytest.importorskip("numpy")
+    readings = [make_reading(wind_speed, 90).asdict() for wind_speed in [5.0, 5.1, 4.9, 30.0, 5.0]]
+    infile = io.StringIO("".join(json.dumps(reading) + "\n" for reading in readings))
+    outfile = io.StringIO()
+    outliers = filter_recording(infile, outfile, window=3)
+    assert outliers == {"wind_speed": 1, "wind_direction": 0}
+    records = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    assert [record["wind_speed"] for record in records] == [5.0, 5.1, 4.9, 5.1, 5.0]
+    assert records[3]["wind_direction"] == 90
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import dataclasses
+import json
+import logging
+import os
+
+import pytest
+
+from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.pipeline import (
+    AggregateStage,
+    FanOutStage,
+    FilterStage,
+    FunctionStage,
+    Pipeline,
+    PipelineStage,
+    ProgressStage,
+    QuantileStage,
+    RecordingSink,
+    ReloadableStage,
+    Sink,
+    StdoutSink,
+    TelemetrySink,
+)
+
+
+def make_reading(wind_speed: float = 1.0) -> CalypsoReading:
+    return CalypsoReading(
+        wind_speed=wind_speed, wind_direction=90, battery_level=80, temperature=20, roll=0, pitch=0, heading=0
+    )
+
+
+class ListSink(Sink):
+    name = "list"
+
+    def __init__(self, name=None):
+        super().__init__(name=name)
+        self.readings = []
+        self.closed = False
+
+    def send(self, reading: CalypsoReading):
+        self.readings.append(reading)
+
+    async def close(self):
+        self.closed = True
+
+
+class FailingSink(Sink):
+    name = "failing"
+
+    def send(self, reading: CalypsoReading):
+        raise RuntimeError("Sink failed")
+
+    def close(self):
+        raise RuntimeError("Closing failed")
+
+
+def test_pipeline_filter_function_fanout():
+    sink = ListSink()
+    pipeline = Pipeline(
+        [
+            FilterStage(lambda reading: reading.wind_speed > 0, name="calm"),
+            FunctionStage(lambda reading: dataclasses.replace(reading, wind_speed=reading.wind_speed * 2), name="x2"),
+            FanOutStage([sink]),
+        ]
+    )
+    assert pipeline(make_reading(0.0)) is None
+    assert pipeline(make_reading(1.5)).wind_speed == 3.0
+
+    assert [reading.wind_speed for reading in sink.readings] == [3.0]
+    assert pipeline.asdict() == {
+        "calm": {"received": 2, "emitted": 1, "dropped": 1, "errors": 0},
+        "x2": {"received": 1, "emitted": 1, "dropped": 0, "errors": 0},
+        "fanout": {"received": 1, "emitted": 1, "dropped": 0, "errors": 0},
+        "list": {"received": 1, "emitted": 1, "dropped": 0, "errors": 0},
+    }
+
+
+def test_pipeline_stage_error():
+    def fail(reading):
+        raise ValueError("Stage failed")
+
+    pipeline = Pipeline([FunctionStage(fail)])
+    with pytest.raises(ValueError):
+        pipeline(make_reading())
+    assert pipeline["fail"].metrics.errors == 1
+
+
+def test_pipeline_fanout_isolates_sinks(caplog):
+    sink = ListSink()
+    pipeline = Pipeline([FanOutStage([FailingSink(), sink])])
+    for _ in range(3):
+        pipeline(make_reading())
+    assert len(sink.readings) == 3
+    assert pipeline.asdict()["failing"]["errors"] == 3
+    # Errors are logged rate-limited.
+    assert caplog.messages.count("Sink 'failing' failed. Errors: 1") == 1
+    assert len([message for message in caplog.messages if message.startswith("Sink 'failing'")]) == 1
+
+
+def test_pipeline_reorder():
+    first = PipelineStage(name="first")
+    second = PipelineStage(name="second")
+    pipeline = Pipeline([second])
+    pipeline.add(first, before="second").add(PipelineStage(name="third"))
+    assert [stage.name for stage in pipeline.stages] == ["first", "second", "third"]
+    assert pipeline.remove("second") is second
+    assert [stage.name for stage in pipeline.stages] == ["first", "third"]
+    with pytest.raises(KeyError) as ex:
+        pipeline["second"]
+    assert ex.match("Pipeline stage not found: second")
+
+
+def test_pipeline_progress():
+    counts = []
+    pipeline = Pipeline([ProgressStage(callback=counts.append, each=2)])
+    for _ in range(5):
+        pipeline(make_reading())
+    assert counts == [2, 4]
+
+
+def test_pipeline_stdout_sink(capsys):
+    pipeline = Pipeline([FanOutStage([StdoutSink()])])
+    pipeline(make_reading())
+    assert json.loads(capsys.readouterr().out)["wind_speed"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_pipeline_recording_sink(tmp_path, mocker):
+    path = tmp_path / "readings.jsonl"
+    fsync = mocker.spy(os, "fsync")
+    sink = RecordingSink(str(path), sync_each=2)
+    pipeline = Pipeline([FanOutStage([sink])])
+    for wind_speed in [1.0, 2.0, 3.0]:
+        pipeline(make_reading(wind_speed))
+    assert sink.pending == 1
+    assert fsync.call_count == 1
+    await pipeline.close()
+    assert sink.pending == 0
+    assert fsync.call_count == 2
+    readings = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [reading["wind_speed"] for reading in readings] == [1.0, 2.0, 3.0]
+    assert "time" in readings[0]
+    with pytest.raises(ValueError) as ex:
+        RecordingSink(str(path), sync_each=0)
+    assert ex.match("Sync interval must be a positive number: 0")
+
+
+@pytest.mark.asyncio
+async def test_pipeline_quantile_stage(tmp_path):
+    """
+    Percentiles are written each `save_each` readings, and when closing, and resumed from the file.
+    """
+    path = tmp_path / "sketch.json"
+    stage = QuantileStage(path=str(path), save_each=2)
+    pipeline = Pipeline([stage])
+    for wind_speed in [1.0, 2.0, 3.0]:
+        pipeline(make_reading(wind_speed))
+    assert json.loads(path.read_text())["count"] == 2
+    await pipeline.close()
+    assert json.loads(path.read_text())["count"] == 3
+
+    stage = QuantileStage(path=str(path))
+    stage(make_reading(4.0))
+    assert stage.digest.asdict()["count"] == 4
+    assert stage.digest.percentile(1.0) == 4.0
+
+    with pytest.raises(ValueError) as ex:
+        QuantileStage(field="true_wind")
+    assert ex.match("Unknown field: true_wind")
+    with pytest.raises(ValueError) as ex:
+        QuantileStage(save_each=0)
+    assert ex.match("Save interval must be a positive number: 0")
+
+
+@pytest.mark.asyncio
+async def test_pipeline_quantile_stage_per_device(tmp_path):
+    """
+    Each device gets its own digest, and its own file when the path contains a `{device}` placeholder.
+    """
+    path = tmp_path / "sketch-{device}.json"
+    stage = QuantileStage(path=str(path))
+    pipeline = Pipeline([stage])
+    for wind_speed in [1.0, 2.0]:
+        pipeline(make_reading(wind_speed).stamp(device="00:00:00:00:00:01"))
+    pipeline(make_reading(10.0).stamp(device="00:00:00:00:00:02"))
+    assert stage.digests["00:00:00:00:00:01"].percentile(1.0) == 2.0
+    assert stage.digests["00:00:00:00:00:02"].percentile(1.0) == 10.0
+    assert stage.digest.count == 3
+    await pipeline.close()
+    assert json.loads((tmp_path / "sketch-00-00-00-00-00-01.json").read_text())["count"] == 2
+    assert json.loads((tmp_path / "sketch-00-00-00-00-00-02.json").read_text())["count"] == 1
+
+    stage = QuantileStage(path=str(path))
+    stage(make_reading(3.0).stamp(device="00:00:00:00:00:01"))
+    assert stage.digests["00:00:00:00:00:01"].count == 3
+
+
+def test_pipeline_telemetry_sink(mocker):
+    telemetry = mocker.Mock()
+    reading = make_reading()
+    Pipeline([FanOutStage([TelemetrySink(telemetry)])])(reading)
+    telemetry.submit.assert_called_once_with(reading)
+
+
+@pytest.mark.asyncio
+async def test_pipeline_close(caplog):
+    caplog.set_level(logging.ERROR)
+    sink = ListSink()
+    pipeline = Pipeline([FanOutStage([FailingSink(), sink])])
+    await pipeline.close()
+    await pipeline.close()
+    # A failing stage does not prevent closing the others.
+    assert sink.closed is True
+    assert caplog.messages == ["Closing pipeline stage 'failing' failed"]
+
+
+def test_pipeline_aggregate():
+    sink = ListSink()
+    pipeline = Pipeline([AggregateStage(window=2), FanOutStage([sink])])
+    first = dataclasses.replace(make_reading(wind_speed=2.0), wind_direction=350, heading=340, temperature=19)
+    second = dataclasses.replace(make_reading(wind_speed=4.0), wind_direction=20, heading=20).stamp(monotonic=42.0)
+    assert pipeline(first) is None
+    pipeline(second)
+    assert sink.readings == [
+        CalypsoReading(wind_speed=3.0, wind_direction=10, battery_level=80, temperature=20, roll=0, pitch=0, heading=0)
+    ]
+    assert sink.readings[0].received_monotonic == 42.0
+    assert pipeline.asdict()["aggregate"] == {"received": 2, "emitted": 1, "dropped": 1, "errors": 0}
+
+
+def test_pipeline_aggregate_calm():
+    aggregate = AggregateStage(window=2)
+    aggregate(make_reading(wind_speed=0.0))
+    assert aggregate(make_reading(wind_speed=0.0)).wind_direction == 0
+
+
+def test_pipeline_aggregate_invalid():
+    with pytest.raises(ValueError) as ex:
+        AggregateStage(window=0)
+    assert ex.match("Aggregation window must be a positive number: 0")
+
+
+@pytest.mark.asyncio
+async def test_pipeline_reloadable():
+    first, second = ListSink(name="first"), ListSink(name="second")
+    reloadable = ReloadableStage(Pipeline([FanOutStage([first])]))
+    pipeline = Pipeline([reloadable])
+    pipeline(make_reading(wind_speed=1.0))
+    previous = reloadable.replace(
+        Pipeline([FilterStage(lambda reading: reading.wind_speed > 1), FanOutStage([second])])
+    )
+    await previous.close()
+    pipeline(make_reading(wind_speed=1.0))
+    pipeline(make_reading(wind_speed=2.0))
+    assert [reading.wind_speed for reading in first.readings] == [1.0]
+    assert [reading.wind_speed for reading in second.readings] == [2.0]
+    assert first.closed is True
+    assert second.closed is False
+    assert [stage.name for stage in pipeline.walk()] == ["reloadable", "filter", "fanout", "second"]
+    await pipeline.close()
+    assert second.closed is True
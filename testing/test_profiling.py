@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import pstats
+import time
+
+import pytest
+
+from calypso_anemometer.profiling import Profiler, SamplingProfiler
+
+
+def busy(duration: float):
+    started = time.monotonic()
+    while time.monotonic() - started < duration:
+        pass
+
+
+def test_sampling_profiler(tmp_path):
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    busy(0.1)
+    profiler.stop()
+    assert profiler.samples > 10
+
+    path = tmp_path / "profile.folded"
+    profiler.dump(str(path))
+    stack, count = path.read_text().splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert "test_sampling_profiler (test_profiling.py:" in stack
+    assert "busy (test_profiling.py:" in stack
+
+    summary = profiler.summary(limit=3).splitlines()
+    assert summary[0].split() == ["samples", "share", "function"]
+    assert len(summary) <= 4
+
+
+def test_profiler_cprofile(tmp_path):
+    path = tmp_path / "profile.pstats"
+    profiler = Profiler(path=str(path), mode="cprofile")
+    with profiler:
+        busy(0.01)
+    stats = pstats.Stats(str(path))
+    assert any(function == "busy" for _, _, function in stats.stats)
+    assert "busy" in profiler.summary(limit=5)
+
+
+def test_profiler_unknown():
+    with pytest.raises(ValueError) as ex:
+        Profiler(path="foo", mode="bar")
+    assert ex.match("Unknown profiler: bar")
+
+
+@pytest.mark.asyncio
+async def test_profiler_run_duration():
+    """
+    The command is cancelled after the profiling duration.
+    """
+    cancelled = False
+
+    async def command():
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    profiler = Profiler(path="unused", duration=0.05)
+    started = time.monotonic()
+    assert await profiler.run(command()) is None
+    assert time.monotonic() - started < 1.0
+    assert cancelled is True
+
+
+@pytest.mark.asyncio
+async def test_profiler_run_readings():
+    """
+    The command is cancelled after processing a number of readings, and returns its result when finishing early.
+    """
+    profiler = Profiler(path="unused", readings=3)
+    stage = profiler.stages()[0]
+
+    async def command():
+        for _ in range(10):
+            stage("reading")
+            await asyncio.sleep(0.01)
+        return "finished"
+
+    assert await profiler.run(command()) is None
+    assert stage.metrics.received == 3
+
+    async def short_command():
+        return "finished"
+
+    assert await Profiler(path="unused").run(short_command()) == "finished"
+    assert Profiler(path="unused").stages() == []
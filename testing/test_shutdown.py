@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+
+import pytest
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.engine import handler_factory, run_engine
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.model import CalypsoReading
+from calypso_anemometer.offload import ExecutorSink
+from calypso_anemometer.pipeline import AggregateStage, FanOutStage, Pipeline, StdoutSink
+from calypso_anemometer.shutdown import ShutdownReport, ShutdownSignal, drain, unsubscribe
+
+
+def make_reading() -> CalypsoReading:
+    return CalypsoReading(
+        wind_speed=1.0, wind_direction=90, battery_level=80, temperature=20, roll=0, pitch=0, heading=0
+    )
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Signal handlers not supported on Windows")
+@pytest.mark.asyncio
+async def test_shutdown_signal(caplog):
+    caplog.set_level(logging.INFO)
+    shutdown = ShutdownSignal()
+    shutdown.install()
+    shutdown.install()
+    assert shutdown.signals == [signal.SIGTERM, signal.SIGINT]
+
+    async def producer():
+        await asyncio.sleep(10)
+
+    asyncio.get_event_loop().call_later(0.05, os.kill, os.getpid(), signal.SIGTERM)
+    task = await asyncio.wait_for(shutdown.run_until_requested(producer()), timeout=2)
+    assert shutdown.requested is True
+    # Handlers are removed, so sending the signal again takes the default action.
+    assert shutdown.signals == []
+    assert task.done() is False
+    task.cancel()
+    assert "Received signal SIGTERM, shutting down. Send again to terminate" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_shutdown_subscription_failure():
+    async def producer():
+        raise ValueError("Subscribing failed")
+
+    with pytest.raises(ValueError) as ex:
+        await ShutdownSignal().run_until_requested(producer())
+    assert ex.match("Subscribing failed")
+
+
+@pytest.mark.asyncio
+async def test_shutdown_unsubscribe_failure(mocker, caplog):
+    async def unsubscribe_reading():
+        raise OSError("Not connected")
+
+    device = mocker.Mock(unsubscribe_reading=unsubscribe_reading)
+    subscription = asyncio.ensure_future(asyncio.sleep(10))
+    await unsubscribe(device, subscription, timeout=1.0)
+    assert subscription.cancelled() is True
+    assert "Unsubscribing failed: Not connected" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_shutdown_drain():
+    """
+    Buffered readings are drained into the pipeline, and flushed by the sinks. Incomplete aggregates are dropped.
+    """
+    processed = []
+    sink = ExecutorSink(processed.extend, batch_size=100, max_latency=0.05)
+    pipeline = Pipeline([FanOutStage([sink])])
+    queue = ReadingQueue(maxsize=10)
+    queue.start(pipeline)
+    for _ in range(5):
+        queue.put_nowait(make_reading())
+
+    report = await drain(pipeline, queue=queue, timeout=1.0)
+    # Each reading is accounted for at the queue, and at the sink.
+    assert report == ShutdownReport(flushed=10, dropped=0, duration=report.duration)
+    assert len(processed) == 5
+
+    aggregate = AggregateStage(window=4)
+    pipeline = Pipeline([aggregate])
+    pipeline(make_reading())
+    report = await drain(pipeline)
+    assert (report.flushed, report.dropped) == (0, 1)
+
+
+@pytest.mark.asyncio
+async def test_shutdown_drain_timeout(caplog):
+    """
+    Readings which can not be processed within the deadline are dropped.
+    """
+    pipeline = Pipeline([FanOutStage([StdoutSink()])])
+    queue = ReadingQueue(maxsize=100)
+    queue.start(pipeline)
+    for _ in range(50):
+        queue.put_nowait(make_reading())
+    report = await drain(pipeline, queue=queue, timeout=0)
+    assert (report.flushed, report.dropped) == (0, 50)
+    assert "Reading queue stopped. Discarded readings: 50" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_shutdown_engine(tmp_path, caplog):
+    """
+    The engine unsubscribes, drains the queue, and syncs recordings to disk, before disconnecting.
+    """
+    caplog.set_level(logging.INFO)
+    record = tmp_path / "readings.jsonl"
+    shutdown = ShutdownSignal()
+    handler = await handler_factory(subscribe=True, quiet=True, queue_size=16, record=str(record), shutdown=shutdown)
+    asyncio.get_event_loop().call_later(0.6, shutdown.trigger)
+    worker = await asyncio.wait_for(run_engine(workhorse=CalypsoDeviceApiFake, handler=handler), timeout=5)
+
+    readings = [json.loads(line) for line in record.read_text().splitlines()]
+    assert len(readings) == worker.arrival_statistics.count
+    assert readings[0]["wind_speed"] == 1
+    assert readings[0]["time"] > 0
+    messages = [message.split(":")[0] for message in caplog.messages]
+    assert messages.index("Unsubscribing from readings") < messages.index("Shutdown")
+    assert "flushed=" in caplog.messages[messages.index("Shutdown")]
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import bisect
+import json
+import os
+import random
+import statistics
+import time
+
+import pytest
+
+from calypso_anemometer.stats import (
+    ArrivalStatistics,
+    HdrHistogram,
+    LoopLagProbe,
+    RunningMedian,
+    TDigest,
+    circular_mean,
+    percentile,
+)
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([3.0, 1.0, 2.0], 0.5) == 2.0
+    assert percentile([3.0, 1.0, 2.0], 0.99) == 3.0
+    assert percentile([3.0, 1.0, 2.0], 0.0) == 1.0
+
+
+def test_circular_mean():
+    mean = circular_mean([350, 10])
+    assert min(mean, 360 - mean) == pytest.approx(0.0, abs=1e-9)
+    assert circular_mean([80, 100]) == pytest.approx(90.0)
+    assert circular_mean([0, 90], weights=[1.0, 3.0]) == pytest.approx(71.565, abs=1e-3)
+    assert circular_mean([0, 180]) is None
+    assert circular_mean([45], weights=[0.0]) is None
+
+
+def test_arrival_statistics_empty():
+    stats = ArrivalStatistics(expected_interval=0.25)
+    stats.update(10.0)
+    assert stats.asdict() == {
+        "count": 1,
+        "expected_interval": 0.25,
+        "mean_interval": None,
+        "jitter_p50": None,
+        "jitter_p99": None,
+        "missed": 0,
+    }
+    assert str(stats) == "mean_interval=n/a, jitter_p50=n/a, jitter_p99=n/a, missed=0"
+
+
+def test_arrival_statistics_jitter_missed():
+    stats = ArrivalStatistics(expected_interval=0.25)
+    # Regular intervals, one late reading, and a gap of two missed readings.
+    for timestamp in [0.0, 0.25, 0.5, 0.8, 1.55]:
+        stats.update(timestamp)
+    assert stats.count == 5
+    assert stats.mean == pytest.approx(1.55 / 4)
+    assert stats.jitter(0.50) == pytest.approx(0.0)
+    assert stats.jitter(0.99) == pytest.approx(0.5)
+    assert stats.missed == 2
+    assert str(stats) == "mean_interval=387.5ms, jitter_p50=0.0ms, jitter_p99=500.0ms, missed=2"
+
+
+def test_arrival_statistics_window():
+    stats = ArrivalStatistics(expected_interval=1.0, window=2)
+    for timestamp in [0.0, 5.0, 6.0, 7.0]:
+        stats.update(timestamp)
+    # Percentiles only account for the recent window, the mean for the whole lifetime.
+    assert list(stats.intervals) == [1.0, 1.0]
+    assert stats.jitter(0.99) == 0.0
+    assert stats.mean == pytest.approx(7.0 / 3)
+    assert stats.missed == 4
+
+
+def test_loop_lag_probe_update():
+    probe = LoopLagProbe()
+    assert probe.asdict() == {"count": 0, "lag_mean": None, "lag_p50": None, "lag_p99": None, "lag_max": None}
+    assert str(probe) == "lag_mean=n/a, lag_p50=n/a, lag_p99=n/a, lag_max=n/a"
+    for lag in [0.001, 0.003, -0.0001]:
+        probe.update(lag)
+    assert probe.count == 3
+    assert probe.mean == pytest.approx(0.004 / 3)
+    assert probe.lag_max == 0.003
+    assert str(probe) == "lag_mean=1.3ms, lag_p50=1.0ms, lag_p99=3.0ms, lag_max=3.0ms"
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_probe_blocked():
+    probe = LoopLagProbe(interval=0.01)
+    probe.start()
+    await asyncio.sleep(0.015)
+    # Hog the event loop.
+    time.sleep(0.05)
+    await asyncio.sleep(0.02)
+    probe.stop()
+    assert probe.count >= 2
+    assert probe.lag_max >= 0.03
+
+
+def test_hdr_histogram_empty():
+    histogram = HdrHistogram()
+    assert histogram.asdict() == {
+        "count": 0,
+        "min": None,
+        "mean": None,
+        "p50": None,
+        "p90": None,
+        "p99": None,
+        "p999": None,
+        "max": None,
+    }
+
+
+def test_hdr_histogram_precision():
+    histogram = HdrHistogram(resolution=1e-6, significant_figures=2)
+    values = [0.000005, 0.0001, 0.0012, 0.0034, 0.0125, 0.2, 1.5, 42.0, -0.001]
+    for value in values:
+        histogram.record(value)
+    assert histogram.count == 9
+    assert histogram.min == 0.0
+    assert histogram.max == 42.0
+    assert histogram.mean == pytest.approx(sum(values[:-1]) / 9)
+    # Each value is reported within 1% of its real value.
+    for index, value in enumerate(sorted(values[:-1]), start=2):
+        assert histogram.percentile(index / 9) == pytest.approx(value, rel=0.01, abs=1e-6)
+    # The highest percentile is exact, because it never exceeds the maximum.
+    assert histogram.percentile(1.0) == 42.0
+
+
+def test_hdr_histogram_bounded_memory():
+    histogram = HdrHistogram()
+    for index in range(100_000):
+        histogram.record(index * 1e-6)
+    assert histogram.count == 100_000
+    assert len(histogram.counts) < 1500
+    assert histogram.percentile(0.5) == pytest.approx(0.05, rel=0.01)
+    histogram.reset()
+    assert histogram.count == 0
+    assert histogram.counts == {}
+
+
+def test_hdr_histogram_invalid():
+    with pytest.raises(ValueError) as ex:
+        HdrHistogram(significant_figures=0)
+    assert ex.match("Significant figures must be between 1 and 5: 0")
+
+
+def test_running_median():
+    median = RunningMedian(window=3)
+    assert len(median) == 0
+    assert median.median is None
+    results = []
+    for value in [5.0, 1.0, 3.0, 9.0, 9.0, 2.0]:
+        median.push(value)
+        results.append(median.median)
+    assert results == [5.0, 3.0, 3.0, 3.0, 9.0, 9.0]
+    assert len(median) == 3
+
+
+def test_running_median_random():
+    """
+    The running median matches the median of the trailing window, and its heaps stay bounded.
+    """
+    rng = random.Random(42)
+    values = [rng.choice([rng.random(), round(rng.random(), 1)]) for _ in range(2000)]
+    for window in [1, 2, 5, 16]:
+        median = RunningMedian(window=window)
+        for index, value in enumerate(values):
+            median.push(value)
+            assert median.median == statistics.median(values[max(0, index - window + 1) : index + 1])
+            assert len(median.low) + len(median.high) <= 2 * window + 16
+
+
+def test_running_median_invalid():
+    with pytest.raises(ValueError) as ex:
+        RunningMedian(window=0)
+    assert ex.match("Window must be a positive number: 0")
+
+
+def test_tdigest_small():
+    """
+    Few values are represented exactly.
+    """
+    digest = TDigest()
+    assert digest.percentile(0.5) is None
+    assert digest.asdict()["p99"] is None
+    for value in [3.0, 1.0, 5.0, 2.0, 4.0]:
+        digest.update(value)
+    assert [digest.percentile(fraction) for fraction in [0.0, 0.3, 0.5, 0.9, 1.0]] == [1.0, 2.0, 3.0, 5.0, 5.0]
+    assert digest.asdict() == {"count": 5, "min": 1.0, "mean": 3.0, "p50": 3.0, "p90": 5.0, "p99": 5.0, "max": 5.0}
+    assert str(digest) == "p50=3.00, p90=5.00, p99=5.00, max=5.00"
+
+
+def test_tdigest_accuracy():
+    """
+    Percentiles are accurate within a fraction of a percent in rank, in bounded memory.
+    """
+    rng = random.Random(42)
+    values = [rng.weibullvariate(6.0, 2.0) for _ in range(50000)]
+    digest = TDigest(compression=100)
+    for value in values:
+        digest.update(value)
+    ordered = sorted(values)
+    for fraction in [0.01, 0.5, 0.9, 0.99, 0.999]:
+        rank = bisect.bisect_right(ordered, digest.percentile(fraction)) / len(ordered)
+        assert rank == pytest.approx(fraction, abs=0.002)
+    assert len(digest.centroids) < 100
+    assert digest.min == ordered[0]
+    assert digest.max == ordered[-1]
+    assert digest.mean == pytest.approx(statistics.mean(values))
+
+
+def test_tdigest_merge():
+    """
+    Merging digests of segments yields the percentiles of all values, also after storing and loading them.
+    """
+    rng = random.Random(42)
+    values = [rng.weibullvariate(6.0, 2.0) for _ in range(20000)]
+    segments = [TDigest() for _ in range(8)]
+    for index, value in enumerate(values):
+        segments[index % len(segments)].update(value)
+    merged = TDigest()
+    merged.merge(TDigest())
+    for segment in segments:
+        merged.merge(TDigest.deserialize(json.loads(json.dumps(segment.serialize()))))
+    assert merged.count == len(values)
+    assert merged.min == min(values)
+    assert merged.max == max(values)
+    ordered = sorted(values)
+    for fraction in [0.5, 0.9, 0.99]:
+        assert merged.percentile(fraction) == pytest.approx(ordered[int(fraction * len(ordered))], rel=0.01)
+
+
+def test_tdigest_save_load(tmp_path):
+    path = str(tmp_path / "sketch.json")
+    digest = TDigest()
+    for value in range(1000):
+        digest.update(float(value))
+    digest.save(path)
+    assert not os.path.exists(f"{path}.tmp")
+    loaded = TDigest.load(path)
+    assert loaded.asdict() == digest.asdict()
+
+
+def test_tdigest_invalid():
+    with pytest.raises(ValueError) as ex:
+        TDigest(compression=5)
+    assert ex.match("Compression must be at least 10: 5")
+    with pytest.raises(ValueError) as ex:
+        TDigest.deserialize({"compression": 100})
+    assert ex.match("Invalid digest: 'centroids'")
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import sys
+
+import pytest
+from pytest_mock import MockerFixture
+
+from calypso_anemometer.buffer import ReadingQueue
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.model import CalypsoDeviceDataRate, CalypsoReading, QueueOverflowPolicy
+from testing.data import dummy_reading, dummy_wire_message_good
+
+
+@pytest.mark.asyncio
+async def test_stream_fake_single():
+    readings = []
+    async with CalypsoDeviceApiFake() as fake:
+        await fake.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        stream = fake.stream()
+        async for reading in stream:
+            readings.append(reading)
+            if len(readings) == 3:
+                break
+        await stream.aclose()
+    assert [reading.wind_speed for reading in readings] == [1, 2, 3]
+    assert all(isinstance(reading, CalypsoReading) for reading in readings)
+    assert fake.subscription is None
+
+
+@pytest.mark.asyncio
+async def test_stream_fake_batch_size():
+    async with CalypsoDeviceApiFake() as fake:
+        await fake.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        stream = fake.stream(batch_size=3)
+        batch = await stream.__anext__()
+        await stream.aclose()
+    assert [reading.wind_speed for reading in batch] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_stream_fake_max_latency():
+    """
+    An incomplete batch will be emitted after `max_latency` seconds.
+    """
+    async with CalypsoDeviceApiFake() as fake:
+        await fake.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        stream = fake.stream(batch_size=100, max_latency=0.2)
+        batch = await stream.__anext__()
+        await stream.aclose()
+    assert 1 <= len(batch) <= 3
+    assert batch[0].wind_speed == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_fake_backpressure():
+    """
+    The fake producer blocks when the consumer can not keep up.
+    """
+    queue = ReadingQueue(maxsize=2, policy=QueueOverflowPolicy.BLOCK)
+    async with CalypsoDeviceApiFake() as fake:
+        await fake.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        stream = fake.stream(queue=queue)
+        await stream.__anext__()
+        await asyncio.sleep(0.5)
+        await stream.aclose()
+    assert queue.metrics.dropped == 0
+    assert queue.metrics.depth_max == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_core(mocker: MockerFixture):
+    if sys.version_info < (3, 8, 0):
+        raise pytest.skip(reason="AsyncMock not supported on Python 3.7")
+
+    from unittest.mock import AsyncMock
+
+    from calypso_anemometer.core import CalypsoDeviceApi
+
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+    start_notify = mocker.patch("calypso_anemometer.core.BleakClient.start_notify", AsyncMock(return_value=None))
+    stop_notify = mocker.patch("calypso_anemometer.core.BleakClient.stop_notify", AsyncMock(return_value=None))
+
+    async def notify():
+        while not start_notify.called:
+            await asyncio.sleep(0)
+        handler = start_notify.call_args.args[1]
+        for _ in range(5):
+            handler(42, bytearray(dummy_wire_message_good))
+
+    async with CalypsoDeviceApi(ble_address="bar") as calypso:
+        producer = asyncio.ensure_future(notify())
+        stream = calypso.stream(batch_size=5)
+        batch = await stream.__anext__()
+        await stream.aclose()
+        await producer
+
+    assert batch == [dummy_reading] * 5
+    stop_notify.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_stream_invalid_arguments():
+    queue = ReadingQueue()
+    with pytest.raises(ValueError) as ex:
+        queue.iterate(batch_size=0)
+    assert ex.match("Batch size must be a positive number: 0")
+    with pytest.raises(ValueError) as ex:
+        queue.iterate(batch_size=5, max_latency=-1.0)
+    assert ex.match("Maximum latency must not be negative: -1.0")
+
+    async with CalypsoDeviceApiFake() as fake:
+        with pytest.raises(ValueError):
+            await fake.stream(batch_size=-1).__anext__()
+        assert fake.subscription is None
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import sys
+
+import pytest
+
+if sys.version_info < (3, 8, 0):
+    raise pytest.skip(reason="AsyncMock not supported on Python 3.7", allow_module_level=True)
+from unittest.mock import ANY, AsyncMock, MagicMock, Mock, call
+
+from bleak import BleakError
+from pytest_mock import MockerFixture
+
+from calypso_anemometer.model import CalypsoDeviceDataRate, Settings
+from calypso_anemometer.supervisor import CalypsoDeviceSupervisor, backoff_delay
+from testing.data import dummy_reading, dummy_wire_message_good
+
+
+def test_backoff_delay():
+    assert backoff_delay(1, initial=0.5, maximum=30.0, jitter=0.0) == 0.5
+    assert backoff_delay(3, initial=0.5, maximum=30.0, jitter=0.0) == 2.0
+    assert backoff_delay(10, initial=0.5, maximum=30.0, jitter=0.0) == 30.0
+    assert 15.0 <= backoff_delay(10, initial=0.5, maximum=30.0, jitter=0.5) <= 30.0
+
+
+@pytest.mark.asyncio
+async def test_supervisor_reconnect_resubscribe(mocker: MockerFixture, caplog):
+    client = mocker.patch("calypso_anemometer.core.BleakClient", autospec=True)
+    callback = MagicMock()
+
+    supervisor = CalypsoDeviceSupervisor(settings=Settings(ble_address="bar"))
+    async with supervisor as calypso:
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        await calypso.subscribe_reading(callback)
+
+        # Emulate link loss, signalled by Bleak.
+        disconnected_callback = client.call_args.kwargs["disconnected_callback"]
+        disconnected_callback(client.return_value)
+        await asyncio.sleep(0)
+        await supervisor.reconnect_task
+
+    assert client.mock_calls == [
+        call("bar", timeout=10.0, adapter="hci0", disconnected_callback=ANY),
+        call().connect(),
+        call().write_gatt_char("0000a002-0000-1000-8000-00805f9b34fb", data=b"\x08", response=True),
+        call().start_notify("00002a39-0000-1000-8000-00805f9b34fb", ANY),
+        call("bar", timeout=10.0, adapter="hci0", disconnected_callback=ANY),
+        call().connect(),
+        call().write_gatt_char("0000a002-0000-1000-8000-00805f9b34fb", data=b"\x08", response=True),
+        call().start_notify("00002a39-0000-1000-8000-00805f9b34fb", ANY),
+        call().disconnect(),
+    ]
+
+    assert supervisor.metrics.disconnects == 1
+    assert supervisor.metrics.reconnects == 1
+    assert supervisor.metrics.reconnect_attempts == 1
+    assert supervisor.metrics.last_reconnect_latency >= 0
+    assert supervisor.metrics.last_gap_duration >= supervisor.metrics.last_reconnect_latency
+
+    assert "Lost connection to device at 'bar'" in caplog.messages
+    assert "Reconnecting to device, attempt #1" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_supervisor_reconnect_backoff(mocker: MockerFixture, caplog):
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+
+    supervisor = CalypsoDeviceSupervisor(settings=Settings(ble_address="bar"), backoff_initial=0.001)
+    async with supervisor:
+        mocker.patch(
+            "calypso_anemometer.core.BleakClient.connect",
+            AsyncMock(side_effect=[BleakError("Device not found"), BleakError("Device not found"), None]),
+        )
+        supervisor.on_disconnected()
+        await asyncio.sleep(0)
+        await supervisor.reconnect_task
+
+    assert supervisor.metrics.reconnects == 1
+    assert supervisor.metrics.reconnect_attempts == 3
+    assert "Reconnecting to device, attempt #3" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_supervisor_no_reconnect_when_closing(mocker: MockerFixture):
+    mocker.patch("calypso_anemometer.core.BleakClient.connect", AsyncMock(return_value=None))
+
+    supervisor = CalypsoDeviceSupervisor(settings=Settings(ble_address="bar"))
+    async with supervisor:
+        pass
+    supervisor.on_disconnected()
+    await asyncio.sleep(0)
+
+    assert supervisor.reconnect_task is None
+    assert supervisor.metrics.disconnects == 0
+
+
+@pytest.mark.asyncio
+async def test_supervisor_recycle(mocker: MockerFixture, caplog):
+    client = mocker.patch("calypso_anemometer.core.BleakClient", autospec=True)
+
+    supervisor = CalypsoDeviceSupervisor(settings=Settings(ble_address="bar"))
+    async with supervisor:
+        await supervisor.recycle()
+
+        # A late disconnect notification about a replaced client will not trigger another reconnect.
+        supervisor.start_reconnect(Mock())
+        assert supervisor.reconnect_task.done()
+
+    assert client.return_value.connect.call_count == 2
+    assert client.return_value.disconnect.call_count == 2
+    assert supervisor.metrics.disconnects == 1
+    assert supervisor.metrics.reconnect_attempts == 1
+    assert supervisor.metrics.reconnects == 1
+    assert "Recycling connection to device at 'bar'" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_supervisor_reconnect_restore_failure(mocker: MockerFixture, caplog):
+    client = mocker.patch("calypso_anemometer.core.BleakClient", autospec=True)
+
+    supervisor = CalypsoDeviceSupervisor(settings=Settings(ble_address="bar"), backoff_initial=0.001)
+    async with supervisor as calypso:
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+
+        # Restoring the settings fails once, with an unexpected error.
+        client.return_value.write_gatt_char.side_effect = [RuntimeError("Something failed"), None]
+        supervisor.on_disconnected()
+        await asyncio.sleep(0)
+        await supervisor.reconnect_task
+
+    # The half-initialized connection has been closed before retrying, and once more when exiting.
+    assert client.return_value.connect.call_count == 3
+    assert client.return_value.disconnect.call_count == 2
+    assert supervisor.metrics.reconnect_attempts == 2
+    assert supervisor.metrics.reconnects == 1
+    assert "Reconnecting failed unexpectedly" in caplog.messages
+    assert any("Reconnecting failed: RuntimeError: Something failed" in message for message in caplog.messages)
+
+
+@pytest.mark.asyncio
+async def test_supervisor_reconnect_task_failure(caplog):
+    supervisor = CalypsoDeviceSupervisor(settings=Settings(ble_address="bar"))
+    task = asyncio.get_event_loop().create_future()
+    task.set_exception(RuntimeError("Something failed"))
+    supervisor.on_reconnect_done(task)
+    assert "Reconnecting to device at 'bar' failed permanently" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_supervisor_stream_reconnect(mocker: MockerFixture):
+    client = mocker.patch("calypso_anemometer.core.BleakClient", autospec=True)
+
+    def notify():
+        handler = client.return_value.start_notify.call_args.args[1]
+        handler(42, bytearray(dummy_wire_message_good))
+
+    supervisor = CalypsoDeviceSupervisor(settings=Settings(ble_address="bar"))
+    async with supervisor as calypso:
+        stream = calypso.stream()
+        reading_task = asyncio.ensure_future(stream.__anext__())
+        while not client.return_value.start_notify.called:
+            await asyncio.sleep(0)
+        notify()
+        assert await reading_task == dummy_reading
+        assert supervisor.subscription is not None
+
+        # Emulate link loss. After reconnecting, the stream continues.
+        client.return_value.start_notify.reset_mock()
+        supervisor.on_disconnected()
+        await asyncio.sleep(0)
+        await supervisor.reconnect_task
+        client.return_value.start_notify.assert_called_once()
+        notify()
+        assert await stream.__anext__() == dummy_reading
+
+        await stream.aclose()
+        assert supervisor.subscription is None
@@ -7,8 +7,9 @@ from copy import deepcopy
 
 import pytest
 
+from calypso_anemometer.model import TrueWind
 from calypso_anemometer.telemetry.adapter import TelemetryAdapter
-from calypso_anemometer.telemetry.nmea0183 import Nmea0183Envelope, Nmea0183MessageVWR
+from calypso_anemometer.telemetry.nmea0183 import Nmea0183Envelope, Nmea0183GenericMessage, Nmea0183MessageVWR
 from calypso_anemometer.telemetry.signalk import SignalKDeltaMessage
 from testing.data import dummy_reading
 
@@ -38,6 +39,37 @@ def test_telemetry_signalk_message():
     assert "updates" in json.loads(bucket.render())
 
 
+def test_telemetry_signalk_message_true_wind():
+    reading = deepcopy(dummy_reading)
+    reading.true_wind = TrueWind(speed=4.2, angle=180.0, direction=90.0)
+    bucket = SignalKDeltaMessage(source="Calypso UP10", location="Mast")
+    bucket.set_reading(reading)
+    values = bucket.asdict()["updates"][0]["values"]
+    assert values[-3:] == [
+        {"path": "environment.wind.angleTrueWater", "value": 3.141592653589793},
+        {"path": "environment.wind.speedTrue", "value": 4.2},
+        {"path": "environment.wind.directionTrue", "value": 1.5707963267948966},
+    ]
+
+    reading.ground_wind = TrueWind(speed=4.5, angle=0.0, direction=270.0)
+    bucket.set_reading(reading)
+    values = bucket.asdict()["updates"][0]["values"]
+    assert values[-3:] == [
+        {"path": "environment.wind.angleTrueGround", "value": 0.0},
+        {"path": "environment.wind.speedOverGround", "value": 4.5},
+        {"path": "environment.wind.directionTrue", "value": 4.71238898038469},
+    ]
+
+
+def test_telemetry_signalk_message_timestamp():
+    reading = deepcopy(dummy_reading).stamp(wall=1677196800.5)
+    bucket = SignalKDeltaMessage(source="Calypso UP10", location="Mast")
+    bucket.set_reading(reading)
+    update = bucket.asdict()["updates"][0]
+    assert update["timestamp"] == "2023-02-24T00:00:00.500Z"
+    assert update["$source"] == "calypso-up10"
+
+
 def test_telemetry_nmea0183_wind_into():
     bucket = Nmea0183Envelope()
     reading = deepcopy(dummy_reading)
@@ -78,6 +110,55 @@ def test_telemetry_nmea0183_wind_zero():
     assert "$MLVWR,0.0,,0.0,N,0.0,M,0.0,K*1A" in bucket.render()
 
 
+def test_telemetry_nmea0183_true_wind():
+    bucket = Nmea0183Envelope()
+    reading = deepcopy(dummy_reading)
+    bucket.set_reading(reading)
+    assert "MWV" not in bucket.render()
+    assert "MWD" not in bucket.render()
+
+    reading.true_wind = TrueWind(speed=4.2, angle=120.5, direction=355.5)
+    reading.ground_wind = TrueWind(speed=4.5, angle=118.0, direction=353.0)
+    bucket.set_reading(reading)
+    messages = bucket.aslist()
+    assert messages[-2:] == ["$MLMWV,120.5,T,4.2,M,A*39", "$MLMWD,353.0,T,,M,8.75,N,4.5,M*55"]
+
+
+def test_telemetry_nmea0183_ground_wind_only():
+    """
+    Ground wind is only submitted as MWD, because MWV with reference `T` would be read as true wind.
+    """
+    bucket = Nmea0183Envelope()
+    reading = deepcopy(dummy_reading)
+    reading.ground_wind = TrueWind(speed=4.5, angle=118.0, direction=353.0)
+    bucket.set_reading(reading)
+    messages = bucket.aslist()
+    assert messages[-1] == "$MLMWD,353.0,T,,M,8.75,N,4.5,M*55"
+    assert "MWV" not in bucket.render()
+
+
+def test_nmea0183message_parse():
+    message = Nmea0183GenericMessage.parse("$GPVTG,054.7,T,034.4,M,005.5,N,010.2,K*48\r\n")
+    assert message.talker == "GP"
+    assert message.sentence_type == "VTG"
+    assert message.fields == ["054.7", "T", "034.4", "M", "005.5", "N", "010.2", "K"]
+    assert message.render() == "$GPVTG,054.7,T,034.4,M,005.5,N,010.2,K*48"
+    assert Nmea0183GenericMessage.parse("$IIHDT,235.0,T").fields == ["235.0", "T"]
+
+
+@pytest.mark.parametrize(
+    "sentence,message",
+    [
+        ("GPVTG,054.7,T", "Invalid NMEA-0183 sentence"),
+        ("$GPVTG,054.7,T*00", "Invalid NMEA-0183 checksum"),
+    ],
+)
+def test_nmea0183message_parse_invalid(sentence, message):
+    with pytest.raises(ValueError) as ex:
+        Nmea0183GenericMessage.parse(sentence)
+    assert ex.match(message)
+
+
 def test_telemetry_nmea0183_compass_heading():
     bucket = Nmea0183Envelope()
     reading = deepcopy(dummy_reading)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import logging
+import os
+import signal
+import time
+
+import pytest
+
+from calypso_anemometer.core import CalypsoDeviceApi
+from calypso_anemometer.emulator import EmulatedPeripheral
+from calypso_anemometer.model import CalypsoDeviceDataRate, CalypsoReading
+from calypso_anemometer.pipeline import FanOutStage, Pipeline, SourceStage, TelemetrySink
+from calypso_anemometer.supervisor import CalypsoDeviceSupervisor
+from calypso_anemometer.tracing import Tracer
+
+
+def make_reading() -> CalypsoReading:
+    return CalypsoReading(
+        wind_speed=1.0, wind_direction=90, battery_level=80, temperature=20, roll=0, pitch=0, heading=0
+    )
+
+
+def test_tracer_pipeline(mocker):
+    telemetry = mocker.Mock()
+    telemetry.prepare.return_value.render.return_value = "$IIMWV,090.0,R,1.0,M,A*00"
+    pipeline = Pipeline([SourceStage(), FanOutStage([TelemetrySink(telemetry)])])
+    tracer = Tracer()
+    tracer.instrument(pipeline)
+
+    reading = make_reading().stamp(time.monotonic() - 0.005)
+    pipeline(reading)
+    # Readings without receive timestamp are not accounted for end-to-end spans.
+    pipeline(make_reading())
+
+    telemetry.send.assert_called_with("$IIMWV,090.0,R,1.0,M,A*00")
+    data = tracer.asdict()
+    assert data["decode"]["count"] == 0
+    assert data["pipeline"]["count"] == 1
+    assert data["pipeline"]["min"] >= 0.005
+    assert data["render"]["count"] == 2
+    assert data["send"]["count"] == 2
+    assert data["total"]["count"] == 1
+    assert data["total"]["min"] >= data["pipeline"]["min"]
+
+
+def test_tracer_disabled(mocker):
+    """
+    Without a tracer, telemetry sinks use the plain `submit` path.
+    """
+    telemetry = mocker.Mock()
+    Pipeline([SourceStage(), FanOutStage([TelemetrySink(telemetry)])])(make_reading())
+    assert telemetry.submit.call_count == 1
+    assert telemetry.send.call_count == 0
+
+
+def test_tracer_report():
+    tracer = Tracer()
+    tracer.record("render", 0.0002)
+    tracer.record("render", 0.0004)
+    lines = tracer.report().splitlines()
+    assert lines[0].split() == ["span", "count", "min", "mean", "p50", "p90", "p99", "p999", "max", "(ms)"]
+    assert lines[1].split() == ["decode", "0"] + ["n/a"] * 7
+    assert lines[3].split() == ["render", "2", "0.200", "0.300", "0.200", "0.400", "0.400", "0.400", "0.400"]
+
+
+@pytest.mark.asyncio
+async def test_tracer_decode():
+    """
+    Decoding is traced within the BLE notification handler, also when running under supervision.
+    """
+    peripheral = EmulatedPeripheral()
+    tracer = Tracer()
+    supervisor = CalypsoDeviceSupervisor(
+        workhorse=lambda settings: CalypsoDeviceApi(ble_address=peripheral.ADDRESS, client_factory=peripheral.client)
+    )
+    tracer.instrument_device(supervisor)
+    readings = []
+    async with supervisor as calypso:
+        await calypso.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        await calypso.subscribe_reading(readings.append)
+        await asyncio.sleep(0.3)
+        await calypso.unsubscribe_reading()
+    assert supervisor.device.tracer is tracer
+    assert tracer.histograms["decode"].count == len(readings) > 0
+
+
+@pytest.mark.asyncio
+async def test_tracer_signal(caplog):
+    caplog.set_level(logging.INFO)
+    tracer = Tracer()
+    tracer.install_signal_handler(signal.SIGUSR1)
+    tracer.install_signal_handler(signal.SIGUSR1)
+    assert tracer.signals == [signal.SIGUSR1]
+    os.kill(os.getpid(), signal.SIGUSR1)
+    await asyncio.sleep(0.05)
+    assert len([message for message in caplog.messages if message.startswith("Latency trace:")]) == 1
+
+    tracer.close()
+    tracer.close()
+    assert tracer.signals == []
+    assert len([message for message in caplog.messages if message.startswith("Latency trace:")]) == 2
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import io
+import json
+import math
+import socket
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from calypso_anemometer.model import CalypsoReading, TrueWind  # noqa: E402
+from calypso_anemometer.pipeline import FanOutStage, Pipeline, StdoutSink  # noqa: E402
+from calypso_anemometer.telemetry.nmea0183 import Nmea0183GenericMessage  # noqa: E402
+from calypso_anemometer.truewind import (  # noqa: E402
+    KNOTS,
+    BoatMotion,
+    FixedMotionSource,
+    MotionTrack,
+    NmeaMotionSource,
+    TrueWindStage,
+    apply_true_wind,
+    make_true_wind_stage,
+    parse_motion,
+    process_recording,
+    true_wind,
+)
+
+# 2023-02-24T00:00:00Z
+EPOCH = 1677196800.0
+
+
+def make_reading(wind_speed: float, wind_direction: int) -> CalypsoReading:
+    return CalypsoReading(
+        wind_speed=wind_speed,
+        wind_direction=wind_direction,
+        battery_level=80,
+        temperature=20,
+        roll=0,
+        pitch=0,
+        heading=0,
+    )
+
+
+def sentence(identifier: str, *fields) -> str:
+    return Nmea0183GenericMessage(identifier=identifier, fields=list(fields)).render()
+
+
+def rmc(time_of_day: str, speed_knots: float, course: float) -> str:
+    return sentence(
+        "$GPRMC", time_of_day, "A", "5430.000", "N", "01030.000", "E", speed_knots, course, "240223", "", ""
+    )
+
+
+@pytest.mark.parametrize(
+    "apparent,motion,expected",
+    [
+        # Calm, the boat motion causes the apparent wind.
+        ((5.0, 0), (0.0, 5.0, 0.0), (0.0, 0.0, 0.0)),
+        # Boat is heading north, true wind from the east.
+        ((math.sqrt(50), 45), (0.0, 5.0, 0.0), (5.0, 90.0, 90.0)),
+        # Boat is heading east, true wind from the south.
+        ((math.sqrt(50), 45), (90.0, 5.0, 90.0), (5.0, 90.0, 180.0)),
+        # Boat is heading west, downwind, true wind from the east.
+        ((3.0, 180), (270.0, 5.0, 270.0), (8.0, 180.0, 90.0)),
+        # Boat at rest, true wind is apparent wind.
+        ((4.0, 300), (100.0, 0.0, 100.0), (4.0, 300.0, 40.0)),
+    ],
+)
+def test_true_wind(apparent, motion, expected):
+    speed, angle, direction = true_wind(*apparent, *motion)
+    assert (float(speed), float(angle), float(direction)) == pytest.approx(expected, abs=1e-9)
+
+
+def test_true_wind_vectorized():
+    """
+    Computing a batch yields the same results as computing each item.
+    """
+    rng = np.random.default_rng(42)
+    columns = [
+        rng.uniform(0, 20, 100),
+        rng.uniform(0, 360, 100),
+        rng.uniform(0, 360, 100),
+        rng.uniform(0, 10, 100),
+        rng.uniform(0, 360, 100),
+    ]
+    batch = true_wind(*columns)
+    for index in range(100):
+        single = true_wind(*(column[index] for column in columns))
+        assert [result[index] for result in batch] == pytest.approx(single)
+
+
+def test_apply_true_wind():
+    readings = [make_reading(math.sqrt(50), 45), make_reading(math.sqrt(50), 45)]
+    motion = {
+        # Heading falls back to the course over ground.
+        "heading": np.array([np.nan, 0.0]),
+        "speed_through_water": np.array([5.0, np.nan]),
+        "speed_over_ground": np.array([5.0, 5.0]),
+        "course_over_ground": np.array([0.0, 315.0]),
+    }
+    apply_true_wind(readings, motion)
+    assert readings[0].true_wind == TrueWind(speed=5.0, angle=90.0, direction=90.0)
+    assert readings[0].ground_wind == TrueWind(speed=5.0, angle=90.0, direction=90.0)
+    assert readings[1].true_wind is None
+    assert readings[1].ground_wind == TrueWind(speed=8.66, angle=80.3, direction=80.3)
+    assert readings[1].asdict()["ground_wind"] == {"speed": 8.66, "angle": 80.3, "direction": 80.3}
+    assert "true_wind" not in readings[1].asdict()
+
+
+def test_boat_motion_fixed():
+    motion = BoatMotion.fixed(speed=2.5, course=90.0)
+    assert motion == BoatMotion(heading=90.0, speed_through_water=2.5, speed_over_ground=2.5, course_over_ground=90.0)
+    assert BoatMotion.fixed(speed=2.5, course=90.0, heading=80.0).heading == 80.0
+    assert np.isnan(BoatMotion().asarrays(2)["heading"]).all()
+
+
+def test_parse_motion():
+    assert parse_motion(rmc("001230.50", 10.0, 45.5)) == {
+        "time": EPOCH + 750.5,
+        "speed_over_ground": pytest.approx(10 * KNOTS),
+        "course_over_ground": 45.5,
+    }
+    assert parse_motion(sentence("$GPVTG", "054.7", "T", "034.4", "M", "005.5", "N", "010.2", "K")) == {
+        "course_over_ground": 54.7,
+        "speed_over_ground": pytest.approx(5.5 * KNOTS),
+    }
+    assert parse_motion(sentence("$IIVHW", "245.1", "T", "", "M", "6.0", "N", "", "K")) == {
+        "heading": 245.1,
+        "speed_through_water": pytest.approx(6.0 * KNOTS),
+    }
+    assert parse_motion(sentence("$HEHDT", "12.5", "T")) == {"heading": 12.5}
+    # Missing values are skipped.
+    assert parse_motion(rmc("001230", 0.0, "")) == {"time": EPOCH + 750.0, "speed_over_ground": 0.0}
+    # Invalid positions, unknown sentences, and sentences emitted by this program are ignored.
+    assert parse_motion(sentence("$GPRMC", "001230", "V", "", "", "", "", "", "", "240223")) == {}
+    assert parse_motion(sentence("$GPGGA", "001230")) == {}
+    assert parse_motion(sentence("$MLHDT", "235.0", "T")) == {}
+
+
+def test_nmea_motion_source_feed():
+    source = NmeaMotionSource(max_age=5.0)
+    source.feed(f"{sentence('$HEHDT', '12.5', 'T')}\r\nfoo\r\n\r\n", timestamp=100.0)
+    source.feed(sentence("$GPVTG", "20.0", "T", "", "M", "5.0", "N", "", "K"), timestamp=103.0)
+    assert source.motion(now=104.0) == BoatMotion(
+        heading=12.5, speed_over_ground=pytest.approx(5.0 * KNOTS), course_over_ground=20.0
+    )
+    # Stale values are not used.
+    assert source.motion(now=106.0).heading is None
+    assert source.motion(now=109.0) is None
+    source.close()
+
+
+def test_nmea_motion_source_address():
+    source = NmeaMotionSource.from_address(":10110")
+    assert (source.host, source.port) == ("0.0.0.0", 10110)  # noqa: S104
+    with pytest.raises(ValueError) as ex:
+        NmeaMotionSource.from_address("localhost")
+    assert ex.match("Invalid NMEA-0183 input address: localhost")
+
+
+@pytest.mark.asyncio
+async def test_nmea_motion_source_udp():
+    """
+    Boat motion is received over UDP, and used to compute true wind within the pipeline.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    stage = make_true_wind_stage(nmea_input=f"127.0.0.1:{port}")
+    pipeline = Pipeline([stage])
+
+    # Listening starts with the first reading.
+    reading = pipeline(make_reading(math.sqrt(50), 45))
+    assert reading.true_wind is None
+    await asyncio.sleep(0.1)
+
+    data = "\r\n".join([sentence("$HEHDT", "0.0", "T"), sentence("$IIVHW", "0.0", "T", "", "M", "9.72", "N", "", "K")])
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        sender.sendto(data.encode(), ("127.0.0.1", port))
+    await asyncio.sleep(0.1)
+
+    reading = pipeline(make_reading(math.sqrt(50), 45))
+    assert reading.true_wind == TrueWind(speed=5.0, angle=90.0, direction=90.0)
+    assert reading.ground_wind is None
+    await pipeline.close()
+    assert stage.source.transport is None
+
+
+def test_true_wind_stage_fixed(capsys):
+    stage = TrueWindStage(FixedMotionSource(BoatMotion.fixed(speed=5.0, course=0.0)))
+    assert stage.name == "true-wind"
+    Pipeline([stage, FanOutStage([StdoutSink()])])(make_reading(math.sqrt(50), 45))
+    data = json.loads(capsys.readouterr().out)
+    assert data["true_wind"] == {"speed": 5.0, "angle": 90.0, "direction": 90.0}
+    assert stage.metrics.emitted == 1
+
+
+@pytest.mark.parametrize(
+    "kwargs,message",
+    [
+        ({"speed": 1.0}, "Fixed boat motion needs both speed and course"),
+        ({"speed": 1.0, "course": 0.0, "nmea_input": ":10110"}, "Use either fixed boat motion, or NMEA-0183 input"),
+    ],
+)
+def test_make_true_wind_stage_invalid(kwargs, message):
+    with pytest.raises(ValueError) as ex:
+        make_true_wind_stage(**kwargs)
+    assert ex.match(message)
+
+
+def test_motion_track():
+    lines = [
+        # Values before the first timestamp are not used.
+        sentence("$HEHDT", "90.0", "T"),
+        rmc("000000", 10.0, 350.0),
+        sentence("$HEHDT", "350.0", "T"),
+        rmc("000002", 12.0, 10.0),
+        sentence("$HEHDT", "10.0", "T"),
+        "garbage",
+        # A gap, where speed through water is only known at the end.
+        rmc("000030", 12.0, 10.0),
+        sentence("$IIVHW", "10.0", "T", "", "M", "6.0", "N", "", "K"),
+    ]
+    track = MotionTrack.from_nmea(lines, max_age=5.0)
+    assert track.times.tolist() == [EPOCH, EPOCH + 2, EPOCH + 30]
+
+    motion = track.at(np.array([EPOCH - 1, EPOCH, EPOCH + 1, EPOCH + 10, EPOCH + 28, EPOCH + 30, EPOCH + 31]))
+    # Angles wrap around north.
+    assert motion["course_over_ground"][1:3] == pytest.approx([350.0, 0.0])
+    assert motion["heading"][1:3] == pytest.approx([350.0, 0.0])
+    assert motion["speed_over_ground"][1:3] == pytest.approx([10 * KNOTS, 11 * KNOTS])
+    # No extrapolation, and no interpolation across gaps.
+    for column in motion.values():
+        assert np.isnan(column[[0, 3, 6]]).all()
+    # The heading of the last sample has been carried over, because it is recent enough.
+    assert motion["heading"][5] == pytest.approx(10.0)
+    assert motion["speed_through_water"][5] == pytest.approx(6 * KNOTS)
+    assert np.isnan(motion["speed_through_water"][4])
+
+    empty = MotionTrack.from_nmea([])
+    assert np.isnan(empty.at(np.array([EPOCH]))["heading"]).all()
+
+
+def test_motion_track_from_file(tmp_path):
+    path = tmp_path / "nmea.log"
+    path.write_text("\n".join([rmc("000000", 10.0, 90.0), rmc("000001", 10.0, 90.0)]))
+    track = MotionTrack.from_file(str(path))
+    assert len(track.times) == 2
+
+
+def test_process_recording():
+    records = [
+        {**make_reading(math.sqrt(50), 45).asdict(), "time": EPOCH + 0.5},
+        {**make_reading(math.sqrt(50), 45).asdict(), "time": EPOCH + 60},
+        {**make_reading(math.sqrt(50), 45).asdict()},
+    ]
+    infile = io.StringIO("\n".join(json.dumps(record) for record in records) + "\n\n")
+    outfile = io.StringIO()
+    track = MotionTrack.from_nmea([rmc("000000", 5 / KNOTS, 0.0), rmc("000001", 5 / KNOTS, 0.0)])
+    assert process_recording(infile, outfile, track, batch_size=2) == 3
+
+    results = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    assert results[0]["time"] == EPOCH + 0.5
+    assert results[0]["ground_wind"] == {"speed": 5.0, "angle": 90.0, "direction": 90.0}
+    assert "true_wind" not in results[0]
+    assert "ground_wind" not in results[1]
+    assert "ground_wind" not in results[2]
+
+    # Fixed boat motion does not need timestamps.
+    outfile = io.StringIO()
+    process_recording(io.StringIO(json.dumps(records[2])), outfile, BoatMotion.fixed(speed=5.0, course=0.0))
+    result = json.loads(outfile.getvalue())
+    assert result["true_wind"] == result["ground_wind"] == {"speed": 5.0, "angle": 90.0, "direction": 90.0}
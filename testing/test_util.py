@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 # (c) 2022 Andreas Motl <andreas.motl@panodata.org>
 # License: GNU Affero General Public License, Version 3
-import sys
+import asyncio
 
 import pytest
 
 from calypso_anemometer.model import BleCharSpec
-from calypso_anemometer.util import to_json, wait_forever
+from calypso_anemometer.util import make_sync, setup_event_loop, to_iso8601, to_json
 
 
 def test_json_encoder_primitive():
@@ -23,13 +23,22 @@ def test_json_encoder_dataclass():
     assert to_json(BleCharSpec("foo", "12345"), pretty=False) == '{"name": "foo", "uuid": "12345", "decoder": null}'
 
 
-@pytest.mark.asyncio
-async def test_wait_forever(mocker):
-    if sys.version_info < (3, 8, 0):
-        raise pytest.skip(reason="AsyncMock not supported on Python 3.7")
+def test_to_iso8601():
+    assert to_iso8601(1677196800.1234) == "2023-02-24T00:00:00.123Z"
 
-    from unittest.mock import AsyncMock
 
-    mocker.patch("calypso_anemometer.util.asyncio.wait_for", AsyncMock(return_value=None))
+def test_setup_event_loop_uvloop():
+    uvloop = pytest.importorskip("uvloop")
+    try:
+        setup_event_loop("uvloop")
+        assert isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy)
+        assert make_sync(asyncio.sleep)(0) is None
+    finally:
+        setup_event_loop("asyncio")
+    assert not isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy)
 
-    await wait_forever()
+
+def test_setup_event_loop_unknown():
+    with pytest.raises(ValueError) as ex:
+        setup_event_loop("foo")
+    assert ex.match("Unknown event loop: foo")
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import asyncio
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from calypso_anemometer.fake import CalypsoDeviceApiFake
+from calypso_anemometer.model import CalypsoDeviceDataRate
+from calypso_anemometer.watchdog import NotificationWatchdog
+
+
+def test_watchdog_interval():
+    fake = CalypsoDeviceApiFake()
+    watchdog = NotificationWatchdog(device=fake, callback=Mock(), tolerance=3.0)
+    assert watchdog.interval == 0.25
+    assert watchdog.timeout == 0.75
+    fake.datarate = CalypsoDeviceDataRate.HZ_8
+    assert watchdog.interval == 0.125
+
+
+@pytest.mark.asyncio
+async def test_watchdog_resubscribe_time_to_recovery(caplog):
+    """
+    Stall the notification stream of the fake device, and verify the watchdog recovers it by resubscribing.
+    """
+    callback = Mock()
+    async with CalypsoDeviceApiFake() as fake:
+        await fake.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        watchdog = NotificationWatchdog(device=fake, callback=callback, tolerance=2.0)
+        watchdog.start()
+        subscription = asyncio.ensure_future(watchdog.subscribe())
+        await asyncio.sleep(0.3)
+
+        # Stall the stream while the connection looks alive.
+        await fake.unsubscribe_reading()
+        await subscription
+        callback.reset_mock()
+
+        # Wait for the watchdog to recover.
+        for _ in range(50):
+            await asyncio.sleep(0.05)
+            if watchdog.metrics.recoveries:
+                break
+        watchdog.stop()
+
+    assert watchdog.metrics.stalls == 1
+    assert watchdog.metrics.resubscribes == 1
+    assert watchdog.metrics.recoveries == 1
+    assert watchdog.timeout < watchdog.metrics.last_time_to_recovery < 1.0
+    assert callback.called
+
+    assert "Recovering notification stream by resubscribing" in caplog.messages
+
+
+@pytest.mark.asyncio
+async def test_watchdog_escalate_reconnect():
+    """
+    When resubscribing does not help, the watchdog escalates to reconnecting.
+    """
+    device = Mock(datarate=CalypsoDeviceDataRate.HZ_8)
+    device.unsubscribe_reading = Mock(side_effect=asyncio.sleep)
+    device.subscribe_reading = Mock(side_effect=lambda callback: asyncio.sleep(0))
+    device.recycle = Mock(side_effect=lambda: asyncio.sleep(0))
+
+    watchdog = NotificationWatchdog(device=device, callback=Mock(), tolerance=1.0)
+    await watchdog.recover(elapsed=1.0)
+    await watchdog.recover(elapsed=1.0)
+    watchdog.stop()
+
+    assert watchdog.metrics.stalls == 2
+    assert watchdog.metrics.resubscribes == 1
+    assert watchdog.metrics.reconnects == 1
+    device.recycle.assert_called_once_with()
+
+
+def test_watchdog_hard_kill():
+    """
+    The thread-based guard kills the process without depending on the event loop.
+    """
+    killed = threading.Event()
+    watchdog = NotificationWatchdog(
+        device=CalypsoDeviceApiFake(), callback=Mock(), hard_timeout=0.1, kill=Mock(side_effect=killed.set)
+    )
+    watchdog.guard_thread = threading.Thread(target=watchdog.guard, daemon=True)
+    watchdog.guard_thread.start()
+    assert killed.wait(timeout=2.0)
+    watchdog.guard_thread.join(timeout=2.0)
+    watchdog.kill.assert_called_once_with()
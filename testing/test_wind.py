@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# (c) 2022 Andreas Motl <andreas.motl@panodata.org>
+# License: GNU Affero General Public License, Version 3
+import statistics
+from unittest.mock import Mock
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from calypso_anemometer.fake import CalypsoDeviceApiFake  # noqa: E402
+from calypso_anemometer.model import CalypsoDeviceDataRate, CalypsoReading  # noqa: E402
+from calypso_anemometer.wind import WindModel, ornstein_uhlenbeck  # noqa: E402
+
+
+def test_ornstein_uhlenbeck_recursion():
+    """
+    The vectorized computation, split into blocks, matches the plain recursion.
+    """
+    values = ornstein_uhlenbeck(1.0, 1000, interval=1.0, timescale=3.0, sigma=2.0, rng=np.random.default_rng(42))
+
+    noise = np.random.default_rng(42).standard_normal(1000) * 2.0 * np.sqrt(1.0 - np.exp(-2.0 / 3.0))
+    expected = []
+    value = 1.0
+    for item in noise:
+        value = np.exp(-1.0 / 3.0) * value + item
+        expected.append(value)
+
+    assert values == pytest.approx(expected)
+
+
+def test_wind_model_reproducible():
+    first = WindModel(seed=42).generate(100, interval=0.25)
+    second = WindModel(seed=42).generate(100, interval=0.25)
+    other = WindModel(seed=43).generate(100, interval=0.25)
+    assert first == second
+    assert first != other
+    assert all(isinstance(reading, CalypsoReading) for reading in first)
+
+
+def test_wind_model_chunk_size_independent():
+    model = WindModel(seed=42)
+    chunked = model.generate(50, interval=0.25) + model.generate(150, interval=0.25)
+    assert chunked == WindModel(seed=42).generate(200, interval=0.25)
+
+
+def test_wind_model_statistics():
+    model = WindModel(seed=42)
+    readings = model.generate(100_000, interval=0.25)
+    speeds = [reading.wind_speed for reading in readings]
+
+    # Mean wind, with gusts and turbulence on top.
+    assert statistics.mean(speeds) == pytest.approx(6.0, abs=0.5)
+    assert statistics.pstdev(speeds) == pytest.approx(6.0 * (0.15**2 + 0.1**2) ** 0.5, rel=0.25)
+    assert min(speeds) >= 0
+
+    # Value ranges the device is able to report.
+    assert all(0 <= reading.wind_direction < 360 for reading in readings)
+    assert all(0 <= reading.heading < 360 for reading in readings)
+    assert all(-90 <= reading.roll <= 90 for reading in readings)
+    assert {reading.battery_level % 10 for reading in readings} == {0}
+
+    # The battery drains slowly, over about seven hours.
+    assert readings[0].battery_level == 100
+    assert readings[-1].battery_level == 90
+
+
+@pytest.mark.asyncio
+async def test_fake_wind_model():
+    callback = Mock()
+    async with CalypsoDeviceApiFake(model=WindModel(seed=42), batch_size=10) as fake:
+        await fake.set_datarate(CalypsoDeviceDataRate.HZ_8)
+        await fake.subscribe_reading(callback=callback, run_once=True)
+    readings = [call.args[0] for call in callback.call_args_list]
+    assert readings == WindModel(seed=42).generate(10, interval=0.125)